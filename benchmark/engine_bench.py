@@ -0,0 +1,337 @@
+#!venv/bin/python
+""" Benchmark suite for TridentFrame's imaging engine.\n
+    Generates synthetic image sequence, GIF, APNG and spritesheet fixtures, then runs the engine's operations on them directly (without zerorpc).
+    Every case runs in its own fresh process so that peak RSS is measured per case. Results are printed as JSON.\n
+    Usage: python benchmark/engine_bench.py --width 320 --height 240 --frames 60 --alpha --repeat 3 --output bench.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import statistics
+import multiprocessing
+from datetime import datetime
+from typing import Dict
+
+import numpy as np
+from PIL import Image
+from apng import APNG, PNG
+
+
+BENCH_PATH = os.path.realpath(__file__)
+BENCH_DIR = os.path.dirname(BENCH_PATH)
+PROJECT_DIR = os.path.abspath(os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, PROJECT_DIR)
+
+CASES = [
+    "inspect_sequence", "inspect_gif", "inspect_apng",
+    "create_gif", "create_apng",
+    "split_gif", "split_apng",
+    "modify_gif", "modify_apng",
+    "build_spritesheet", "slice_spritesheet",
+]
+
+
+def _render_frame(index: int, width: int, height: int, fcount: int, alpha: bool, rng: np.random.Generator) -> Image.Image:
+    """ Draw a deterministic RGBA frame: a scrolling gradient with some noise, and a moving disc as the only opaque area if alpha is set """
+    y, x = np.mgrid[0:height, 0:width]
+    shift = index * 256 // max(fcount, 1)
+    noise = rng.integers(0, 24, (height, width))
+    red = (x * 255 // max(width - 1, 1) + shift) % 256
+    green = y * 255 // max(height - 1, 1)
+    blue = (x + y + noise + shift) % 256
+    opacity = np.full((height, width), 255)
+    if alpha:
+        angle = 2 * math.pi * index / max(fcount, 1)
+        cx = width / 2 + math.cos(angle) * width / 4
+        cy = height / 2 + math.sin(angle) * height / 4
+        radius = min(width, height) / 3
+        distance = np.hypot(x - cx, y - cy)
+        opacity = np.where(distance < radius, 255, np.where(distance < radius * 1.2, 128, 0))
+    pixels = np.stack([red, green, blue, opacity], axis=-1).astype(np.uint8)
+    return Image.fromarray(pixels)
+
+
+def _gif_frame(im: Image.Image) -> Image.Image:
+    """ Palettize an RGBA frame for the GIF fixture, with palette index 255 as transparency """
+    frame = im.convert("RGB").convert("P", palette=Image.ADAPTIVE, colors=255)
+    frame.paste(255, im.getchannel("A").point(lambda a: 255 if a < 128 else 0))
+    frame.info["transparency"] = 255
+    return frame
+
+
+def make_fixtures(fixture_dir: str, width: int, height: int, fcount: int, alpha: bool, delay: int, seed: int) -> Dict:
+    """ Generate the image sequence, GIF, APNG and spritesheet fixtures inside fixture_dir. Returns their paths and dimensions """
+    rng = np.random.default_rng(seed)
+    seq_dir = os.path.join(fixture_dir, "sequence")
+    os.makedirs(seq_dir, exist_ok=True)
+    frames = [_render_frame(index, width, height, fcount, alpha, rng) for index in range(fcount)]
+    sequence = []
+    for index, im in enumerate(frames):
+        path = os.path.join(seq_dir, f"frame_{str(index).zfill(4)}.png")
+        im.save(path, "PNG")
+        sequence.append(path)
+
+    gif_path = os.path.join(fixture_dir, "fixture.gif")
+    gif_frames = [_gif_frame(im) for im in frames]
+    gif_frames[0].save(gif_path, "GIF", save_all=True, append_images=gif_frames[1:], duration=delay, loop=0, disposal=2, transparency=255)
+
+    apng_path = os.path.join(fixture_dir, "fixture.png")
+    apng = APNG()
+    for path in sequence:
+        apng.append(PNG.open(path), delay=delay, delay_den=1000)
+    apng.save(apng_path)
+
+    tiles_per_row = math.ceil(math.sqrt(fcount))
+    rows = math.ceil(fcount / tiles_per_row)
+    sheet = Image.new("RGBA", (width * tiles_per_row, height * rows))
+    for index, im in enumerate(frames):
+        sheet.paste(im, ((index % tiles_per_row) * width, (index // tiles_per_row) * height))
+    sheet_path = os.path.join(fixture_dir, "spritesheet.png")
+    sheet.save(sheet_path, "PNG")
+
+    return {
+        "sequence": sequence,
+        "gif": gif_path,
+        "apng": apng_path,
+        "spritesheet": sheet_path,
+        "width": width,
+        "height": height,
+        "frames": fcount,
+        "delay": delay,
+        "tiles_per_row": tiles_per_row,
+        "sheet_width": sheet.width,
+        "sheet_height": sheet.height,
+    }
+
+
+def _creation_vals(fixtures: Dict, fmt: str, workers: int) -> Dict:
+    return {
+        'name': "created", 'fps': 1000 / fixtures['delay'], 'delay': fixtures['delay'] / 1000, 'format': fmt,
+        'is_reversed': False, 'is_transparent': True, 'flip_x': False, 'flip_y': False,
+        'width': fixtures['width'], 'height': fixtures['height'], 'loop_count': 0, 'start_frame': 1, 'rotation': 0, 'workers': workers,
+        'is_optimized': False, 'optimization_level': 1, 'is_lossy': False, 'lossy_value': 0,
+        'is_reduced_color': False, 'color_space': 0, 'is_unoptimized': False,
+        'apng_is_optimized': False, 'apng_optimization_level': 0, 'apng_is_lossy': False, 'apng_lossy_value': 0, 'apng_is_unoptimized': False,
+    }
+
+
+def _modification_vals(image_path: str, fmt: str, workers: int) -> Dict:
+    """ Fill in the modification criteria the same way the frontend does from an inspection, reversing and flipping the image """
+    from pycore.inspect_ops import inspect_general
+    info = inspect_general(image_path)
+    gen_info = info['general_info']
+    ani_info = info['animation_info']
+    vals = _creation_vals({'delay': ani_info['avg_delay']['value'] * 1000, 'width': 0, 'height': 0}, fmt, workers)
+    vals.update({
+        'orig_name': gen_info['name']['value'], 'name': "modified", 'orig_format': gen_info['format']['value'],
+        'orig_width': gen_info['width']['value'], 'orig_height': gen_info['height']['value'],
+        'width': gen_info['width']['value'], 'height': gen_info['height']['value'],
+        'orig_delay': ani_info['avg_delay']['value'], 'delay': ani_info['avg_delay']['value'], 'fps': ani_info['fps']['value'],
+        'orig_frame_count': ani_info['frame_count']['value'], 'orig_frame_count_ds': ani_info['frame_count_ds']['value'],
+        'orig_loop_duration': ani_info['loop_duration']['value'],
+        'orig_loop_count': ani_info['loop_count']['value'], 'loop_count': ani_info['loop_count']['value'],
+        'skip_frame': 0, 'preserve_alpha': True, 'is_reversed': True, 'flip_x': True,
+    })
+    return vals
+
+
+def _split_vals() -> Dict:
+    return {'new_name': "", 'pad_count': 4, 'color_space': 0, 'is_duration_sensitive': False, 'is_unoptimized': True, 'will_generate_delay_info': False}
+
+
+def _prepare_case(case: str, fixtures: Dict, out_dir: str, workers: int):
+    """ Returns the operation generator of a case, and the number of frames it processes """
+    from pycore.inspect_ops import inspect_general, inspect_sequence
+    from pycore.create_ops import create_aimg
+    from pycore.split_ops import split_aimg
+    from pycore.modify_ops import modify_aimg
+    from pycore.sprite_ops import _build_spritesheet, _slice_spritesheet
+    from pycore.core_funcs.criterion import (CriteriaBundle, CreationCriteria, SplitCriteria, ModificationCriteria,
+                                             SpritesheetBuildCriteria, SpritesheetSliceCriteria, GIFOptimizationCriteria, APNGOptimizationCriteria)
+    from pycore.core_funcs.inspect_cache import inspection_cache
+
+    fcount = fixtures['frames']
+    if case.startswith("inspect_"):
+        inspection_cache.clear()
+    if case == "inspect_sequence":
+        return inspect_sequence(fixtures['sequence']), fcount
+    elif case in ("inspect_gif", "inspect_apng"):
+        image_path = fixtures['gif' if case == "inspect_gif" else 'apng']
+        return (inspect_general(image_path) for _ in range(1)), fcount
+    elif case in ("create_gif", "create_apng"):
+        vals = _creation_vals(fixtures, "GIF" if case == "create_gif" else "PNG", workers)
+        crbundle = CriteriaBundle({
+            'create_aimg': CreationCriteria(vals),
+            'gif_opt': GIFOptimizationCriteria(vals),
+            'apng_opt': APNGOptimizationCriteria(vals),
+        })
+        return create_aimg(fixtures['sequence'], out_dir, vals['name'], crbundle), fcount
+    elif case in ("split_gif", "split_apng"):
+        image_path = fixtures['gif' if case == "split_gif" else 'apng']
+        return split_aimg(image_path, out_dir, SplitCriteria(_split_vals())), fcount
+    elif case in ("modify_gif", "modify_apng"):
+        image_path = fixtures['gif' if case == "modify_gif" else 'apng']
+        vals = _modification_vals(image_path, "GIF" if case == "modify_gif" else "PNG", workers)
+        inspection_cache.clear()
+        crbundle = CriteriaBundle({
+            'modify_aimg': ModificationCriteria(vals),
+            'gif_opt': GIFOptimizationCriteria(vals),
+            'apng_opt': APNGOptimizationCriteria(vals),
+        })
+        return modify_aimg(image_path, out_dir, crbundle), fcount
+    elif case == "build_spritesheet":
+        criteria = SpritesheetBuildCriteria({
+            'tile_width': fixtures['width'], 'tile_height': fixtures['height'], 'input_format': "sequence",
+            'tile_row': fixtures['tiles_per_row'], 'preserve_alpha': True,
+        })
+        return _build_spritesheet(fixtures['sequence'], out_dir, "spritesheet", criteria), fcount
+    elif case == "slice_spritesheet":
+        criteria = SpritesheetSliceCriteria({
+            'sheet_width': fixtures['sheet_width'], 'sheet_height': fixtures['sheet_height'],
+            'tile_width': fixtures['width'], 'tile_height': fixtures['height'],
+        })
+        tiles = math.ceil(fixtures['sheet_width'] / fixtures['width']) * math.ceil(fixtures['sheet_height'] / fixtures['height'])
+        return _slice_spritesheet(fixtures['spritesheet'], out_dir, "tile", criteria), tiles
+    else:
+        raise Exception(f"Unknown benchmark case: {case}")
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def _peak_rss_kb() -> int:
+    """ Peak resident set size of this process in KB. Read from VmHWM on Linux, because ru_maxrss is carried over across exec
+        and would report the parent's peak in a freshly spawned process
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _run_case(case: str, fixtures: Dict, work_dir: str, out_dir: str, workers: int, queue: multiprocessing.Queue):
+    """ Runs a single case to completion inside a child process, and puts its measurements into the queue """
+    os.chdir(work_dir)
+    try:
+        operation, fcount = _prepare_case(case, fixtures, out_dir, workers)
+        baseline_rss = _peak_rss_kb()
+        start = time.perf_counter()
+        for _msg in operation:
+            pass
+        wall = time.perf_counter() - start
+        queue.put({
+            "wall_s": wall,
+            "frames": fcount,
+            "frames_per_s": fcount / wall if wall else None,
+            "peak_rss_kb": _peak_rss_kb(),
+            "baseline_rss_kb": baseline_rss,
+            "bytes_written": _dir_size(out_dir),
+        })
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_case(case: str, fixtures: Dict, work_dir: str, workers: int, repeat: int) -> Dict:
+    """ Runs a case repeat times, each in a fresh process with an empty output folder, and summarizes the runs """
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for _ in range(repeat):
+        out_dir = os.path.join(work_dir, "out", case)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        os.makedirs(out_dir)
+        queue = context.Queue()
+        process = context.Process(target=_run_case, args=(case, fixtures, work_dir, out_dir, workers, queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        if "error" in result:
+            return {"case": case, "error": result["error"]}
+        runs.append(result)
+    walls = [r["wall_s"] for r in runs]
+    median_wall = statistics.median(walls)
+    return {
+        "case": case,
+        "frames": runs[0]["frames"],
+        "wall_s_min": min(walls),
+        "wall_s_median": median_wall,
+        "frames_per_s": runs[0]["frames"] / median_wall if median_wall else None,
+        "peak_rss_kb": max(r["peak_rss_kb"] for r in runs),
+        "baseline_rss_kb": min(r["baseline_rss_kb"] for r in runs),
+        "bytes_written": runs[-1]["bytes_written"],
+        "runs": runs,
+    }
+
+
+def _make_work_dir(path: str) -> str:
+    """ Create the benchmark's working directory. The engine resolves config/, bin/, cache/ and temp/ relative to it, so the project's
+        config and binaries are linked in while the cache and temp folders stay separate from the app's own
+    """
+    work_dir = os.path.abspath(path) if path else tempfile.mkdtemp(prefix="tridentframe_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    for dirname in ("config", "bin"):
+        link = os.path.join(work_dir, dirname)
+        if not os.path.exists(link):
+            os.symlink(os.path.join(PROJECT_DIR, dirname), link)
+    return work_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TridentFrame's imaging engine on synthetic fixtures")
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--alpha", action="store_true", help="Give the fixtures transparent areas")
+    parser.add_argument("--delay", type=int, default=40, help="Delay of each fixture frame in milliseconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--work-dir", default="", help="Folder for the fixtures and outputs. A new temporary folder is used if omitted")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder afterwards")
+    parser.add_argument("--output", default="", help="Also write the JSON report into this file")
+    args = parser.parse_args()
+
+    work_dir = _make_work_dir(args.work_dir)
+    try:
+        fixtures = make_fixtures(os.path.join(work_dir, "fixtures"), args.width, args.height, args.frames, args.alpha, args.delay, args.seed)
+        results = [run_case(case, fixtures, work_dir, args.workers, args.repeat) for case in args.cases]
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "cpu_count": os.cpu_count(),
+        "params": {
+            "width": args.width, "height": args.height, "frames": args.frames, "alpha": args.alpha,
+            "delay": args.delay, "seed": args.seed, "workers": args.workers, "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as jsonfile:
+            jsonfile.write(report_json)
+    print(report_json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!venv/bin/python
+""" Startup benchmark for TridentFrame's imaging engine.\n
+    Starts the engine repeatedly and measures how long it takes to accept connections and to report itself ready through the ready RPC,
+    both in the default mode (bind first, warm up in the background) and with --eager (warm up first, then bind). The warmup case times
+    each warm-up step in a fresh process without starting a server. Results are printed as JSON.\n
+    Usage: python benchmark/startup_bench.py --repeat 5 --output startup.json
+    Pass the frozen engine with --engine engine/linux/main to benchmark a build instead of main.py
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import platform
+import argparse
+import statistics
+import subprocess
+import multiprocessing
+from datetime import datetime
+from typing import Dict, List
+
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+PROJECT_DIR = os.path.abspath(os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, PROJECT_DIR)
+
+CASES = ["warmup", "engine_lazy", "engine_eager"]
+ENGINE_ADDRESS = ('127.0.0.1', 42069)
+
+
+def _run_warmup(work_dir: str, queue: multiprocessing.Queue):
+    """ Times the imports the server needs before it can bind, and then each warm-up step, inside a child process """
+    os.chdir(work_dir)
+    try:
+        start = time.perf_counter()
+        from pycore.core_funcs.warmup import engine_warmup
+        import_s = time.perf_counter() - start
+        engine_warmup.wait()
+        status = engine_warmup.status()
+        if not status["ready"]:
+            raise Exception(status["error"])
+        queue.put({"import_s": import_s, "warmup_s": status["elapsed"], "steps": status["steps"]})
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_warmup(work_dir: str) -> Dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_warmup, args=(work_dir, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _wait_for_bind(engine: subprocess.Popen, timeout: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if engine.poll() is not None:
+            raise Exception(f"The engine exited with code {engine.returncode}")
+        try:
+            with socket.create_connection(ENGINE_ADDRESS, timeout=0.5):
+                return time.perf_counter()
+        except OSError:
+            time.sleep(0.005)
+    raise Exception(f"The engine did not bind within {timeout} seconds")
+
+
+def run_engine(engine_cmd: List[str], work_dir: str, eager: bool, timeout: float) -> Dict:
+    """ Start the engine once, and time how long it takes to bind and to report itself ready """
+    try:
+        import zerorpc
+    except ImportError as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    start = time.perf_counter()
+    engine = subprocess.Popen(engine_cmd + (["--eager"] if eager else []), cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        bound = _wait_for_bind(engine, timeout)
+        client = zerorpc.Client(timeout=timeout)
+        client.connect(f"tcp://{ENGINE_ADDRESS[0]}:{ENGINE_ADDRESS[1]}")
+        first_reply = None
+        try:
+            while True:
+                status = client.ready(0.05)
+                first_reply = first_reply or time.perf_counter()
+                if status["ready"] or status["state"] == "failed":
+                    break
+        finally:
+            client.close()
+        if not status["ready"]:
+            raise Exception(status["error"])
+        ready = time.perf_counter()
+        return {"bind_s": bound - start, "first_reply_s": first_reply - start, "ready_s": ready - start, "steps": status["steps"]}
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    finally:
+        engine.terminate()
+        engine.wait()
+
+
+def _summarize(case: str, runs: List[Dict]) -> Dict:
+    errors = [run["error"] for run in runs if "error" in run]
+    if errors:
+        return {"case": case, "error": errors[0]}
+    summary = {"case": case}
+    for key in runs[0]:
+        if key.endswith("_s"):
+            values = [run[key] for run in runs]
+            summary[f"{key}_min"] = min(values)
+            summary[f"{key}_median"] = statistics.median(values)
+    summary["runs"] = runs
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the startup of TridentFrame's imaging engine")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=CASES)
+    parser.add_argument("--engine", default="", help="Engine executable to start. Runs main.py with this Python if omitted")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for the engine to bind and warm up")
+    parser.add_argument("--work-dir", default="", help="Folder the engine runs in. A new temporary folder is used if omitted")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder afterwards")
+    parser.add_argument("--output", default="", help="Also write the JSON report into this file")
+    args = parser.parse_args()
+    # engine_bench imports Pillow and numpy, which would skew the warmup case if the spawned children imported it along with this module
+    from engine_bench import _make_work_dir
+
+    engine_cmd = [os.path.abspath(args.engine)] if args.engine else [sys.executable, os.path.join(PROJECT_DIR, "main.py")]
+    work_dir = _make_work_dir(args.work_dir)
+    try:
+        results = []
+        for case in args.cases:
+            if case == "warmup":
+                runs = [run_warmup(work_dir) for _ in range(args.repeat)]
+            else:
+                runs = [run_engine(engine_cmd, work_dir, case == "engine_eager", args.timeout) for _ in range(args.repeat)]
+            results.append(_summarize(case, runs))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "engine": engine_cmd,
+        "params": {"repeat": args.repeat, "timeout": args.timeout},
+        "results": results,
+    }
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as jsonfile:
+            jsonfile.write(report_json)
+    print(report_json)
+
+
+if __name__ == "__main__":
+    main()
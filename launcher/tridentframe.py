@@ -1,13 +1,28 @@
+import time
+import socket
 import subprocess
-from multiprocessing import Pool
 
 
-processes = ('./resources/app/engine/linux/main', './tridentframe-electron')
+ENGINE = './resources/app/engine/linux/main'
+ELECTRON = './tridentframe-electron'
+ENGINE_ADDRESS = ('127.0.0.1', 42069)
+ENGINE_BIND_TIMEOUT = 30
 
 
-def run_process(process):
-    subprocess.run(process)
+def wait_for_engine(engine: subprocess.Popen) -> bool:
+    """ Wait until the engine accepts connections. It binds before loading the imaging code, so this takes a fraction of a second """
+    deadline = time.time() + ENGINE_BIND_TIMEOUT
+    while time.time() < deadline and engine.poll() is None:
+        try:
+            with socket.create_connection(ENGINE_ADDRESS, timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
 
 
-pool = Pool(processes=2)
-pool.map(run_process, processes)
+engine = subprocess.Popen(ENGINE)
+if not wait_for_engine(engine):
+    print("The imaging engine did not start, launching the app anyway")
+subprocess.run(ELECTRON)
+engine.wait()
@@ -6,39 +6,74 @@ from typing import List
 import os
 import signal
 import time
+import uuid
+import multiprocessing
 
+import gevent
 import zerorpc
 
-from pycore.inspect_ops import inspect_sequence, inspect_general, _inspect_smart
-from pycore.create_ops import create_aimg
-from pycore.split_ops import split_aimg
-from pycore.sprite_ops import _build_spritesheet, _slice_spritesheet
-from pycore.modify_ops import modify_aimg
-from pycore.core_funcs.criterion import CriteriaBundle, CreationCriteria, SplitCriteria, ModificationCriteria, SpritesheetBuildCriteria, SpritesheetSliceCriteria, GIFOptimizationCriteria, APNGOptimizationCriteria
-from pycore.core_funcs.utility import _purge_directory, util_generator, util_generator_shallow
-from pycore.core_funcs.config import ABS_CACHE_PATH, ABS_TEMP_PATH
+# The ops modules and utility pull in Pillow, numpy and apng, so they are imported inside the API methods instead.
+# The engine warm-up imports them in the background right after the server is bound, see main()
+from pycore.batch_ops import BatchManager
+from pycore.core_funcs.criterion import CriteriaBundle, CreationCriteria, SplitCriteria, ModificationCriteria, SpritesheetBuildCriteria, SpritesheetSliceCriteria, GIFOptimizationCriteria, APNGOptimizationCriteria, PreviewCriteria
+from pycore.core_funcs.config import ABS_CACHE_PATH, ABS_TEMP_PATH, WARMUP_POLL_INTERVAL
+from pycore.core_funcs.inspect_cache import inspection_cache
+from pycore.core_funcs.preview_cache import preview_cache
+from pycore.core_funcs.stage_cache import stage_cache
+from pycore.core_funcs.cancellation import CancellationToken, cancellable
+from pycore.core_funcs.instrumentation import profiled
+from pycore.core_funcs.scratch import scratch_space
+from pycore.core_funcs.imager_backends import imager_backends
+from pycore.core_funcs.process_runner import process_runner
+from pycore.core_funcs.warmup import engine_warmup
 
 
 IS_FROZEN = getattr(sys, 'frozen', False)
+batch_manager = BatchManager()
+operation_tokens = {}
+
+
+def _cancellable_stream(operation, vals: dict):
+    """Stream an operation that can be cancelled through API.cancel_operation. The operation ID is taken from vals['op_id'] if given, and announced first.
+    Stage timings are reported before the final CONTROL message if vals['profile'] or vals['trace_path'] is set"""
+    op_id = str(vals.get('op_id') or uuid.uuid4().hex)
+    token = CancellationToken()
+    operation_tokens[op_id] = token
+    try:
+        yield {"op_id": op_id}
+        yield from cancellable(profiled(operation, vals), token)
+    finally:
+        operation_tokens.pop(op_id, None)
+
 
 class API(object):
     
     def echo(self, msg):
         return f"{msg} echoed"
 
+    def ready(self, timeout=0):
+        """Report whether the engine has finished warming up, waiting up to timeout seconds for it. Also returns the time taken by each warm-up step"""
+        deadline = time.time() + (timeout or 0)
+        while not engine_warmup.is_finished and time.time() < deadline:
+            gevent.sleep(WARMUP_POLL_INTERVAL)
+        return engine_warmup.status()
+
     def inspect_one(self, image_path, fitler_on=""):
         """Inspect a single image and then return its information"""
+        from pycore.inspect_ops import inspect_general
         return inspect_general(image_path, filter_on=fitler_on)
     
     @zerorpc.stream
     def inspect_many(self, image_paths):
         """Inspect a sequence of images and then return their information"""
+        from pycore.inspect_ops import inspect_sequence
         info = inspect_sequence(image_paths)
         return info
 
     @zerorpc.stream
     def inspect_smart(self, image_path):
         """Inspect a sequence of images and then return their information"""
+        from pycore.inspect_ops import _inspect_smart
         info = _inspect_smart(image_path)
         # raise Exception("mama")
         return info
@@ -46,6 +81,7 @@ class API(object):
     @zerorpc.stream
     def combine_image(self, image_paths, out_dir, filename, vals: dict):
         """Combine a sequence of images into a GIF/APNG"""
+        from pycore.create_ops import create_aimg
         # raise Exception(image_paths, out_dir, filename, fps, extension, fps, reverse, transparent)
         if not image_paths and not out_dir:
             raise Exception("Please load the images and choose the output folder!")
@@ -58,11 +94,12 @@ class API(object):
             "gif_opt": GIFOptimizationCriteria(vals),
             "apng_opt": APNGOptimizationCriteria(vals)
         })
-        return create_aimg(image_paths, out_dir, filename, crbundle)
+        return _cancellable_stream(create_aimg(image_paths, out_dir, filename, crbundle), vals)
 
     @zerorpc.stream
     def split_image(self, image_path, out_dir, vals):
         """Split all the frames of a GIF/APNG into a sequence of images"""
+        from pycore.split_ops import split_aimg
         if not image_path and not out_dir:
             raise Exception("Please load a GIF or APNG and choose the output folder!")
         elif not image_path:
@@ -70,11 +107,12 @@ class API(object):
         elif not out_dir:
             raise Exception("Please choose an output folder!")
         criteria = SplitCriteria(vals)
-        return split_aimg(image_path, out_dir, criteria)
+        return _cancellable_stream(split_aimg(image_path, out_dir, criteria), vals)
 
     @zerorpc.stream
     def modify_image(self, image_path, out_dir, vals):
         """Modify the criteria and behavior of a GIF/APNG"""
+        from pycore.modify_ops import modify_aimg
         if not image_path and not out_dir:
             raise Exception("Please load a GIF or APNG and choose the output folder!")
         elif not image_path:
@@ -87,12 +125,27 @@ class API(object):
             'gif_opt': GIFOptimizationCriteria(vals),
             'apng_opt': APNGOptimizationCriteria(vals),
         })
-        return modify_aimg(image_path, out_dir, crbundle)
+        return _cancellable_stream(modify_aimg(image_path, out_dir, crbundle), vals)
+
+    @zerorpc.stream
+    def preview_image(self, image_path, vals):
+        """Preview the modifications of a GIF/APNG on a cached low-resolution proxy of it. The full resolution image is only rendered by modify_image"""
+        from pycore.modify_ops import preview_aimg
+        if not image_path:
+            raise Exception("Please load a GIF or APNG!")
+        crbundle = CriteriaBundle({
+            'modify_aimg': ModificationCriteria(vals),
+            'gif_opt': GIFOptimizationCriteria(vals),
+            'apng_opt': APNGOptimizationCriteria(vals),
+            'preview': PreviewCriteria(vals),
+        })
+        return _cancellable_stream(preview_aimg(image_path, crbundle), vals)
         
 
     @zerorpc.stream
     def build_spritesheet(self, image_paths, out_dir, filename, vals: dict):
         """Build a spritesheet using the specified sequence of images"""
+        from pycore.sprite_ops import _build_spritesheet
     # def build_spritesheet(self, image_paths, input_mode, out_dir, filename, width, height, tiles_per_row, off_x, off_y, pad_x, pad_y, preserve_alpha):
         if not image_paths and not out_dir:
             raise Exception("Please load the images and choose the output folder!")
@@ -103,11 +156,12 @@ class API(object):
         criteria = SpritesheetBuildCriteria(vals)
         # raise Exception(criteria.__dict__)
         # yield {"msg": "yo"}
-        return _build_spritesheet(image_paths, out_dir, filename, criteria)
+        return _cancellable_stream(_build_spritesheet(image_paths, out_dir, filename, criteria), vals)
     
     @zerorpc.stream
     def slice_spritesheet(self, image_path, out_dir, filename, vals: dict):
         """Slice a spritesheet into individual sections"""
+        from pycore.sprite_ops import _slice_spritesheet
         if not image_path and not out_dir:
             raise Exception("Please load the spritesheet and choose the output folder!")
         elif not image_path:
@@ -115,14 +169,99 @@ class API(object):
         elif not out_dir:
             raise Exception("Please choos the output folder")
         criteria = SpritesheetSliceCriteria(vals)
-        return _slice_spritesheet(image_path, out_dir, filename, criteria)
+        return _cancellable_stream(_slice_spritesheet(image_path, out_dir, filename, criteria), vals)
+
+    def submit_batch(self, jobs: List[dict]):
+        """Queue a list of create/split/modify/spritesheet jobs to run concurrently. Returns the batch ID and the job IDs"""
+        return batch_manager.submit(jobs)
+
+    @zerorpc.stream
+    def stream_batch(self, batch_id):
+        """Stream the interleaved progress of every job in a batch, each tagged with its job_id"""
+        return batch_manager.stream(batch_id, idle=gevent.sleep)
+
+    def batch_status(self, batch_id):
+        """Return the status of every job in a batch"""
+        return batch_manager.batch_status(batch_id)
+
+    def job_status(self, job_id):
+        """Return the status of a single batch job"""
+        return batch_manager.job_status(job_id)
+
+    def job_result(self, job_id):
+        """Return the result of a finished batch job"""
+        return batch_manager.job_result(job_id)
+
+    def cancel_operation(self, op_id):
+        """Cancel a running create/split/modify/spritesheet stream by its operation ID"""
+        token = operation_tokens.get(op_id)
+        if not token:
+            raise Exception(f"No running operation with the ID {op_id}")
+        token.cancel()
+        return op_id
+
+    def cancel_job(self, job_id):
+        """Cancel a queued or running batch job"""
+        return batch_manager.cancel_job(job_id)
+
+    def cancel_batch(self, batch_id):
+        """Cancel every unfinished job of a batch"""
+        return batch_manager.cancel_batch(batch_id)
+
+    def forget_batch(self, batch_id):
+        """Drop the records of a finished batch"""
+        batch_manager.forget_batch(batch_id)
+        return batch_id
+
+    def set_batch_workers(self, workers: int):
+        """Change the number of worker processes used for batch jobs"""
+        batch_manager.set_workers(workers)
+        return batch_manager.workers
+
+    def inspection_cache_stats(self):
+        """Return the hit/miss counters and size of the inspection cache"""
+        return inspection_cache.stats()
+
+    def preview_cache_stats(self):
+        """Return the hit/miss counters and size of the cache of modification previews"""
+        return preview_cache.stats()
+
+    def stage_cache_stats(self):
+        """Return the hit/miss counters and size of the cache of modify pipeline stages"""
+        return stage_cache.stats()
 
     def purge_cache_temp(self):
-        """Remove cache and temp directories"""
+        """Remove cache and temp directories. Scratch directories of running operations are kept"""
+        from pycore.core_funcs.utility import _purge_directory
         _purge_directory(ABS_TEMP_PATH())
-        _purge_directory(ABS_CACHE_PATH())
+        # The inspection cache database can be held open by batch workers, so it is emptied instead of removed
+        inspection_cache.clear()
+        _purge_directory(ABS_CACHE_PATH(), keep=[scratch_space.root, inspection_cache.db_path()])
+        scratch_space.purge()
         return "Cache and temp evaporated"
 
+    def scratch_stats(self):
+        """Return the location, size and byte cap of the scratch space"""
+        return scratch_space.stats()
+
+    def configure_scratch(self, max_bytes=None, use_tmpfs=None):
+        """Change the byte cap of the scratch space, or move it to/from tmpfs. Applies to batch jobs submitted from now on as well"""
+        scratch_space.configure(max_bytes, use_tmpfs)
+        return scratch_space.stats()
+
+    def imager_stats(self):
+        """Return the probed image processing binaries, and the backends of each imaging operation along with their measured speeds"""
+        return imager_backends.stats()
+
+    def benchmark_imagers(self):
+        """Time every backend of the operations that have more than one on synthetic jobs, so that the fastest is picked right away"""
+        return imager_backends.benchmark()
+
+    def reload_imagers(self):
+        """Probe the image processing binaries again"""
+        imager_backends.reload()
+        return imager_backends.stats()
+
     def print_cwd(self):
         """Dev method for displaying python cwd"""
         msg = {
@@ -135,6 +274,7 @@ class API(object):
 
     @zerorpc.stream
     def test_generator(self):
+        from pycore.core_funcs.utility import util_generator
         return util_generator()
 
 
@@ -154,14 +294,21 @@ def main():
     port = '42069'
     # print(port)
     handle_execpath()
+    # With --eager the engine finishes warming up before binding, the way it used to start. Otherwise it warms up while already serving
+    if "--eager" in sys.argv:
+        engine_warmup.wait()
     # port = argv
     address = f"tcp://127.0.0.1:{port}"
     SERVER: zerorpc.Server = zerorpc.Server(API())
     SERVER.debug = True
     SERVER.bind(address)
+    engine_warmup.start()
+    # The RPCs are served by greenlets of this thread, which must not be blocked while an operation waits for a binary, or a cancel_operation could not get through
+    process_runner.set_idle(gevent.sleep)
     print(f"Starting TridentFrame's imaging engine on {address}")
     # killer = GracefullKiller(SERVER)
     SERVER.run()
+    batch_manager.shutdown()
 
 
 def handle_execpath():
@@ -171,6 +318,7 @@ def handle_execpath():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     # port = sys.argv[-1]
     main()
     # main(port)
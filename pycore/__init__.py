@@ -1,2 +1,10 @@
-from . import bin_funcs
-from . import core_funcs
+import importlib
+
+# The subpackages are only imported on first access, which lets the engine bind its RPC server before loading any of the imaging code
+_SUBMODULES = ('bin_funcs', 'core_funcs')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,337 @@
+import os
+import time
+import uuid
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import List, Dict, Callable, Iterator
+
+from .core_funcs.config import BATCH_POLL_INTERVAL, BATCH_EVENT_BUFFER
+from .core_funcs.cancellation import CancellationToken, activated, cancellable
+from .core_funcs.instrumentation import profiled
+from .core_funcs.scratch import scratch_space
+from .core_funcs.criterion import CriteriaBundle, CreationCriteria, SplitCriteria, ModificationCriteria, SpritesheetBuildCriteria, SpritesheetSliceCriteria, GIFOptimizationCriteria, APNGOptimizationCriteria
+
+
+BATCH_OPERATIONS = ('create', 'split', 'modify', 'build_spritesheet', 'slice_spritesheet')
+
+_progress_queue: multiprocessing.Queue = None
+
+
+def _operation_generator(job: Dict):
+    """ Build the criteria of a batch job the same way the single-shot API methods do, and return its operation's generator.\n
+        Job keys follow the API methods' parameters: create/build_spritesheet take image_paths, out_dir, filename and vals,
+        split/modify take image_path, out_dir and vals, and slice_spritesheet takes image_path, out_dir, filename and vals
+    """
+    # Imported here so that the engine can start without loading the ops modules, the worker processes import them for their first job
+    from .create_ops import create_aimg
+    from .split_ops import split_aimg
+    from .modify_ops import modify_aimg
+    from .sprite_ops import _build_spritesheet, _slice_spritesheet
+
+    operation = job.get('operation')
+    vals = job.get('vals') or {}
+    if operation == 'create':
+        crbundle = CriteriaBundle({
+            "create_aimg": CreationCriteria(vals),
+            "gif_opt": GIFOptimizationCriteria(vals),
+            "apng_opt": APNGOptimizationCriteria(vals),
+        })
+        return create_aimg(job['image_paths'], job['out_dir'], job['filename'], crbundle)
+    elif operation == 'split':
+        return split_aimg(job['image_path'], job['out_dir'], SplitCriteria(vals))
+    elif operation == 'modify':
+        crbundle = CriteriaBundle({
+            'modify_aimg': ModificationCriteria(vals),
+            'gif_opt': GIFOptimizationCriteria(vals),
+            'apng_opt': APNGOptimizationCriteria(vals),
+        })
+        return modify_aimg(job['image_path'], job['out_dir'], crbundle)
+    elif operation == 'build_spritesheet':
+        return _build_spritesheet(job['image_paths'], job['out_dir'], job['filename'], SpritesheetBuildCriteria(vals))
+    elif operation == 'slice_spritesheet':
+        return _slice_spritesheet(job['image_path'], job['out_dir'], job['filename'], SpritesheetSliceCriteria(vals))
+    else:
+        raise Exception(f"Unknown batch operation: {operation}. Supported operations are {', '.join(BATCH_OPERATIONS)}")
+
+
+def _init_worker(progress_queue: multiprocessing.Queue):
+    global _progress_queue
+    _progress_queue = progress_queue
+
+
+def _run_job(job_id: str, job: Dict, cancel_event, scratch_settings: Dict):
+    """ Runs a single job inside a worker process, sending its status changes and progress dicts back through the progress queue.
+
+        cancel_event is set by the server to cancel the job, which also kills any external binary the job is running
+    """
+    scratch_space.configure(**scratch_settings)
+    token = CancellationToken(cancel_event)
+    _progress_queue.put((job_id, "running", None))
+    try:
+        with token.watching(), activated(token):
+            stream = cancellable(profiled(_operation_generator(job), job.get('vals') or {}), token)
+            while True:
+                try:
+                    msg = next(stream)
+                except StopIteration as stop:
+                    result = stop.value
+                    break
+                if msg.get("CONTROL") == "CANCELLED":
+                    _progress_queue.put((job_id, "cancelled", None))
+                    return
+                _progress_queue.put((job_id, "progress", msg))
+    except Exception as e:
+        token.cleanup()
+        _progress_queue.put((job_id, "failed", str(e)))
+        return
+    _progress_queue.put((job_id, "done", result))
+
+
+class BatchJob:
+    """ Server-side record of a job submitted in a batch """
+
+    def __init__(self, job_id: str, batch_id: str, operation: str):
+        self.job_id = job_id
+        self.batch_id = batch_id
+        self.operation = operation
+        self.status = "queued"
+        self.last_msg = None
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future: Future = None
+        self.cancel_event = None
+
+    def is_final(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "batch_id": self.batch_id,
+            "operation": self.operation,
+            "status": self.status,
+            "last_msg": self.last_msg,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class BatchManager:
+    """ Runs batches of create/split/modify/spritesheet jobs concurrently on a pool of worker processes.\n
+        Progress from every worker flows through a single bounded queue, drained by a background thread into a buffer per batch.
+        Each buffer holds up to BATCH_EVENT_BUFFER progress dicts: once a slow or absent client lets it fill up, the oldest progress dicts are dropped,
+        while status changes (running, done, failed, cancelled) are always kept
+    """
+
+    def __init__(self, workers: int = 0):
+        self.workers = workers or os.cpu_count() or 1
+        self.jobs: Dict[str, BatchJob] = {}
+        self.batches: Dict[str, List[str]] = {}
+        self._events: Dict[str, deque] = {}
+        self._dropped: Dict[str, int] = {}
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.RLock()
+        self._queue = None
+        self._sync = None
+        self._pool: ProcessPoolExecutor = None
+        self._pump_thread: threading.Thread = None
+
+    def _ensure_pool(self) -> ProcessPoolExecutor:
+        if not self._pool:
+            self._queue = self._context.Queue(maxsize=BATCH_EVENT_BUFFER)
+            self._sync = self._context.Manager()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context,
+                                             initializer=_init_worker, initargs=(self._queue,))
+            self._pump_thread = threading.Thread(target=self._pump_events, args=(self._queue,), daemon=True)
+            self._pump_thread.start()
+        return self._pool
+
+    def set_workers(self, workers: int):
+        """ Change the size of the worker pool. The pool is only restarted once it has no unfinished jobs """
+        workers = max(int(workers or 0), 0) or os.cpu_count() or 1
+        if workers == self.workers:
+            return
+        self.pump()
+        if any(not job.is_final() for job in self.jobs.values()):
+            raise Exception("Cannot resize the batch worker pool while jobs are still running!")
+        self.shutdown()
+        self.workers = workers
+
+    def submit(self, jobs: List[Dict]) -> Dict:
+        """ Queue a list of jobs as a new batch. Returns the batch ID and the ID of each job, in the order they were given """
+        if not jobs:
+            raise Exception("The batch does not contain any jobs!")
+        job_ids = [str(job.get('job_id') or uuid.uuid4().hex) for job in jobs]
+        with self._lock:
+            for job_id in job_ids:
+                if job_id in self.jobs or job_ids.count(job_id) > 1:
+                    raise Exception(f"A job with the ID {job_id} has already been submitted!")
+            pool = self._ensure_pool()
+            batch_id = uuid.uuid4().hex
+            self.batches[batch_id] = job_ids
+            self._events[batch_id] = deque()
+            self._dropped[batch_id] = 0
+            for job_id, job in zip(job_ids, jobs):
+                record = BatchJob(job_id, batch_id, job.get('operation'))
+                record.cancel_event = self._sync.Event()
+                self.jobs[job_id] = record
+                record.future = pool.submit(_run_job, job_id, job, record.cancel_event, scratch_space.settings())
+        return {"batch_id": batch_id, "job_ids": job_ids}
+
+    def _buffer_event(self, batch_id: str, event: Dict, is_progress: bool):
+        events = self._events.get(batch_id)
+        if events is None:
+            return
+        if is_progress and len(events) >= BATCH_EVENT_BUFFER:
+            oldest = next((index for index, (progress, _e) in enumerate(events) if progress), None)
+            if oldest is None:
+                return
+            del events[oldest]
+            self._dropped[batch_id] += 1
+        events.append((is_progress, event))
+
+    def _record_event(self, job_id: str, kind: str, payload):
+        job = self.jobs.get(job_id)
+        if not job or job.is_final():
+            return
+        if kind == "running":
+            job.status = "running"
+            job.started_at = time.time()
+            event = {"job_id": job_id, "status": "running"}
+        elif kind == "progress":
+            job.last_msg = payload
+            event = {"job_id": job_id, **payload}
+        elif kind == "done":
+            job.status = "done"
+            job.result = payload
+            job.finished_at = time.time()
+            event = {"job_id": job_id, "status": "done", "result": payload}
+        elif kind == "cancelled":
+            job.status = "cancelled"
+            job.finished_at = time.time()
+            event = {"job_id": job_id, "status": "cancelled"}
+        else:
+            job.status = "failed"
+            job.error = payload
+            job.finished_at = time.time()
+            event = {"job_id": job_id, "status": "failed", "error": payload}
+        self._buffer_event(job.batch_id, event, kind == "progress")
+
+    def _pump_events(self, progress_queue: multiprocessing.Queue):
+        """ Background thread moving the workers' events into the batch buffers, so that workers never block for long on a full queue """
+        while True:
+            try:
+                item = progress_queue.get(timeout=BATCH_POLL_INTERVAL * 4)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError, ValueError):
+                break
+            if item is None:
+                break
+            with self._lock:
+                self._record_event(*item)
+
+    def pump(self):
+        """ Fail the jobs whose worker died without reporting back """
+        with self._lock:
+            for job in self.jobs.values():
+                if not job.is_final() and job.future and job.future.done() and not job.future.cancelled() and job.future.exception():
+                    self._record_event(job.job_id, "failed", str(job.future.exception()))
+
+    def stream(self, batch_id: str, idle: Callable[[float], None] = time.sleep) -> Iterator[Dict]:
+        """ Yield the interleaved progress of every job in the batch, each dict tagged with its job_id, until all of them are finished.\n
+            idle is called between polls, so that a cooperative server can pass its own sleep function
+        """
+        if batch_id not in self.batches:
+            raise Exception(f"No batch with the ID {batch_id}")
+        job_ids = self.batches[batch_id]
+        while True:
+            self.pump()
+            with self._lock:
+                pending = [event for progress, event in self._events[batch_id]]
+                self._events[batch_id].clear()
+                finished = all(self.jobs[job_id].is_final() for job_id in job_ids)
+            yield from pending
+            if finished:
+                break
+            idle(BATCH_POLL_INTERVAL)
+        yield {"CONTROL": "BATCH_FINISH", "batch_id": batch_id}
+
+    def cancel_job(self, job_id: str) -> Dict:
+        """ Cancel a job. A queued job is dropped right away, while a running one is stopped at its next frame and its external binaries killed """
+        with self._lock:
+            if job_id not in self.jobs:
+                raise Exception(f"No job with the ID {job_id}")
+            job = self.jobs[job_id]
+            if not job.is_final():
+                job.cancel_event.set()
+                if job.future.cancel():
+                    self._record_event(job_id, "cancelled", None)
+            return job.to_dict()
+
+    def cancel_batch(self, batch_id: str) -> Dict:
+        if batch_id not in self.batches:
+            raise Exception(f"No batch with the ID {batch_id}")
+        for job_id in self.batches[batch_id]:
+            self.cancel_job(job_id)
+        return self.batch_status(batch_id)
+
+    def job_status(self, job_id: str) -> Dict:
+        self.pump()
+        with self._lock:
+            if job_id not in self.jobs:
+                raise Exception(f"No job with the ID {job_id}")
+            return self.jobs[job_id].to_dict()
+
+    def job_result(self, job_id: str):
+        """ Returns the return value of a finished job's operation, such as the output path or the list of split frame paths """
+        status = self.job_status(job_id)
+        if status["status"] == "failed":
+            raise Exception(f"Job {job_id} failed: {status['error']}")
+        elif status["status"] != "done":
+            raise Exception(f"Job {job_id} is {status['status']}")
+        return self.jobs[job_id].result
+
+    def batch_status(self, batch_id: str) -> Dict:
+        self.pump()
+        with self._lock:
+            if batch_id not in self.batches:
+                raise Exception(f"No batch with the ID {batch_id}")
+            jobs = [self.jobs[job_id].to_dict() for job_id in self.batches[batch_id]]
+            dropped = self._dropped[batch_id]
+        counts = {}
+        for job in jobs:
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"batch_id": batch_id, "counts": counts, "dropped_progress": dropped, "jobs": jobs}
+
+    def forget_batch(self, batch_id: str):
+        """ Drop the records of a finished batch, so that long-running servers do not keep every job's result around """
+        self.pump()
+        with self._lock:
+            job_ids = self.batches.get(batch_id, [])
+            if any(not self.jobs[job_id].is_final() for job_id in job_ids):
+                raise Exception(f"Batch {batch_id} still has unfinished jobs!")
+            for job_id in job_ids:
+                del self.jobs[job_id]
+            self.batches.pop(batch_id, None)
+            self._events.pop(batch_id, None)
+            self._dropped.pop(batch_id, None)
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=True)
+            self._queue.put(None)
+            self._pump_thread.join()
+            self._sync.shutdown()
+            self._pool = None
+            self._queue = None
+            self._sync = None
+            self._pump_thread = None
@@ -1,2 +1,10 @@
-from . import arg_builder
-from . import imager_api
+import importlib
+
+# imager_api needs Pillow and numpy, so the submodules are only imported on first access
+_SUBMODULES = ('arg_builder', 'imager_api')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
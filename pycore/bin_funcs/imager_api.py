@@ -1,45 +1,64 @@
 import os
+import shlex
 import shutil
-import subprocess
-from subprocess import PIPE
-from typing import List, Tuple
+from typing import List, Tuple, Iterator
 
+import numpy as np
 from PIL import Image
 from apng import APNG
 
-from ..core_funcs.utility import _mk_temp_dir, imager_exec_path, shout_indices
+from ..core_funcs.config import PNGQUANT_BATCH_SIZE
+from ..core_funcs.utility import _mk_temp_dir, _unoptimize_gif, imager_exec_path, shout_indices, imap_ordered
+from ..core_funcs.cancellation import checkpoint
+from ..core_funcs.process_runner import run_process, stream_process
+from ..core_funcs.instrumentation import stage
+from ..core_funcs.scratch import scratch_space
+from ..core_funcs.imager_backends import imager_backends
 
 
-def gifsicle_render(sicle_args: List[Tuple[str, str]], target_path: str, out_full_path: str, total_ops: int) -> str:
+def gifsicle_render(sicle_args: List[Tuple[str, str]], target_path: str, out_full_path: str, total_ops: int, shift_index=0) -> str:
     yield {"sicle_args": sicle_args}
     gifsicle_path = imager_exec_path('gifsicle')
     for index, (arg, description) in enumerate(sicle_args, start=1):
         yield {"msg": f"index {index}, arg {arg}, description: {description}"}
-        cmdlist = [gifsicle_path, arg, f'"{target_path}"', "--output", f'"{out_full_path}"']
-        cmd = ' '.join(cmdlist)
-        yield {"msg": f"[{index}/{total_ops}] {description}"}
-        yield {"cmd": cmd}
-        subprocess.run(cmd, shell=True)
+        cmdlist = [gifsicle_path, arg, target_path, "--output", out_full_path]
+        yield {"msg": f"[{shift_index + index}/{total_ops}] {description}"}
+        yield {"cmd": " ".join(map(shlex.quote, cmdlist))}
+        run_process(cmdlist)
         if target_path != out_full_path:
             target_path = out_full_path
     return target_path
 
 
+@imager_backends.backend("optimize_gif", "gifsicle", binary="gifsicle")
+def gifsicle_pipe(sicle_args: List[Tuple[str, str]], gif_bytes: bytes, out_full_path: str) -> str:
+    """ Stream an in-memory GIF into gifsicle through stdin, applying all of the arguments in one pass. Returns the output path """
+    gifsicle_path = imager_exec_path('gifsicle')
+    cmdlist = [gifsicle_path, *[arg for arg, description in sicle_args], "-", "--output", out_full_path]
+    for arg, description in sicle_args:
+        yield {"msg": description}
+    yield {"cmd": " ".join(map(shlex.quote, cmdlist))}
+    result = run_process(cmdlist, input=gif_bytes)
+    if result.returncode != 0:
+        raise Exception(f"gifsicle failed: {result.stderr.decode('utf-8')}")
+    return out_full_path
+
+
 def imagemagick_render(magick_args: List[Tuple[str, str]], target_path: str, out_full_path: str, total_ops=0, shift_index=0) -> str:
     yield {"magick_args": magick_args}
     imagemagick_path = imager_exec_path('imagemagick')
     for index, (arg, description) in enumerate(magick_args, start=1):
         yield {"msg": f"index {index}, arg {arg}, description: {description}"}
-        cmdlist = [imagemagick_path, arg, f'"{target_path}"', "--output", f'"{out_full_path}"']
-        cmd = ' '.join(cmdlist)
+        cmdlist = [imagemagick_path, target_path, arg, out_full_path]
         yield {"msg": f"[{shift_index + index}/{total_ops}] {description}"}
-        yield {"cmd": cmd}
-        subprocess.run(cmd, shell=True)
+        yield {"cmd": " ".join(map(shlex.quote, cmdlist))}
+        run_process(cmdlist)
         if target_path != out_full_path:
             target_path = out_full_path
     return target_path
 
 
+@imager_backends.backend("optimize_apng", "apngopt", binary="apngopt")
 def apngopt_render(aopt_args, target_path: str, out_full_path: str, total_ops=0, shift_index=0):
     """ Use apngopt to optimize an APNG. Returns the output path """
     yield {"aopt_args": aopt_args}
@@ -52,26 +71,17 @@ def apngopt_render(aopt_args, target_path: str, out_full_path: str, total_ops=0,
     target_rel_path = os.path.relpath(target_path, cwd)
     for index, (arg, description) in enumerate(aopt_args, start=1):
         yield {"msg": f"index {index}, arg {arg}, description: {description}"}
-        cmdlist = [opt_exec_path, arg, f'"{target_rel_path}"', f'"{target_rel_path}"']
+        cmdlist = [opt_exec_path, arg, target_rel_path, target_rel_path]
         # raise Exception(cmdlist, out_full_path)
-        cmd = ' '.join(cmdlist)
         yield {"msg": f"[{shift_index + index}/{total_ops}] {description}"}
-        yield {"cmd": cmd}
-        # result = subprocess.check_output(cmd, shell=True)
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        index = 0
-        while True:
-            output = process.stdout.readline()
-            if process.poll() is not None:
-                break
-            if output:
-                yield {"STDOUT": output.decode('utf-8')}
-            index += 1
+        yield {"cmd": " ".join(map(shlex.quote, cmdlist))}
+        for stream_name, line in stream_process(cmdlist):
+            yield {"STDOUT": line}
         # if target_path != out_full_path:
             # target_path = out_full_path
     x = shutil.move(target_path, out_full_path)
     yield {"X": x}
-    # shutil.rmtree(aopt_dir)
+    scratch_space.release(aopt_dir)
     return out_full_path
 
 
@@ -86,56 +96,90 @@ def apngdis_split(target_path: str, seq_rename="", out_dir=""):
     args = [dis_exec_path, target_path]
     if seq_rename:
         args.append(seq_rename)
-    cmd = ' '.join(args)
-    yield {"ARGS": cmd}
+    yield {"ARGS": " ".join(map(shlex.quote, args))}
     fcount = len(APNG.open(target_path).frames)
     yield {"fcount": fcount}
     shout_nums = shout_indices(fcount, 5)
     yield {"shout_nums": shout_nums}
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    index = 0
-    while True:
-        output = process.stdout.readline()
-        yield {"STDOUT": output.decode('utf-8')}
-        # err = process.stderr.readline()
-        if process.poll() is not None:
-            break
-        if output and shout_nums.get(index):
+    for index, (stream_name, line) in enumerate(stream_process(args)):
+        yield {"STDOUT": line}
+        if shout_nums.get(index):
             yield {"msg": f'Extracting frames... ({shout_nums.get(index)})'}
-        # if err:
-        #     yield {"apngdis stderr": err.decode('utf-8')}
-        index += 1
-            # yield {"msg": output.decode('utf-8')}
-    # for line in iter(process.stdout.readline(), b''):
-    #     yield {"msg": line.decode('utf-8')}
     fragment_paths = (os.path.abspath(os.path.join(split_dir, f)) for f in os.listdir(split_dir) 
                         if f != filename and os.path.splitext(f)[1] == '.png')
     return fragment_paths
     # Remove generated text file and copied APNG file
 
 
-def pngquant_render(pq_args, image_paths: List[str], optional_out_path=""):
-    """ Perform PNG quantization on a list of PIL.Image.Images using PNGQuant. Returns a generator of image paths """
-    quantized_frames = []
-    yield {"pmgquant_args": pq_args}
-    pngquant_exec = imager_exec_path("pngquant")
-    # quant_dir = _mk_temp_dir(prefix_name="quant_dir")
-    shout_nums = shout_indices(len(image_paths), 5)
-    for index, ipath in enumerate(image_paths):
-        if optional_out_path:
-            target_path = os.path.join(optional_out_path, os.path.basename(ipath))
-        else:
-            target_path = ipath
-        if shout_nums.get(index):
-            yield {"msg": f'Quantizing PNG... ({shout_nums.get(index)})'}
-
-        args = [pngquant_exec, ' '.join([arg[0] for arg in pq_args]), f'"{ipath}"', "--force", "--output", f'"{target_path}"']
-        cmd = ' '.join(args)
-        # yield {"cmd": cmd}
-        result = subprocess.check_output(cmd, shell=True)
+@imager_backends.backend("quantize_png", "pngquant", binary="pngquant")
+def pngquant_batch(pq_args, image_paths: List[str], keep_palette=False) -> List[str]:
+    """ Quantize a batch of PNG files in place with a single PNGQuant invocation. Unless keep_palette is set, the quantized palette PNGs are converted back to RGBA. Returns the paths """
+    args = [imager_exec_path("pngquant"), *[arg for arg, description in pq_args], "--force", "--ext", ".png", *image_paths]
+    run_process(args, check=True)
+    if not keep_palette:
         # Convert back to RGBA image
-        with Image.open(target_path).convert("RGBA") as rgba_im:
-            rgba_im.save(target_path)
-        quantized_frames.append(target_path)
-    # yield {"ssdsdsssdsd": quantized_frames}
-    return quantized_frames
+        for path in image_paths:
+            with stage("encode", "png"), Image.open(path) as quant_im:
+                quant_im.convert("RGBA").save(path)
+    return image_paths
+
+
+def _clear_transparent(im: Image.Image) -> Image.Image:
+    """ Zero out the color of fully transparent pixels, the way the in-process decoders leave them """
+    with stage("transform", "rgba"):
+        pixels = np.array(im.convert("RGBA"))
+        pixels[pixels[..., 3] == 0] = 0
+        return Image.fromarray(pixels, "RGBA")
+
+
+@imager_backends.backend("coalesce_gif", "gifsicle", binary="gifsicle")
+def gifsicle_coalesce(gif_path: str) -> Iterator[Image.Image]:
+    """ Unoptimize a GIF with gifsicle, and then yield its full frames as RGBA PIL.Image.Images """
+    unopt_dir = _mk_temp_dir(prefix_name="gifsicle_unopt")
+    try:
+        unopt_path = _unoptimize_gif(gif_path, unopt_dir, 'gifsicle')
+        with Image.open(unopt_path) as gif:
+            for index in range(gif.n_frames):
+                with stage("decode", "gif"):
+                    gif.seek(index)
+                    frame = _clear_transparent(gif)
+                yield frame
+    finally:
+        scratch_space.release(unopt_dir)
+
+
+@imager_backends.backend("coalesce_apng", "apngdis", binary="apngdis")
+def apngdis_coalesce(apng_path: str) -> Iterator[Image.Image]:
+    """ Extract the full frames of an APNG with apngdis, and then yield them as RGBA PIL.Image.Images """
+    split_dir = _mk_temp_dir(prefix_name="apngdis_dir")
+    try:
+        filename = os.path.basename(apng_path)
+        target_path = shutil.copyfile(apng_path, os.path.join(split_dir, filename))
+        run_process([imager_exec_path('apngdis'), target_path], check=True)
+        fragment_paths = sorted(os.path.join(split_dir, f) for f in os.listdir(split_dir) if f != filename and os.path.splitext(f)[1] == '.png')
+        for path in fragment_paths:
+            with stage("decode", "png"), Image.open(path) as fragment:
+                frame = _clear_transparent(fragment)
+            yield frame
+    finally:
+        scratch_space.release(split_dir)
+
+
+def pngquant_render(pq_args, image_paths: List[str], optional_out_path="", keep_palette=False, workers: int = 0, batch_size: int = PNGQUANT_BATCH_SIZE):
+    """ Perform PNG quantization on a list of PNG paths using PNGQuant. Returns a list of the quantized image paths.\n
+        The files are quantized in place (or inside optional_out_path) in batches of batch_size files per pngquant invocation, with up to
+        workers invocations running at once (defaults to the CPU count). Unless keep_palette is set, the quantized palette PNGs are converted back to RGBA
+    """
+    yield {"pngquant_args": pq_args}
+    if optional_out_path:
+        target_paths = [shutil.copyfile(ipath, os.path.join(optional_out_path, os.path.basename(ipath))) for ipath in image_paths]
+    else:
+        target_paths = list(image_paths)
+    batches = [target_paths[i:i + batch_size] for i in range(0, len(target_paths), batch_size)]
+
+    quantized_count = 0
+    for batch in imap_ordered(lambda batch: pngquant_batch(pq_args, batch, keep_palette), batches, workers or os.cpu_count() or 1):
+        checkpoint()
+        quantized_count += len(batch)
+        yield {"msg": f'Quantizing PNG... ({round(quantized_count / len(target_paths) * 100)}%)'}
+    return target_paths
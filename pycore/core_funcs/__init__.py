@@ -1,3 +1,10 @@
-from . import config
-from . import criterion
-from . import utility
+import importlib
+
+# Submodules are only imported on first access, so that importing a light one does not pull in Pillow and numpy through the others
+_SUBMODULES = ('config', 'criterion', 'utility', 'gif_reader', 'gif_writer', 'inspect_cache', 'png_reader', 'cancellation', 'instrumentation', 'scratch', 'atlas_packer', 'imager_backends', 'process_runner', 'warmup', 'preview_cache', 'stage_cache')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,108 @@
+import math
+from typing import List, Tuple, Optional
+
+from .config import ATLAS_MAX_SIZE
+
+
+def _next_power_of_two(value: int) -> int:
+    return 1 << max(value - 1, 0).bit_length()
+
+
+class MaxRectsPacker:
+    """ Packs rectangles into a fixed-size bin with the MaxRects algorithm, using the Best Short Side Fit heuristic and no rotation.\n
+        The free space is tracked as the list of maximal free rectangles, which may overlap each other
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.free_rects: List[Tuple[int, int, int, int]] = [(0, 0, width, height)]
+
+    def insert(self, width: int, height: int) -> Optional[Tuple[int, int]]:
+        """ Place a rectangle, returning its top-left position, or None if it doesn't fit anywhere """
+        best = None
+        best_fit = None
+        for free_x, free_y, free_width, free_height in self.free_rects:
+            if width <= free_width and height <= free_height:
+                leftover_x, leftover_y = free_width - width, free_height - height
+                fit = (min(leftover_x, leftover_y), max(leftover_x, leftover_y))
+                if best_fit is None or fit < best_fit:
+                    best, best_fit = (free_x, free_y), fit
+        if best:
+            self._split_free_rects((*best, width, height))
+        return best
+
+    def _split_free_rects(self, used: Tuple[int, int, int, int]):
+        used_x, used_y, used_width, used_height = used
+        used_right, used_bottom = used_x + used_width, used_y + used_height
+        kept_rects = []
+        split_rects = []
+        for free in self.free_rects:
+            free_x, free_y, free_width, free_height = free
+            free_right, free_bottom = free_x + free_width, free_y + free_height
+            if used_x >= free_right or used_right <= free_x or used_y >= free_bottom or used_bottom <= free_y:
+                kept_rects.append(free)
+                continue
+            # Keep the parts of the free rectangle on each of the four sides of the used one
+            if used_x > free_x:
+                split_rects.append((free_x, free_y, used_x - free_x, free_height))
+            if used_right < free_right:
+                split_rects.append((used_right, free_y, free_right - used_right, free_height))
+            if used_y > free_y:
+                split_rects.append((free_x, free_y, free_width, used_y - free_y))
+            if used_bottom < free_bottom:
+                split_rects.append((free_x, used_bottom, free_width, free_bottom - used_bottom))
+        # The untouched rectangles are still maximal among themselves, so only the split ones need to be checked against the rest
+        split_rects = list(dict.fromkeys(split_rects))
+        split_rects = [rect for rect in split_rects if not any(other != rect and _contains(other, rect) for other in split_rects)
+                       and not any(_contains(other, rect) for other in kept_rects)]
+        kept_rects = [rect for rect in kept_rects if not any(_contains(other, rect) for other in split_rects)]
+        self.free_rects = kept_rects + split_rects
+
+
+def _contains(outer: Tuple[int, int, int, int], inner: Tuple[int, int, int, int]) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[0] + outer[2] >= inner[0] + inner[2] and outer[1] + outer[3] >= inner[1] + inner[3]
+
+def _try_pack(sizes: List[Tuple[int, int]], order: List[int], width: int, height: int) -> Optional[List[Tuple[int, int]]]:
+    packer = MaxRectsPacker(width, height)
+    positions = [None] * len(sizes)
+    for index in order:
+        position = packer.insert(*sizes[index])
+        if position is None:
+            return None
+        positions[index] = position
+    return positions
+
+
+def pack_rects(sizes: List[Tuple[int, int]], padding_x: int = 0, padding_y: int = 0, margin_x: int = 0, margin_y: int = 0,
+               power_of_two: bool = False) -> Tuple[int, int, List[Tuple[int, int]]]:
+    """ Pack rectangles of the given (width, height) into the smallest atlas found, keeping padding_x/padding_y pixels between them and margin_x/margin_y pixels left empty at the top-left.\n
+        Starts from a square as large as the total area and grows its shorter side until everything fits. Returns the atlas width and height,
+        and the top-left position of every rectangle in the order they were given
+    """
+    if not sizes:
+        return margin_x, margin_y, []
+    # Each rectangle reserves its padding on the right and bottom, the bin gets the same extra room so that the last ones don't need it
+    padded = [(width + padding_x, height + padding_y) for width, height in sizes]
+    order = sorted(range(len(sizes)), key=lambda index: (max(padded[index]), min(padded[index])), reverse=True)
+    side = math.ceil(math.sqrt(sum(width * height for width, height in padded)))
+    width = max(side, max(size[0] for size in sizes)) + margin_x
+    height = max(side, max(size[1] for size in sizes)) + margin_y
+    while True:
+        if power_of_two:
+            width, height = _next_power_of_two(width), _next_power_of_two(height)
+        if width > ATLAS_MAX_SIZE or height > ATLAS_MAX_SIZE:
+            raise Exception(f"The frames do not fit into a {ATLAS_MAX_SIZE}x{ATLAS_MAX_SIZE} atlas!")
+        positions = _try_pack(padded, order, width - margin_x + padding_x, height - margin_y + padding_y)
+        if positions:
+            break
+        if width <= height:
+            width = width * 2 if power_of_two else width + max(width // 8, 1)
+        else:
+            height = height * 2 if power_of_two else height + max(height // 8, 1)
+    positions = [(x + margin_x, y + margin_y) for x, y in positions]
+    used_width = max(x + size[0] for (x, y), size in zip(positions, padded)) - padding_x
+    used_height = max(y + size[1] for (x, y), size in zip(positions, padded)) - padding_y
+    if power_of_two:
+        return _next_power_of_two(used_width), _next_power_of_two(used_height), positions
+    return used_width, used_height, positions
@@ -0,0 +1,166 @@
+import os
+import shutil
+import signal
+import platform
+import threading
+import subprocess
+from contextlib import contextmanager
+from typing import Dict
+
+
+class OperationCancelled(Exception):
+    """ Raised at a checkpoint once the token of the running operation has been cancelled """
+
+
+class CancellationToken:
+    """ Cancellation flag of a single operation, along with the child processes and temp dirs it has spawned so far.\n
+        The flag is a threading.Event by default, but any object with set/is_set/wait can be passed in, such as a multiprocessing Event proxy
+    """
+
+    def __init__(self, event=None):
+        self._event = event or threading.Event()
+        self._lock = threading.Lock()
+        self._processes = set()
+        self.temp_dirs = []
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        self.kill_processes()
+
+    def check(self):
+        if self.is_cancelled:
+            raise OperationCancelled("The operation has been cancelled")
+
+    def track_process(self, process):
+        with self._lock:
+            self._processes.add(process)
+        if self.is_cancelled:
+            _kill_process_tree(process)
+
+    def untrack_process(self, process):
+        with self._lock:
+            self._processes.discard(process)
+
+    def track_temp_dir(self, temp_dir: str):
+        with self._lock:
+            self.temp_dirs.append(temp_dir)
+
+    def kill_processes(self):
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            _kill_process_tree(process)
+
+    def cleanup(self):
+        """ Kill every child process that is still running and remove the temp dirs made by the operation """
+        self.kill_processes()
+        with self._lock:
+            temp_dirs, self.temp_dirs = self.temp_dirs, []
+        for temp_dir in temp_dirs:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @contextmanager
+    def watching(self, interval: float = 0.2):
+        """ While the body runs, a daemon thread kills the tracked child processes as soon as the token is cancelled from elsewhere.
+            Needed when the flag is set by another process, since cancel() is never called on this side
+        """
+        stop = threading.Event()
+
+        def _watch():
+            while not stop.is_set():
+                try:
+                    if self._event.wait(interval):
+                        self.kill_processes()
+                        break
+                except (EOFError, OSError):
+                    break
+
+        watcher = threading.Thread(target=_watch, daemon=True)
+        watcher.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            watcher.join()
+
+
+def _kill_process_tree(process):
+    """ Kill a child process along with every process it launched """
+    if process.poll() is not None:
+        return
+    try:
+        if platform.system() == 'Windows':
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], capture_output=True)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.kill()
+
+
+_local = threading.local()
+
+
+def active_token() -> CancellationToken:
+    return getattr(_local, "token", None)
+
+
+@contextmanager
+def activated(token: CancellationToken):
+    """ Make token the active one of the current thread while running the body, so that checkpoints, processes and temp dirs are tied to it """
+    previous = active_token()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+def checkpoint():
+    """ Raise OperationCancelled if the active operation has been cancelled. Called between frames """
+    token = active_token()
+    if token:
+        token.check()
+
+
+def _popen_kwargs() -> Dict:
+    # A new process group/session lets the whole tree be killed, including anything the binary launches itself
+    if platform.system() == 'Windows':
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+
+def cancellable(operation, token: CancellationToken):
+    """ Drive an operation generator with token active during each of its steps, checking for cancellation in between.\n
+        A cancelled operation is closed, its child processes killed and temp dirs removed, and a CANCELLED control message is yielded.
+        If the consumer goes away mid-stream, the operation is cancelled the same way. The temp dirs are also removed once the operation finishes or fails
+    """
+    try:
+        while True:
+            with activated(token):
+                token.check()
+                try:
+                    msg = next(operation)
+                except StopIteration as stop:
+                    token.cleanup()
+                    return stop.value
+            yield msg
+    except OperationCancelled:
+        with activated(token):
+            operation.close()
+        token.cleanup()
+        yield {"CONTROL": "CANCELLED"}
+    except GeneratorExit:
+        token.cancel()
+        with activated(token):
+            operation.close()
+        token.cleanup()
+        raise
+    except Exception:
+        with activated(token):
+            operation.close()
+        token.cleanup()
+        raise
@@ -11,9 +11,60 @@ ANIMATED_IMG_EXTS = ['gif', 'png']
 
 CACHE_DIRNAME = 'cache'
 TEMP_DIRNAME = 'temp'
+SCRATCH_DIRNAME = 'scratch'
+
+GIF_ALPHA_THRESHOLD = 128
+GIF_PALETTE_SAMPLE_PIXELS = 1024 * 1024
+# Upper bound of the decoded bytes of a band of tile rows held in memory while slicing a spritesheet
+SPRITESHEET_BAND_BYTES = 32 * 1024 * 1024
+# Largest width/height of a packed sprite atlas
+ATLAS_MAX_SIZE = 16384
+# Largest frame delays the formats can hold, in centiseconds for GIF and milliseconds for APNG
+GIF_MAX_DELAY = 65535
+APNG_MAX_DELAY = 65535
 
 BIN_DIRNAME = 'bin'
 
+INSPECT_CACHE_FILENAME = 'inspect_cache.sqlite3'
+INSPECT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Cache hits whose access times are held in memory before being written to the inspection cache together
+INSPECT_CACHE_ACCESS_BATCH = 256
+PREVIEW_CACHE_DIRNAME = 'previews'
+PREVIEW_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Seconds during which a cached file handed out by get/put is never evicted, so that the caller has time to read it
+PREVIEW_CACHE_PIN_SECONDS = 30
+# Longest side and frame count of the proxies that modification previews are rendered from
+PREVIEW_MAX_SIZE = 480
+PREVIEW_MAX_FRAMES = 60
+# Intermediate files of the modify pipeline
+STAGE_CACHE_DIRNAME = 'stages'
+STAGE_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+
+BATCH_POLL_INTERVAL = 0.05
+BATCH_EVENT_BUFFER = 1000
+SCRATCH_MAX_BYTES = 2 * 1024 * 1024 * 1024
+SCRATCH_USE_TMPFS = False
+SCRATCH_TMPFS_PATH = '/dev/shm'
+
+TIMING_HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+IMAGER_PROBE_TIMEOUT = 5
+# Modules registering imaging backends, relative to the pycore package
+IMAGER_BACKEND_MODULES = ['.bin_funcs.imager_api', '.split_ops']
+# Weight of the newest timing in the running average of a backend's speed
+IMAGER_TIMING_WEIGHT = 0.3
+# (width, height, frames) of the synthetic jobs timed by the imager benchmark
+IMAGER_BENCHMARK_SIZES = ((64, 64, 8), (256, 256, 16), (640, 480, 32))
+# Seconds an external binary may run before it gets killed
+EXTERNAL_PROCESS_TIMEOUT = 30 * 60
+# Seconds between the checks of a thread that waits on processes cooperatively, see ProcessRunner.set_idle
+PROCESS_POLL_INTERVAL = 0.05
+# Frames handed to every pngquant invocation
+PNGQUANT_BATCH_SIZE = 16
+# Modules imported by the engine warm-up right after the RPC server is bound, relative to the pycore package
+WARMUP_MODULES = ['PIL.Image', 'numpy', 'apng', '.core_funcs.utility', '.inspect_ops', '.create_ops', '.split_ops', '.sprite_ops', '.modify_ops']
+WARMUP_POLL_INTERVAL = 0.05
+
 
 def _bin_dirpath():
     if platform.system() == 'Windows':
@@ -36,22 +87,3 @@ def ABS_CACHE_PATH():
 
 def ABS_TEMP_PATH():
     return os.path.abspath(TEMP_DIRNAME)
-
-
-def imager_exec_path(binname: str) -> str:
-    """ Get the path to the internal image processing binaries\n
-        Supported binname params: ['gifsicle', 'imagemagick', 'apngasm', 'apngopt', 'apngdis', 'pngquant']
-    """
-    if platform.system() == 'Windows':
-        path = imager_confile()['win'][binname]
-        # return os.path.abspath("./bin/gifsicle-1.92-win64/gifsicle.exe")
-    elif platform.system() == 'Linux':
-        path = imager_confile()['linux'][binname]
-        # return os.path.abspath("./bin/gifsicle-1.92-2+b1_amd64/gifsicle")
-    else:
-        raise Exception(f"TridentFrame does not have the engine for processing images on this platform! {platform.system()}")
-    path = f"\"{os.path.abspath(os.path.join(_bin_dirpath(), path))}\""
-    # Escape apostrophes
-    # path = path.replace("'", "''")
-    # path = f".'{path}'"
-    return path
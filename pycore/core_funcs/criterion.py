@@ -1,4 +1,6 @@
-from os import path
+from os import path, cpu_count
+
+from .config import GIF_ALPHA_THRESHOLD, PREVIEW_MAX_SIZE, PREVIEW_MAX_FRAMES
 
 class CreationCriteria:
     """ Contains all of the criterias for Creating an animated image """
@@ -18,6 +20,13 @@ class CreationCriteria:
         self.start_frame = (int(vals['start_frame'] or 0) or 1)
         self.start_frame = self.start_frame - 1 if self.start_frame >= 0 else self.start_frame
         self.rotation = int(vals['rotation'] or 0)
+        self.workers = max(int(vals.get('workers') or 1), 1)
+        # Pixels with an alpha at or below this become fully transparent in GIF frames. 0 only drops fully transparent pixels
+        self.alpha_threshold = GIF_ALPHA_THRESHOLD if vals.get('alpha_threshold') is None else min(max(int(vals['alpha_threshold']), 0), 255)
+        # Map every frame onto one palette built from all of them, instead of quantizing each frame on its own
+        self.global_palette: bool = bool(vals.get('global_palette'))
+        # Merge runs of identical consecutive frames into one frame that lasts as long as the whole run
+        self.merge_identical: bool = bool(vals.get('merge_identical'))
     
     # def transform(self, resize_width, resize_height, flip_h, flip_v):
     #     try:
@@ -44,6 +53,8 @@ class SplitCriteria:
         self.is_duration_sensitive: bool = json_vals['is_duration_sensitive']
         self.is_unoptimized: bool = json_vals['is_unoptimized']
         self.will_generate_delay_info: bool = json_vals['will_generate_delay_info']
+        # Save runs of identical frames once and report them, instead of writing every duplicate
+        self.will_report_runs: bool = bool(json_vals.get('report_runs'))
 
 
 class ModificationCriteria:
@@ -74,6 +85,10 @@ class ModificationCriteria:
         self.flip_y: bool = json_vals.get('flip_y')
         self.is_reversed = json_vals['is_reversed']
         self.preserve_alpha = json_vals['preserve_alpha']
+        self.workers = max(int(json_vals.get('workers') or 1), 1)
+        self.alpha_threshold = json_vals.get('alpha_threshold')
+        self.global_palette = json_vals.get('global_palette')
+        self.merge_identical = json_vals.get('merge_identical')
 
         # self.is_optimized = json_vals['is_optimized']
         # self.optimization_level = json_vals['optimization_level']
@@ -138,6 +153,9 @@ class SpritesheetBuildCriteria:
         self.padding_x: int = int(vals.get('padding_x') or 0)
         self.padding_y: int = int(vals.get('padding_y') or 0)
         self.preserve_alpha: bool = vals['preserve_alpha']
+        # 'grid' places every frame in a fixed-size cell, 'atlas' packs the trimmed frames as tightly as possible and describes them in a JSON file
+        self.layout: str = vals.get('layout') or 'grid'
+        self.power_of_two: bool = bool(vals.get('power_of_two'))
 
 
 class SpritesheetSliceCriteria:
@@ -153,6 +171,17 @@ class SpritesheetSliceCriteria:
         self.padding_x: int = int(vals.get('padding_x') or 0)
         self.padding_y: int = int(vals.get('padding_y') or 0)
         self.is_edge_alpha: bool = vals.get('is_edge_alpha')
+        self.workers = max(int(vals.get('workers') or cpu_count() or 1), 1)
+        # Don't write tiles whose pixels are all fully transparent
+        self.skip_transparent: bool = bool(vals.get('skip_transparent'))
+
+
+class PreviewCriteria:
+    """ Size limits of the low-resolution proxy that a modification preview is rendered from """
+
+    def __init__(self, vals):
+        self.max_size: int = max(int(vals.get('preview_max_size') or PREVIEW_MAX_SIZE), 1)
+        self.max_frames: int = max(int(vals.get('preview_max_frames') or PREVIEW_MAX_FRAMES), 1)
 
 
 class GIFOptimizationCriteria:
@@ -192,3 +221,4 @@ class CriteriaBundle:
         self.slice_spr: SpritesheetSliceCriteria = vals.get('slice_spr')
         self.gif_opt: GIFOptimizationCriteria = vals.get('gif_opt')
         self.apng_opt: APNGOptimizationCriteria = vals.get('apng_opt')
+        self.preview: PreviewCriteria = vals.get('preview')
@@ -0,0 +1,150 @@
+import struct
+from typing import List, Iterator
+
+
+GIF_TRAILER = 0x3B
+GIF_EXTENSION = 0x21
+GIF_IMAGE_DESCRIPTOR = 0x2C
+GIF_GCE_LABEL = 0xF9
+GIF_COMMENT_LABEL = 0xFE
+GIF_APPLICATION_LABEL = 0xFF
+
+
+class GIFFrameBlock:
+    """ Describes a single frame of a GIF as it is stored in the file, along with its Graphic Control Extension values """
+
+    def __init__(self):
+        self.left: int = 0
+        self.top: int = 0
+        self.width: int = 0
+        self.height: int = 0
+        self.packed: int = 0
+        self.local_color_table: bytes = b""
+        self.lzw_min_code_size: int = 0
+        self.image_data: bytes = b""
+        self.delay: int = 0
+        self.disposal: int = 0
+        self.transparency: int = None
+        self.comment: bytes = b""
+
+    def box(self):
+        return (self.left, self.top, self.left + self.width, self.top + self.height)
+
+    def standalone_bytes(self, global_color_table: bytes, gct_packed: int) -> bytes:
+        """ Wrap the frame into a minimal single-frame GIF located at (0, 0), so that it can be decoded on its own """
+        lsd_packed = gct_packed if not self.local_color_table else 0
+        out = [b"GIF89a", struct.pack("<HHBBB", self.width, self.height, lsd_packed, 0, 0)]
+        if lsd_packed:
+            out.append(global_color_table)
+        if self.transparency is not None:
+            out.append(struct.pack("<BBBBHBB", GIF_EXTENSION, GIF_GCE_LABEL, 4, 1, 0, self.transparency, 0))
+        out.append(struct.pack("<BHHHHB", GIF_IMAGE_DESCRIPTOR, 0, 0, self.width, self.height, self.packed))
+        out.append(self.local_color_table)
+        out.append(bytes([self.lzw_min_code_size]))
+        out.append(self.image_data)
+        out.append(bytes([GIF_TRAILER]))
+        return b"".join(out)
+
+
+class GIFBlocks:
+    """ The logical screen of a GIF and the list of its frame blocks """
+
+    def __init__(self):
+        self.version: str = ""
+        self.width: int = 0
+        self.height: int = 0
+        self.gct_packed: int = 0
+        self.global_color_table: bytes = b""
+        self.background_index: int = 0
+        self.loop: int = None
+        self.frames: List[GIFFrameBlock] = []
+
+
+def _color_table_size(packed: int) -> int:
+    return 3 * (2 ** ((packed & 0x07) + 1)) if packed & 0x80 else 0
+
+
+def _read_sub_blocks(buf: bytes, pos: int, keep=True):
+    """ Walk a chain of data sub-blocks starting at pos. Returns the raw chain (including its terminator) and the position after it """
+    start = pos
+    while pos < len(buf):
+        size = buf[pos]
+        pos += 1 + size
+        if size == 0:
+            break
+    return (buf[start:pos] if keep else b""), pos
+
+
+def _sub_block_payload(raw: bytes) -> bytes:
+    payload = []
+    pos = 0
+    while pos < len(raw) and raw[pos]:
+        size = raw[pos]
+        payload.append(raw[pos + 1:pos + 1 + size])
+        pos += 1 + size
+    return b"".join(payload)
+
+
+def read_gif_blocks(gif_path: str, keep_image_data=True) -> GIFBlocks:
+    """ Walk the blocks of a GIF file without decompressing any pixel data.\n
+        When keep_image_data is False, the LZW-compressed image data of each frame is skipped instead of kept
+    """
+    with open(gif_path, "rb") as gif_file:
+        return parse_gif_blocks(gif_file.read(), keep_image_data, gif_path)
+
+
+def parse_gif_blocks(buf: bytes, keep_image_data=True, source_name="GIF data") -> GIFBlocks:
+    """ Walk the blocks of an in-memory GIF without decompressing any pixel data """
+    if buf[:3] != b"GIF":
+        raise Exception(f"{source_name} is not a valid GIF image")
+    blocks = GIFBlocks()
+    blocks.version = buf[3:6].decode("ascii", errors="replace")
+    blocks.width, blocks.height, blocks.gct_packed, blocks.background_index, _aspect = struct.unpack_from("<HHBBB", buf, 6)
+    pos = 13
+    gct_size = _color_table_size(blocks.gct_packed)
+    blocks.global_color_table = buf[pos:pos + gct_size]
+    pos += gct_size
+    pending = GIFFrameBlock()
+    while pos < len(buf):
+        introducer = buf[pos]
+        pos += 1
+        if introducer == GIF_TRAILER:
+            break
+        elif introducer == GIF_EXTENSION:
+            label = buf[pos]
+            pos += 1
+            raw, pos = _read_sub_blocks(buf, pos)
+            payload = _sub_block_payload(raw)
+            if label == GIF_GCE_LABEL and len(payload) >= 4:
+                packed, delay, transparency = struct.unpack_from("<BHB", payload)
+                pending.disposal = (packed >> 2) & 0x07
+                pending.delay = delay
+                pending.transparency = transparency if packed & 0x01 else None
+            elif label == GIF_APPLICATION_LABEL and payload[:11] in (b"NETSCAPE2.0", b"ANIMEXTS1.0") and len(payload) >= 14:
+                blocks.loop = struct.unpack_from("<H", payload, 12)[0]
+            elif label == GIF_COMMENT_LABEL:
+                pending.comment = b"\n".join(filter(None, [pending.comment, payload]))
+        elif introducer == GIF_IMAGE_DESCRIPTOR:
+            frame = pending
+            frame.left, frame.top, frame.width, frame.height, frame.packed = struct.unpack_from("<HHHHB", buf, pos)
+            pos += 9
+            lct_size = _color_table_size(frame.packed)
+            frame.local_color_table = buf[pos:pos + lct_size]
+            pos += lct_size
+            frame.lzw_min_code_size = buf[pos]
+            pos += 1
+            frame.image_data, pos = _read_sub_blocks(buf, pos, keep=keep_image_data)
+            blocks.frames.append(frame)
+            pending = GIFFrameBlock()
+        else:
+            # Garbage after the last frame, treat it like a trailer
+            break
+    if not blocks.frames:
+        raise Exception(f"{source_name} does not contain any frames")
+    return blocks
+
+
+def iter_gif_delays(gif_path: str) -> Iterator[int]:
+    """ Yields the delay of every frame of a GIF in milliseconds """
+    for frame in read_gif_blocks(gif_path, keep_image_data=False).frames:
+        yield frame.delay * 10
@@ -0,0 +1,70 @@
+import io
+import struct
+from typing import List
+
+from PIL import Image
+
+from .gif_reader import parse_gif_blocks, GIF_EXTENSION, GIF_GCE_LABEL, GIF_APPLICATION_LABEL, GIF_IMAGE_DESCRIPTOR, GIF_TRAILER
+
+
+class GIFAssembler:
+    """ Assembles an animated GIF in memory out of palettized PIL.Image.Images.\n
+        Each frame is LZW-encoded once by Pillow as a single-frame GIF, and its blocks are spliced into the animation with its palette kept as a local color table.
+        With share_color_table, the first frame's palette becomes the global color table, and later frames with the same palette are written without a local one
+    """
+
+    def __init__(self, loop_count: int = 0, disposal: int = 2, share_color_table: bool = False):
+        self.loop_count = loop_count
+        self.disposal = disposal
+        self.share_color_table = share_color_table
+        self.global_color_table = b""
+        self.width = 0
+        self.height = 0
+        self.frame_blocks: List[bytes] = []
+
+    def append(self, im: Image.Image, delay: int):
+        """ Append a frame with the specified delay in centiseconds. The transparency index is read from im.info['transparency'] """
+        with io.BytesIO() as bytebox:
+            # Unused palette entries are kept when sharing, so that every frame mapped to the same palette writes the same table
+            im.save(bytebox, "GIF", optimize=not self.share_color_table)
+            blocks = parse_gif_blocks(bytebox.getvalue())
+        block = blocks.frames[0]
+        if block.local_color_table:
+            color_table = block.local_color_table
+            table_bits = block.packed & 0x07
+        else:
+            color_table = blocks.global_color_table
+            table_bits = blocks.gct_packed & 0x07
+        if self.share_color_table and not self.frame_blocks:
+            self.global_color_table = color_table
+        if color_table and color_table == self.global_color_table:
+            color_table = b""
+            table_bits = 0
+        gce_packed = (self.disposal << 2) | (1 if block.transparency is not None else 0)
+        descriptor_packed = (0x80 if color_table else 0) | (block.packed & 0x40) | table_bits
+        self.width = max(self.width, block.left + block.width)
+        self.height = max(self.height, block.top + block.height)
+        self.frame_blocks.append(b"".join([
+            struct.pack("<BBBBHBB", GIF_EXTENSION, GIF_GCE_LABEL, 4, gce_packed, delay, block.transparency or 0, 0),
+            struct.pack("<BHHHHB", GIF_IMAGE_DESCRIPTOR, block.left, block.top, block.width, block.height, descriptor_packed),
+            color_table,
+            bytes([block.lzw_min_code_size]),
+            block.image_data,
+        ]))
+
+    def loop_extension(self) -> bytes:
+        """ Loop count follows gifsicle's convention: 0 is infinite, 1 plays once (no extension), n plays n times """
+        if self.loop_count == 1:
+            return b""
+        loop = 0 if not self.loop_count else self.loop_count - 1
+        return struct.pack("<BBB11sBBHB", GIF_EXTENSION, GIF_APPLICATION_LABEL, 11, b"NETSCAPE2.0", 3, 1, loop, 0)
+
+    def to_bytes(self) -> bytes:
+        if not self.frame_blocks:
+            raise Exception("Cannot assemble a GIF without any frames!")
+        screen_packed = 0
+        if self.global_color_table:
+            table_bits = (len(self.global_color_table) // 3).bit_length() - 2
+            screen_packed = 0x80 | (table_bits << 4) | table_bits
+        header = [b"GIF89a", struct.pack("<HHBBB", self.width, self.height, screen_packed, 0, 0), self.global_color_table, self.loop_extension()]
+        return b"".join(header + self.frame_blocks + [bytes([GIF_TRAILER])])
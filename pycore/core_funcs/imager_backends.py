@@ -0,0 +1,225 @@
+import os
+import time
+import inspect
+import platform
+import importlib
+import threading
+import subprocess
+from typing import Callable, Dict, List, Optional
+
+from .config import imager_confile, _bin_dirpath, IMAGER_PROBE_TIMEOUT, IMAGER_BACKEND_MODULES, IMAGER_TIMING_WEIGHT, IMAGER_BENCHMARK_SIZES
+from .scratch import scratch_space
+
+
+class ImagerBinary:
+    """ An external image processing binary listed in config/imagers.json, along with the result of probing it """
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.available = False
+        self.version = ""
+
+    def probe(self):
+        """ Check that the binary exists and starts, and read its version from the first line it prints """
+        if not os.path.isfile(self.path) or not os.access(self.path, os.X_OK):
+            return
+        try:
+            result = subprocess.run([self.path, "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=IMAGER_PROBE_TIMEOUT)
+        except (OSError, subprocess.SubprocessError):
+            return
+        self.available = True
+        self.version = next((line.strip() for line in result.stdout.decode('utf-8', 'replace').splitlines() if line.strip()), "")
+
+
+class ImagerBackend:
+    """ One implementation of an imaging operation, running either in-process or through one of the external binaries """
+
+    def __init__(self, operation: str, name: str, func: Callable, binary: str = None):
+        self.operation = operation
+        self.name = name
+        self.func = func
+        self.binary = binary
+
+
+class BackendRegistry:
+    """ Registry of the backends of the imaging operations that go through external binaries (coalescing, quantizing, optimizing), and of the binaries they need.
+        Assembling GIFs and APNGs is left out, as it only has the in-process GIFAssembler and apng implementations.\n
+        The binaries are located and probed once, the first time they are needed. Every run of a backend is timed, and each job goes to
+        the available backend whose measured time per unit of work (pixels times frames) is the lowest at the job's size. Backends that
+        were never measured get tried first, in-process ones before binaries, and benchmark() can measure all of them up front on synthetic jobs
+    """
+
+    def __init__(self):
+        self._binaries: Optional[Dict[str, ImagerBinary]] = None
+        self._backends: Dict[str, Dict[str, ImagerBackend]] = {}
+        self._samples: Dict[str, Callable] = {}
+        # (operation, backend name) -> {size bucket: seconds per unit of work}
+        self._timings: Dict[tuple, Dict[int, float]] = {}
+        self._lock = threading.RLock()
+        self._modules_loaded = False
+
+    def load(self):
+        """ Probe the binaries and import the modules that register backends. Only does anything on the first call """
+        with self._lock:
+            if self._binaries is None:
+                platform_key = 'win' if platform.system() == 'Windows' else 'linux'
+                if platform.system() not in ('Windows', 'Linux'):
+                    raise Exception(f"TridentFrame does not have the engine for processing images on this platform! {platform.system()}")
+                binaries = {name: ImagerBinary(name, os.path.abspath(os.path.join(_bin_dirpath(), path)))
+                            for name, path in imager_confile()[platform_key].items()}
+                for binary in binaries.values():
+                    binary.probe()
+                self._binaries = binaries
+            if not self._modules_loaded:
+                self._modules_loaded = True
+                for module in IMAGER_BACKEND_MODULES:
+                    importlib.import_module(module, __package__.rpartition('.')[0])
+
+    def reload(self):
+        """ Probe the binaries again, e.g. after they were installed or replaced """
+        with self._lock:
+            self._binaries = None
+        self.load()
+
+    def binaries(self) -> Dict[str, ImagerBinary]:
+        self.load()
+        return self._binaries
+
+    def binary_path(self, binname: str) -> str:
+        binary = self.binaries().get(binname)
+        if not binary:
+            raise Exception(f"Unknown image processing binary: {binname}")
+        if not binary.available:
+            raise Exception(f"{binname} is not available, the binary at {binary.path} is missing or cannot be run!")
+        return binary.path
+
+    def backend(self, operation: str, name: str, binary: str = None):
+        """ Decorator registering a function as the backend called name for operation. binary is the external binary it runs, if any """
+        def register(func: Callable) -> Callable:
+            with self._lock:
+                self._backends.setdefault(operation, {})[name] = ImagerBackend(operation, name, func, binary)
+            return func
+        return register
+
+    def sample(self, operation: str):
+        """ Decorator registering a function that makes the arguments of a synthetic job of a given size for operation, used by benchmark() """
+        def register(func: Callable) -> Callable:
+            self._samples[operation] = func
+            return func
+        return register
+
+    def available_backends(self, operation: str) -> List[ImagerBackend]:
+        self.load()
+        binaries = self.binaries()
+        return [backend for backend in self._backends.get(operation, {}).values()
+                if not backend.binary or (backend.binary in binaries and binaries[backend.binary].available)]
+
+    def estimate(self, operation: str, name: str, size: int) -> Optional[float]:
+        """ Estimated seconds for a job of the given size, extrapolated from the closest size measured. None if it was never measured """
+        timings = self._timings.get((operation, name))
+        if not timings:
+            return None
+        bucket = _size_bucket(size)
+        closest = min(timings, key=lambda measured: abs(measured - bucket))
+        return timings[closest] * max(size, 1)
+
+    def select(self, operation: str, size: int) -> ImagerBackend:
+        candidates = self.available_backends(operation)
+        if not candidates:
+            raise Exception(f"There is no backend available for {operation}!")
+        with self._lock:
+            unmeasured = [backend for backend in candidates if (operation, backend.name) not in self._timings]
+            if unmeasured:
+                return min(unmeasured, key=lambda backend: backend.binary is not None)
+            return min(candidates, key=lambda backend: self.estimate(operation, backend.name, size))
+
+    def record(self, operation: str, name: str, size: int, seconds: float):
+        with self._lock:
+            timings = self._timings.setdefault((operation, name), {})
+            bucket = _size_bucket(size)
+            per_unit = seconds / max(size, 1)
+            previous = timings.get(bucket)
+            timings[bucket] = per_unit if previous is None else previous + (per_unit - previous) * IMAGER_TIMING_WEIGHT
+
+    def run(self, operation: str, size: int, *args, **kwargs):
+        """ Run operation on the backend selected for the job size. Generator results are returned wrapped, so that only the time spent inside them is measured """
+        backend = self.select(operation, size)
+        start = time.perf_counter()
+        result = backend.func(*args, **kwargs)
+        if inspect.isgenerator(result):
+            return self._timed(backend, size, result, time.perf_counter() - start)
+        self.record(operation, backend.name, size, time.perf_counter() - start)
+        return result
+
+    def _timed(self, backend: ImagerBackend, size: int, generator, elapsed: float):
+        # Callers that zip the frames with something else never exhaust the generator, so the time is recorded once it gets closed
+        produced = False
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(generator)
+                except StopIteration as stop:
+                    produced = True
+                    return stop.value
+                except BaseException:
+                    # Failed runs are not measured
+                    produced = False
+                    raise
+                finally:
+                    elapsed += time.perf_counter() - start
+                produced = True
+                yield item
+        finally:
+            generator.close()
+            if produced:
+                self.record(backend.operation, backend.name, size, elapsed)
+
+    def benchmark(self, sizes=IMAGER_BENCHMARK_SIZES) -> Dict:
+        """ Time every available backend of each operation that has more than one, on synthetic jobs of the given (width, height, frames) sizes """
+        self.load()
+        for operation, make_sample in self._samples.items():
+            backends = self.available_backends(operation)
+            if len(backends) < 2:
+                continue
+            for width, height, frames in sizes:
+                sample_dir = scratch_space.mkdir(prefix_name="imager_benchmark")
+                try:
+                    args = make_sample(sample_dir, width, height, frames)
+                    for backend in backends:
+                        start = time.perf_counter()
+                        result = backend.func(*args)
+                        if inspect.isgenerator(result):
+                            for item in result:
+                                pass
+                        self.record(operation, backend.name, width * height * frames, time.perf_counter() - start)
+                finally:
+                    scratch_space.release(sample_dir)
+        return self.stats()
+
+    def stats(self) -> Dict:
+        binaries = self.binaries()
+        return {
+            "binaries": {name: {"path": binary.path, "available": binary.available, "version": binary.version} for name, binary in binaries.items()},
+            "operations": {operation: {name: {
+                "binary": backend.binary,
+                "available": backend in self.available_backends(operation),
+                "seconds_per_megapixel": {str(2 ** bucket): round(per_unit * 1e6, 4) for bucket, per_unit in sorted(self._timings.get((operation, name), {}).items())},
+            } for name, backend in backends.items()} for operation, backends in self._backends.items()},
+        }
+
+
+def _size_bucket(size: int) -> int:
+    """ Jobs are grouped by the power of two of their size """
+    return max(size, 1).bit_length() - 1
+
+
+imager_backends = BackendRegistry()
+
+
+def imager_exec_path(binname: str) -> str:
+    """ Get the path to the internal image processing binaries, for use as the first item of a process argv\n
+        Supported binname params: ['gifsicle', 'imagemagick', 'apngopt', 'apngdis', 'pngquant']
+    """
+    return imager_backends.binary_path(binname)
@@ -0,0 +1,164 @@
+import os
+import time
+import atexit
+import pickle
+import sqlite3
+import threading
+from typing import Dict
+
+from .config import ABS_CACHE_PATH, INSPECT_CACHE_FILENAME, INSPECT_CACHE_MAX_BYTES, INSPECT_CACHE_ACCESS_BATCH
+
+
+class InspectionCache:
+    """ On-disk cache of image inspection results, keyed by the image's absolute path, size and modification time.\n
+        Entries are evicted in least-recently-used order once the total size of the stored results exceeds max_bytes.
+        A single connection is kept open, and the access times of cache hits are written in batches instead of one transaction per hit
+    """
+
+    def __init__(self, filename: str = INSPECT_CACHE_FILENAME, max_bytes: int = INSPECT_CACHE_MAX_BYTES, access_batch: int = INSPECT_CACHE_ACCESS_BATCH):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.access_batch = access_batch
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection = None
+        self._conn_path = ""
+        # path -> time of the last hit, not written to the database yet
+        self._accesses: Dict[str, float] = {}
+
+    def db_path(self) -> str:
+        return os.path.join(ABS_CACHE_PATH(), self.filename)
+
+    def _connection(self) -> sqlite3.Connection:
+        """ The open connection to the cache database, opening it and creating the tables first if needed. Must be called with the lock held """
+        db_path = self.db_path()
+        if self._conn and (self._conn_path != db_path or not os.path.exists(db_path)):
+            # The working directory changed or the cache folder was purged
+            self._close()
+        if not self._conn:
+            os.makedirs(ABS_CACHE_PATH(), exist_ok=True)
+            conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            with conn:
+                self._create_tables(conn)
+            self._conn, self._conn_path = conn, db_path
+        return self._conn
+
+    def _close(self):
+        try:
+            self._conn.close()
+        except sqlite3.Error:
+            pass
+        self._conn, self._conn_path = None, ""
+
+    def _create_tables(self, conn: sqlite3.Connection):
+        conn.execute("""CREATE TABLE IF NOT EXISTS inspections (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            info BLOB NOT NULL,
+            nbytes INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS inspections_last_access ON inspections (last_access)")
+
+    def get(self, abspath: str) -> Dict:
+        """ Returns the cached inspection of abspath, or None if it is missing or the file has changed since """
+        try:
+            stat = os.stat(abspath)
+            with self._lock:
+                row = self._connection().execute("SELECT info FROM inspections WHERE path = ? AND size = ? AND mtime_ns = ?",
+                                                 (abspath, stat.st_size, stat.st_mtime_ns)).fetchone()
+                if row:
+                    self._accesses[abspath] = time.time()
+                    if len(self._accesses) >= self.access_batch:
+                        with self._conn:
+                            self._flush_accesses()
+            info = pickle.loads(row[0]) if row else None
+        except (OSError, sqlite3.Error, pickle.UnpicklingError):
+            info = None
+        if info is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return info
+
+    def put(self, abspath: str, info: Dict):
+        """ Stores the inspection of abspath, then evicts the least recently used entries if the cache is over its size budget """
+        try:
+            stat = os.stat(abspath)
+            blob = pickle.dumps(info, protocol=pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                conn = self._connection()
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO inspections VALUES (?, ?, ?, ?, ?, ?)",
+                                 (abspath, stat.st_size, stat.st_mtime_ns, blob, len(blob), time.time()))
+                    self._accesses.pop(abspath, None)
+                    self._evict(conn)
+        except (OSError, sqlite3.Error, pickle.PicklingError, TypeError):
+            pass
+
+    def _flush_accesses(self):
+        """ Write the access times of the pending cache hits, inside the caller's transaction """
+        if self._accesses:
+            accesses, self._accesses = self._accesses, {}
+            self._conn.executemany("UPDATE inspections SET last_access = ? WHERE path = ?", [(last_access, path) for path, last_access in accesses.items()])
+
+    def _evict(self, conn: sqlite3.Connection):
+        total = conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM inspections").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        self._flush_accesses()
+        rows = conn.execute("SELECT path, nbytes FROM inspections ORDER BY last_access ASC").fetchall()
+        evicted = []
+        for path, nbytes in rows:
+            if total <= self.max_bytes:
+                break
+            evicted.append((path,))
+            total -= nbytes
+        conn.executemany("DELETE FROM inspections WHERE path = ?", evicted)
+        self.evictions += len(evicted)
+
+    def clear(self):
+        """ Remove every entry. The database file itself is kept, since other processes may have it open """
+        try:
+            with self._lock:
+                conn = self._connection()
+                self._accesses.clear()
+                with conn:
+                    conn.execute("DELETE FROM inspections")
+                conn.execute("VACUUM")
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        """ Write the pending access times and close the connection """
+        with self._lock:
+            if not self._conn:
+                return
+            try:
+                with self._conn:
+                    self._flush_accesses()
+            except sqlite3.Error:
+                pass
+            self._close()
+
+    def stats(self) -> Dict:
+        try:
+            with self._lock:
+                entries, total = self._connection().execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM inspections").fetchone()
+        except sqlite3.Error:
+            entries, total = 0, 0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
+
+
+inspection_cache = InspectionCache()
+atexit.register(inspection_cache.close)
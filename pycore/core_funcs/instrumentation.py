@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List
+
+from .config import TIMING_HISTOGRAM_BOUNDS_MS
+
+
+class StageSpan:
+    """ A single timed run of a stage, such as decoding one frame or one call to an external binary """
+    __slots__ = ("stage", "label", "start", "wall", "cpu", "thread_id")
+
+    def __init__(self, stage: str, label: str, start: float, wall: float, cpu: float, thread_id: int):
+        self.stage = stage
+        self.label = label
+        self.start = start
+        self.wall = wall
+        self.cpu = cpu
+        self.thread_id = thread_id
+
+
+class StageProfiler:
+    """ Records the wall and CPU time of every stage of an operation (decode, transform, quantize, encode, external, write).\n
+        CPU time is measured per thread, so stages running on worker threads are accounted for separately
+    """
+
+    def __init__(self, trace_path: str = ""):
+        self.trace_path = trace_path
+        self.spans: List[StageSpan] = []
+        self.origin = time.perf_counter()
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, span: StageSpan):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self) -> Dict:
+        """ Per-stage totals, percentiles and a histogram of span latencies in milliseconds """
+        with self._lock:
+            spans = list(self.spans)
+        stages = {}
+        for span in spans:
+            stages.setdefault(span.stage, []).append(span)
+        summary = {
+            "elapsed_s": round(time.perf_counter() - self.origin, 6),
+            "busy_s": round(self.busy, 6),
+            "stages": {},
+        }
+        for name, stage_spans in stages.items():
+            walls = sorted(span.wall * 1000 for span in stage_spans)
+            count = len(walls)
+            histogram = {}
+            for bound in TIMING_HISTOGRAM_BOUNDS_MS:
+                histogram[f"<={bound}ms"] = 0
+            histogram[f">{TIMING_HISTOGRAM_BOUNDS_MS[-1]}ms"] = 0
+            for wall in walls:
+                bound = next((b for b in TIMING_HISTOGRAM_BOUNDS_MS if wall <= b), None)
+                key = f"<={bound}ms" if bound is not None else f">{TIMING_HISTOGRAM_BOUNDS_MS[-1]}ms"
+                histogram[key] += 1
+            summary["stages"][name] = {
+                "count": count,
+                "wall_ms": round(sum(walls), 3),
+                "cpu_ms": round(sum(span.cpu for span in stage_spans) * 1000, 3),
+                "mean_ms": round(sum(walls) / count, 3),
+                "p50_ms": round(walls[int(0.50 * (count - 1))], 3),
+                "p95_ms": round(walls[int(0.95 * (count - 1))], 3),
+                "max_ms": round(walls[-1], 3),
+                "histogram": {key: n for key, n in histogram.items() if n},
+            }
+        if self.trace_path:
+            summary["trace_path"] = self.trace_path
+        return summary
+
+    def chrome_trace(self) -> Dict:
+        """ The recorded spans in the Chrome trace event format, viewable in chrome://tracing or Perfetto """
+        with self._lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        events = [{
+            "name": span.label or span.stage,
+            "cat": span.stage,
+            "ph": "X",
+            "ts": round((span.start - self.origin) * 1e6, 3),
+            "dur": round(span.wall * 1e6, 3),
+            "pid": pid,
+            "tid": span.thread_id,
+            "args": {"cpu_ms": round(span.cpu * 1000, 3)},
+        } for span in spans]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, trace_path: str) -> str:
+        with open(trace_path, "w") as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+        return trace_path
+
+
+_local = threading.local()
+
+
+def active_profiler() -> StageProfiler:
+    return getattr(_local, "profiler", None)
+
+
+@contextmanager
+def profiling(profiler: StageProfiler):
+    """ Make profiler the active one of the current thread while running the body """
+    previous = active_profiler()
+    _local.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _local.profiler = previous
+
+
+@contextmanager
+def stage(name: str, label: str = ""):
+    """ Time the body as a run of the named stage. Does nothing unless a profiler is active """
+    profiler = active_profiler()
+    if not profiler:
+        yield
+        return
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield
+    finally:
+        profiler.record(StageSpan(name, label, start, time.perf_counter() - start, time.thread_time() - cpu_start, threading.get_ident()))
+
+
+def instrumented(operation, profiler: StageProfiler):
+    """ Drive an operation generator with profiler active during each of its steps.\n
+        A {"TIMINGS": ...} summary is yielded right before the operation's final CONTROL message (or at its end if it has none),
+        after writing the Chrome trace if the profiler has a trace_path
+    """
+    held_control = None
+    try:
+        while True:
+            with profiling(profiler):
+                step_start = time.perf_counter()
+                try:
+                    msg = next(operation)
+                except StopIteration as stop:
+                    result = stop.value
+                    break
+                finally:
+                    profiler.busy += time.perf_counter() - step_start
+            if held_control:
+                yield held_control
+                held_control = None
+            if isinstance(msg, dict) and "CONTROL" in msg:
+                held_control = msg
+            else:
+                yield msg
+        if profiler.trace_path:
+            profiler.write_chrome_trace(profiler.trace_path)
+        yield {"TIMINGS": profiler.summary()}
+        if held_control:
+            yield held_control
+        return result
+    finally:
+        operation.close()
+
+
+def profiled(operation, vals: Dict):
+    """ Instrument the operation if its vals opt in with 'profile', or with 'trace_path' to also export a Chrome trace there. Otherwise it is returned as is """
+    if not vals.get('profile') and not vals.get('trace_path'):
+        return operation
+    return instrumented(operation, StageProfiler(vals.get('trace_path') or ""))
@@ -0,0 +1,212 @@
+import struct
+import zlib
+from typing import List, Iterator, Tuple
+
+from PIL import Image
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Most bytes inflated at once while decoding a PNG in bands
+PNG_INFLATE_STEP = 1024 * 1024
+# Channel counts of the PNG color types, at a bit depth of 8
+PNG_8BIT_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+class PNGFrameControl:
+    """ The values of an APNG fcTL chunk, named after pyAPNG's FrameControl """
+
+    def __init__(self, data: bytes):
+        (self.sequence, self.width, self.height, self.x_offset, self.y_offset,
+         self.delay, self.delay_den, self.depose_op, self.blend_op) = struct.unpack(">IIIIIHHBB", data[:26])
+
+
+class APNGChunks:
+    """ Image header, animation control and per-frame control values of a PNG/APNG """
+
+    def __init__(self):
+        self.width: int = 0
+        self.height: int = 0
+        self.bit_depth: int = 0
+        self.color_type: int = 0
+        self.interlace: int = 0
+        self.num_frames: int = 0
+        self.num_plays: int = 0
+        self.frame_controls: List[PNGFrameControl] = []
+
+    @property
+    def animation_controls(self) -> List[PNGFrameControl]:
+        """ Frame controls of the frames that make up the animation. A default image without fcTL is not one of them, unless it is the only image of a static PNG """
+        return [control for control in self.frame_controls if control] or self.frame_controls
+
+
+def read_apng_chunks(png_path: str) -> APNGChunks:
+    """ Walk the chunks of a PNG/APNG and collect its IHDR, acTL and fcTL values, seeking over IDAT/fdAT without reading any pixel data.\n
+        Frames are grouped the same way pyAPNG does: a frame without an fcTL chunk (the default image) has None as its frame control
+    """
+    chunks = APNGChunks()
+    with open(png_path, "rb") as png_file:
+        if png_file.read(8) != PNG_SIGNATURE:
+            raise Exception(f"{png_path} is not a valid PNG image")
+        control = None
+        has_image_data = False
+        while True:
+            header = png_file.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            if chunk_type in (b"IHDR", b"acTL", b"fcTL"):
+                data = png_file.read(length)
+                png_file.seek(4, 1)
+            else:
+                png_file.seek(length + 4, 1)
+            if chunk_type == b"IHDR":
+                chunks.width, chunks.height, chunks.bit_depth, chunks.color_type = struct.unpack(">IIBB", data[:10])
+                chunks.interlace = data[12]
+            elif chunk_type == b"acTL":
+                chunks.num_frames, chunks.num_plays = struct.unpack(">II", data[:8])
+            elif chunk_type == b"fcTL":
+                if has_image_data:
+                    chunks.frame_controls.append(control)
+                    has_image_data = False
+                control = PNGFrameControl(data)
+            elif chunk_type in (b"IDAT", b"fdAT"):
+                has_image_data = True
+            elif chunk_type == b"IEND":
+                chunks.frame_controls.append(control)
+                break
+    return chunks
+
+
+def _make_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+
+
+def iter_apng_frames(png_path: str) -> Iterator[Tuple[bytes, PNGFrameControl]]:
+    """ Stream the frames of a PNG/APNG one at a time as standalone PNG bytes, along with their frame control (None for a default image without fcTL).\n
+        Only one frame's compressed data is held in memory at any time
+    """
+    with open(png_path, "rb") as png_file:
+        if png_file.read(8) != PNG_SIGNATURE:
+            raise Exception(f"{png_path} is not a valid PNG image")
+        ihdr = b""
+        head_chunks = []
+        data_chunks = []
+        control = None
+        seen_image_data = False
+
+        def assemble_frame() -> bytes:
+            frame_ihdr = ihdr
+            if control:
+                frame_ihdr = struct.pack(">II", control.width, control.height) + ihdr[8:]
+            return b"".join([PNG_SIGNATURE, _make_chunk(b"IHDR", frame_ihdr), *head_chunks, *data_chunks, _make_chunk(b"IEND", b"")])
+
+        while True:
+            header = png_file.read(8)
+            if len(header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", header)
+            data = png_file.read(length)
+            png_file.seek(4, 1)
+            if chunk_type == b"IHDR":
+                ihdr = data
+            elif chunk_type == b"fcTL":
+                if data_chunks:
+                    yield assemble_frame(), control
+                    data_chunks = []
+                control = PNGFrameControl(data)
+            elif chunk_type == b"IDAT":
+                seen_image_data = True
+                data_chunks.append(_make_chunk(b"IDAT", data))
+            elif chunk_type == b"fdAT":
+                seen_image_data = True
+                data_chunks.append(_make_chunk(b"IDAT", data[4:]))
+            elif chunk_type == b"IEND":
+                yield assemble_frame(), control
+                break
+            elif chunk_type != b"acTL" and not seen_image_data:
+                head_chunks.append(_make_chunk(chunk_type, data))
+
+
+def supports_png_bands(png_path: str) -> bool:
+    """ Whether iter_png_bands can stream the image, which has to be a non-interlaced 8-bit PNG """
+    try:
+        chunks = read_apng_chunks(png_path)
+    except Exception:
+        return False
+    return chunks.bit_depth == 8 and chunks.color_type in PNG_8BIT_CHANNELS and not chunks.interlace
+
+
+def _stored_zlib(data: memoryview) -> bytes:
+    """ Wrap data in a zlib stream of uncompressed deflate blocks, which costs a single copy of it """
+    blocks = [b"\x78\x01"]
+    for start in range(0, len(data), 0xFFFF):
+        block = data[start:start + 0xFFFF]
+        blocks.append(struct.pack("<BHH", start + 0xFFFF >= len(data), len(block), len(block) ^ 0xFFFF))
+        blocks.append(block)
+    blocks.append(struct.pack(">I", zlib.adler32(data)))
+    return b"".join(blocks)
+
+
+def iter_png_bands(png_path: str, band_height: int) -> Iterator[Image.Image]:
+    """ Decode a non-interlaced 8-bit PNG in horizontal bands of band_height rows (the last one may be shorter), yielded as PIL.Image.Images with the PNG's own mode, palette and info.\n
+        The image data is inflated incrementally and each band is unfiltered by Pillow on its own, so only a band or two is ever held in memory no matter how large the image is
+    """
+    chunks = read_apng_chunks(png_path)
+    if not supports_png_bands(png_path):
+        raise Exception(f"{png_path} is not a non-interlaced 8-bit PNG")
+    with Image.open(png_path) as header:
+        # Opening only parses the chunks before the image data, which gives the mode, palette and transparency of the PNG
+        mode, palette, info, rawmode = header.mode, header.palette, dict(header.info), header.tile[0].args
+        width, height = header.size
+    row_size = width * PNG_8BIT_CHANNELS[chunks.color_type] + 1
+    inflater = zlib.decompressobj()
+    pending = bytearray()
+    # Every band but the first is decoded with the last row of the previous one on top, unfiltered, as its scanlines may be filtered against it
+    context_size = 0
+    rows_left = height
+
+    def take_bands(final: bool = False):
+        nonlocal pending, context_size, rows_left
+        while rows_left:
+            rows = min(band_height, rows_left)
+            band_size = context_size + row_size * rows
+            if len(pending) < band_size:
+                if final:
+                    raise Exception(f"{png_path} has less image data than its header claims")
+                return
+            with memoryview(pending) as scanlines:
+                stored = _stored_zlib(scanlines[:band_size])
+            pending = pending[band_size:]
+            band = Image.frombytes(mode, (width, band_size // row_size), stored, "zip", rawmode)
+            del stored
+            pending[0:0] = b"\x00" + band.crop((0, band.height - 1, width, band.height)).tobytes()
+            if context_size:
+                band = band.crop((0, 1, width, band.height))
+            context_size = row_size
+            if palette:
+                band.putpalette(palette)
+            band.info = dict(info)
+            rows_left -= rows
+            yield band
+
+    with open(png_path, "rb") as png_file:
+        png_file.read(8)
+        while rows_left:
+            chunk_header = png_file.read(8)
+            if len(chunk_header) < 8:
+                break
+            length, chunk_type = struct.unpack(">I4s", chunk_header)
+            if chunk_type == b"IDAT":
+                data = png_file.read(length)
+                while data:
+                    # Inflate in small steps up to the end of the band, so a highly compressed chunk cannot blow up in memory
+                    pending += inflater.decompress(data, min(max(context_size + row_size * band_height - len(pending), 1), PNG_INFLATE_STEP))
+                    data = inflater.unconsumed_tail
+                    yield from take_bands()
+            elif chunk_type == b"IEND":
+                break
+            else:
+                png_file.seek(length, 1)
+            png_file.seek(4, 1)
+    pending += inflater.flush()
+    yield from take_bands(final=True)
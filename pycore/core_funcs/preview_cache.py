@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Dict, Tuple
+
+from .config import ABS_CACHE_PATH, PREVIEW_CACHE_DIRNAME, PREVIEW_CACHE_MAX_BYTES, PREVIEW_CACHE_PIN_SECONDS
+
+
+class PreviewCache:
+    """ On-disk cache of the proxies and previews rendered for the Modify tab, stored as files named after their keys.\n
+        Keys start from a hash of the source image's contents, so a preview is reused for as long as the image and the criteria it was rendered with stay the same.
+        Files are evicted in least-recently-used order (by modification time, which is refreshed on every hit) once their total size exceeds max_bytes.
+        Every path handed out by get or put is pinned for PREVIEW_CACHE_PIN_SECONDS, during which it is not evicted even if that keeps the cache over budget
+    """
+
+    def __init__(self, dirname: str = PREVIEW_CACHE_DIRNAME, max_bytes: int = PREVIEW_CACHE_MAX_BYTES):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # (abspath, size, mtime_ns) -> content hash, so that an unchanged image is only read once
+        self._source_hashes: Dict[Tuple[str, int, int], str] = {}
+        # Path -> time.monotonic() until which it is not evicted
+        self._pins: Dict[str, float] = {}
+
+    def dir_path(self) -> str:
+        return os.path.join(ABS_CACHE_PATH(), self.dirname)
+
+    def source_key(self, abspath: str) -> str:
+        """ Hash of the contents of a source image """
+        stat = os.stat(abspath)
+        stamp = (abspath, stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            source_hash = self._source_hashes.get(stamp)
+        if not source_hash:
+            digest = hashlib.blake2b(digest_size=16)
+            with open(abspath, "rb") as source:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            source_hash = digest.hexdigest()
+            with self._lock:
+                self._source_hashes[stamp] = source_hash
+        return source_hash
+
+    @staticmethod
+    def key(*parts) -> str:
+        """ Combine a source key with anything else the cached file depends on (criteria objects, size limits...) into a single key """
+        serialized = json.dumps([vars(part) if hasattr(part, "__dict__") else part for part in parts], sort_keys=True, default=str)
+        return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.dir_path(), f"{key}.{ext}")
+
+    def get(self, key: str, ext: str) -> str:
+        """ Returns the path of the cached file, or None if there isn't one. The file is refreshed and pinned under the lock that eviction holds """
+        path = self._path(key, ext)
+        with self._lock:
+            try:
+                os.utime(path)
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._pin(path)
+        return path
+
+    def put(self, key: str, file_path: str, ext: str) -> str:
+        """ Copy a file into the cache, evict the least recently used files if the cache is over its size budget, and return the cached path """
+        os.makedirs(self.dir_path(), exist_ok=True)
+        path = self._path(key, ext)
+        staging_path = f"{path}.{threading.get_ident()}.part"
+        with open(file_path, "rb") as source, open(staging_path, "wb") as staging:
+            for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                staging.write(chunk)
+        os.replace(staging_path, path)
+        with self._lock:
+            self._pin(path)
+            self._evict()
+        return path
+
+    def _pin(self, path: str):
+        self._pins[path] = time.monotonic() + PREVIEW_CACHE_PIN_SECONDS
+
+    def _entries(self):
+        try:
+            with os.scandir(self.dir_path()) as scan:
+                return [(entry.path, entry.stat()) for entry in scan if entry.is_file() and not entry.name.endswith(".part")]
+        except OSError:
+            return []
+
+    def _evict(self):
+        now = time.monotonic()
+        self._pins = {path: until for path, until in self._pins.items() if until > now}
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        total = sum(stat.st_size for path, stat in entries)
+        for path, stat in entries:
+            if total <= self.max_bytes:
+                break
+            if path in self._pins:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= stat.st_size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._pins.clear()
+            for path, stat in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self) -> Dict:
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(stat.st_size for path, stat in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+preview_cache = PreviewCache()
@@ -0,0 +1,184 @@
+import os
+import queue
+import threading
+import subprocess
+from subprocess import PIPE, DEVNULL
+from concurrent.futures import Future
+from typing import Dict, List, Iterator, Tuple, Callable
+
+from .config import EXTERNAL_PROCESS_TIMEOUT, PROCESS_POLL_INTERVAL
+from .cancellation import CancellationToken, active_token, activated, _popen_kwargs, _kill_process_tree
+from .instrumentation import stage, profiling
+
+
+class ProcessFuture(Future):
+    """ Future of the subprocess.CompletedProcess of a running process. Cancelling it kills the process """
+
+    def __init__(self, process: subprocess.Popen):
+        super().__init__()
+        self.process = process
+        # The process is already running, so cancel() never marks the future itself as cancelled
+        self.set_running_or_notify_cancel()
+
+    def cancel(self) -> bool:
+        _kill_process_tree(self.process)
+        return super().cancel()
+
+
+class ProcessRunner:
+    """ Runs the external binaries with a thread of their own each, so that any number of them can run at once while the threads that started them only wait for the results.\n
+        Processes are started from argv lists without a shell, are tied to the cancellation token of the operation that started them, are killed once they
+        run past their timeout, and can have their output streamed back line by line as it is printed
+    """
+
+    def __init__(self):
+        # Thread ID -> idle function of the threads that wait cooperatively
+        self._idlers: Dict[int, Callable[[float], None]] = {}
+
+    def set_idle(self, idle: Callable[[float], None]):
+        """ Make the current thread wait for processes (and the futures passed to wait_for) by calling idle(PROCESS_POLL_INTERVAL) until they are done, instead of blocking.\n
+            The engine passes gevent.sleep for the thread of its RPC server, so that other RPCs such as cancel_operation are still served while a binary runs. None restores blocking waits
+        """
+        if idle:
+            self._idlers[threading.get_ident()] = idle
+        else:
+            self._idlers.pop(threading.get_ident(), None)
+
+    def idle_function(self) -> Callable[[float], None]:
+        return self._idlers.get(threading.get_ident())
+
+    def submit(self, argv: List[str], input: bytes = None, timeout: float = EXTERNAL_PROCESS_TIMEOUT, on_line: Callable[[str, bytes], None] = None) -> ProcessFuture:
+        """ Start a process and return a ProcessFuture of its subprocess.CompletedProcess, with stdout and stderr captured as bytes.\n
+            With on_line, on_line(stream_name, line) is also called from the process' threads for every line printed to stdout or stderr
+        """
+        argv = [str(arg) for arg in argv]
+        token = active_token()
+        process = subprocess.Popen(argv, stdin=PIPE if input is not None else DEVNULL, stdout=PIPE, stderr=PIPE, **_popen_kwargs())
+        if token:
+            token.track_process(process)
+        future = ProcessFuture(process)
+        threading.Thread(target=self._run, args=(future, argv, input, timeout, on_line, token), name="process_runner", daemon=True).start()
+        return future
+
+    def _run(self, future: ProcessFuture, argv: List[str], input: bytes, timeout: float, on_line: Callable, token: CancellationToken):
+        process = future.process
+        try:
+            stdout, stderr = _communicate(process, input, timeout, on_line)
+        except subprocess.TimeoutExpired:
+            future.set_exception(subprocess.TimeoutExpired(argv, timeout))
+        except BaseException as e:
+            _kill_process_tree(process)
+            future.set_exception(e)
+        else:
+            future.set_result(subprocess.CompletedProcess(argv, process.returncode, stdout, stderr))
+        finally:
+            if token:
+                token.untrack_process(process)
+
+
+def _communicate(process: subprocess.Popen, input: bytes, timeout: float, on_line: Callable) -> Tuple[bytes, bytes]:
+    if not on_line:
+        try:
+            return process.communicate(input, timeout)
+        except subprocess.TimeoutExpired:
+            _kill_process_tree(process)
+            process.communicate()
+            raise
+
+    output = {}
+
+    def feed():
+        if process.stdin is None:
+            return
+        try:
+            process.stdin.write(input)
+            process.stdin.close()
+        except OSError:
+            # The process exited without reading all of its input
+            pass
+
+    def pump(stream, stream_name: str):
+        lines = []
+        for line in iter(stream.readline, b""):
+            lines.append(line)
+            on_line(stream_name, line)
+        stream.close()
+        output[stream_name] = b"".join(lines)
+
+    threads = [threading.Thread(target=feed, daemon=True),
+               threading.Thread(target=pump, args=(process.stdout, "stdout"), daemon=True),
+               threading.Thread(target=pump, args=(process.stderr, "stderr"), daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        _kill_process_tree(process)
+        process.wait()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    return output["stdout"], output["stderr"]
+
+
+process_runner = ProcessRunner()
+
+
+def _idle(idle: Callable[[float], None]):
+    # The active token and profiler are per-thread, and the greenlets that run while this one waits share the thread, so they start out without any
+    with activated(None), profiling(None):
+        idle(PROCESS_POLL_INTERVAL)
+
+
+def wait_for(future: Future):
+    """ Return the result of a future, waiting for it cooperatively if the current thread has an idle function """
+    idle = process_runner.idle_function()
+    if idle:
+        while not future.done():
+            _idle(idle)
+    return future.result()
+
+
+def _next_line(lines: queue.Queue):
+    idle = process_runner.idle_function()
+    while idle:
+        try:
+            return lines.get_nowait()
+        except queue.Empty:
+            _idle(idle)
+    return lines.get()
+
+
+def _finish(result: subprocess.CompletedProcess, token: CancellationToken, check: bool) -> subprocess.CompletedProcess:
+    # A process killed by a cancellation fails, report the cancellation instead of the failure
+    if token:
+        token.check()
+    if check and result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args, result.stdout, result.stderr)
+    return result
+
+
+def run_process(argv: List[str], input: bytes = None, check: bool = False, timeout: float = EXTERNAL_PROCESS_TIMEOUT) -> subprocess.CompletedProcess:
+    """ Run a binary without a shell and wait for it to exit. Its output is captured, and it is killed if the active operation gets cancelled or the timeout runs out """
+    token = active_token()
+    with stage("external", os.path.basename(argv[0])):
+        result = wait_for(process_runner.submit(argv, input, timeout))
+    return _finish(result, token, check)
+
+
+def stream_process(argv: List[str], input: bytes = None, check: bool = False, timeout: float = EXTERNAL_PROCESS_TIMEOUT) -> Iterator[Tuple[str, str]]:
+    """ Run a binary like run_process, yielding a (stream name, line) for every line it prints to stdout or stderr while it runs. Returns its subprocess.CompletedProcess """
+    token = active_token()
+    lines = queue.Queue()
+    with stage("external", os.path.basename(argv[0])):
+        future = process_runner.submit(argv, input, timeout, on_line=lambda stream_name, line: lines.put((stream_name, line)))
+        future.add_done_callback(lambda done: lines.put(None))
+        try:
+            for stream_name, line in iter(lambda: _next_line(lines), None):
+                yield stream_name, line.decode('utf-8', 'replace')
+        finally:
+            # Stop the process if the consumer went away before it exited
+            future.cancel()
+        result = future.result()
+    return _finish(result, token, check)
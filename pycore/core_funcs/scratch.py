@@ -0,0 +1,180 @@
+import os
+import shutil
+import ctypes
+import platform
+import tempfile
+import threading
+from typing import Dict, Tuple
+
+from .config import ABS_CACHE_PATH, SCRATCH_DIRNAME, SCRATCH_MAX_BYTES, SCRATCH_USE_TMPFS, SCRATCH_TMPFS_PATH
+from .cancellation import active_token
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    if platform.system() == 'Windows':
+        # os.kill(pid, 0) terminates the process on Windows, so ask for its exit code instead
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+
+class ScratchSpace:
+    """ Allocator of the temporary directories used by the engine's operations.\n
+        Every directory gets a unique name tagged with the ID of the process that made it, and stays checked out from mkdir until it is released,
+        or removed along with the temp dirs of the active operation once it finishes, fails or gets cancelled. The size of the scratch space is kept
+        as a running total: the directories already in it are measured once per root (and again by stats and purge), then the total follows the
+        directories as they are created and released. Whenever it grows past max_bytes, the least recently modified directories that are neither
+        checked out nor held by another live process are evicted. With use_tmpfs, scratch space is placed on a RAM-backed filesystem if there is one
+    """
+
+    def __init__(self, max_bytes: int = SCRATCH_MAX_BYTES, use_tmpfs: bool = SCRATCH_USE_TMPFS):
+        self.max_bytes = max_bytes
+        self.use_tmpfs = use_tmpfs
+        self._checked_out = set()
+        # Path -> (last modified time, size in bytes) of every directory in the scratch space, as of when it was measured or created
+        self._dirs: Dict[str, Tuple[float, int]] = {}
+        self._used = 0
+        self._scanned_root = None
+        self._lock = threading.RLock()
+
+    @property
+    def on_tmpfs(self) -> bool:
+        return bool(self.use_tmpfs and platform.system() == 'Linux' and os.access(SCRATCH_TMPFS_PATH, os.W_OK))
+
+    @property
+    def root(self) -> str:
+        if self.on_tmpfs:
+            return os.path.join(SCRATCH_TMPFS_PATH, f"tridentframe_{SCRATCH_DIRNAME}")
+        return os.path.join(ABS_CACHE_PATH(), SCRATCH_DIRNAME)
+
+    def settings(self) -> Dict:
+        return {"max_bytes": self.max_bytes, "use_tmpfs": self.use_tmpfs}
+
+    def configure(self, max_bytes: int = None, use_tmpfs: bool = None):
+        if max_bytes is not None:
+            self.max_bytes = int(max_bytes)
+        if use_tmpfs is not None:
+            self.use_tmpfs = bool(use_tmpfs)
+        self.evict()
+
+    def mkdir(self, prefix_name: str = "") -> str:
+        """ Create a new scratch directory and return its absolute path. It is checked out until released, and tied to the active operation if there is one """
+        root = self.root
+        os.makedirs(root, exist_ok=True)
+        with self._lock:
+            if self._scanned_root != root:
+                self._scan(root)
+            if self._used > self.max_bytes:
+                self._evict()
+        prefix = f"{prefix_name}_{os.getpid()}_" if prefix_name else f"{os.getpid()}_"
+        scratch_dir = tempfile.mkdtemp(prefix=prefix, dir=root)
+        with self._lock:
+            self._checked_out.add(scratch_dir)
+            self._dirs[scratch_dir] = (os.path.getmtime(scratch_dir), 0)
+        token = active_token()
+        if token:
+            token.track_temp_dir(scratch_dir)
+        return scratch_dir
+
+    def release(self, scratch_dir: str):
+        """ Remove a scratch directory as soon as it is no longer needed """
+        with self._lock:
+            self._forget(scratch_dir)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    def _forget(self, path: str):
+        self._checked_out.discard(path)
+        mtime, size = self._dirs.pop(path, (0, 0))
+        self._used -= size
+
+    def _scan(self, root: str):
+        """ Measure every directory in the scratch space. Has to be called with the lock held """
+        dirs = {}
+        if os.path.isdir(root):
+            for name in os.listdir(root):
+                path = os.path.join(root, name)
+                try:
+                    dirs[path] = (os.path.getmtime(path), _dir_size(path))
+                except OSError:
+                    continue
+        self._dirs = dirs
+        self._used = sum(size for mtime, size in dirs.values())
+        self._checked_out &= set(dirs)
+        self._scanned_root = root
+
+    def _evictable(self, path: str) -> bool:
+        if path in self._checked_out:
+            return False
+        owner = next((int(part) for part in os.path.basename(path).split("_") if part.isdigit()), None)
+        # Directories of other live processes may still be in use by them
+        return owner is None or owner == os.getpid() or not _pid_alive(owner)
+
+    def _evict(self) -> int:
+        # Checked out directories removed by their operation's token never get released here
+        for path in [path for path in self._checked_out if not os.path.isdir(path)]:
+            self._forget(path)
+        freed = 0
+        for path, (mtime, size) in sorted(self._dirs.items(), key=lambda entry: entry[1][0]):
+            if self._used <= self.max_bytes:
+                break
+            if self._evictable(path):
+                shutil.rmtree(path, ignore_errors=True)
+                self._forget(path)
+                freed += size
+        return freed
+
+    def evict(self) -> int:
+        """ Remove the least recently modified evictable directories until the scratch space fits in max_bytes. Returns the number of bytes freed """
+        with self._lock:
+            root = self.root
+            if self._scanned_root != root:
+                self._scan(root)
+            return self._evict()
+
+    def purge(self):
+        """ Remove every directory that is neither checked out nor held by another live process """
+        with self._lock:
+            self._scan(self.root)
+            for path in [path for path in self._dirs if self._evictable(path)]:
+                shutil.rmtree(path, ignore_errors=True)
+                self._forget(path)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._scan(self.root)
+            return {
+                "root": self.root,
+                "on_tmpfs": self.on_tmpfs,
+                "max_bytes": self.max_bytes,
+                "used_bytes": self._used,
+                "dirs": len(self._dirs),
+                "in_use_dirs": sum(1 for path in self._dirs if not self._evictable(path)),
+            }
+
+
+scratch_space = ScratchSpace()
@@ -0,0 +1,14 @@
+from .config import STAGE_CACHE_DIRNAME, STAGE_CACHE_MAX_BYTES
+from .preview_cache import PreviewCache
+
+
+class StageCache(PreviewCache):
+    """ On-disk cache of the output of every stage of the modify pipeline (rebuilding, then each gifsicle/ImageMagick/apngopt pass), stored as files named after their keys.\n
+        The key of a stage chains the key of its input with its own parameters, so changing one parameter only re-runs the stage it belongs to and the ones after it
+    """
+
+    def __init__(self, dirname: str = STAGE_CACHE_DIRNAME, max_bytes: int = STAGE_CACHE_MAX_BYTES):
+        super().__init__(dirname, max_bytes)
+
+
+stage_cache = StageCache()
@@ -3,14 +3,23 @@ import shutil
 import time
 import subprocess
 import json
-from typing import List, Tuple, Dict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict, Callable, Iterable, Iterator
 
 from PIL import Image
 from PIL.GifImagePlugin import GifImageFile
 from apng import APNG
 
-from .config import ABS_CACHE_PATH, ABS_TEMP_PATH, imager_exec_path
+from .config import ABS_CACHE_PATH, ABS_TEMP_PATH
+from .imager_backends import imager_exec_path
 from .criterion import CreationCriteria, SplitCriteria, ModificationCriteria
+from .gif_reader import iter_gif_delays
+from .png_reader import read_apng_chunks
+from .cancellation import active_token, activated
+from .process_runner import run_process, wait_for
+from .scratch import scratch_space
+from .instrumentation import active_profiler, profiling
 # from .create_ops import create_aimg
 # from .split_ops import split_aimg
 
@@ -77,9 +86,12 @@ def _filter_images(image_paths, option="static"):
 #     _purge_directory(abs_temp_path)
 
 
-def _purge_directory(target_folder):
+def _purge_directory(target_folder, keep: List[str] = None):
+    keep = keep or []
     for stuff in os.listdir(target_folder):
         stuff_path = os.path.join(target_folder, stuff)
+        if stuff_path in keep:
+            continue
         try:
             name, ext = os.path.splitext(stuff_path)
             if os.path.isfile(stuff_path) and ext:
@@ -91,14 +103,8 @@ def _purge_directory(target_folder):
 
 
 def _mk_temp_dir(prefix_name: str = ''):
-    """ Creates a directory for temporary storage inside cache/, and then returns its absolute path """
-    dirname = str(int(round(time.time() * 1000)))
-    if prefix_name:
-        dirname = f"{prefix_name}_{dirname}"
-    temp_dir = os.path.join(ABS_CACHE_PATH(), dirname)
-    # raise Exception(temp_dir, os.getcwd())
-    os.mkdir(temp_dir)
-    return temp_dir
+    """ Creates a uniquely named directory for temporary storage in the scratch space, and then returns its absolute path """
+    return scratch_space.mkdir(prefix_name)
 
 
 def _unoptimize_gif(gif_path, out_dir, decoder: str) -> str:
@@ -107,12 +113,11 @@ def _unoptimize_gif(gif_path, out_dir, decoder: str) -> str:
     unop_gif_save_path = os.path.join(out_dir, os.path.basename(gif_path))
     imager_path = imager_exec_path(decoder)
     if decoder == 'imagemagick':
-        args = [imager_path, "-coalesce", f'"{gif_path}"', f'"{unop_gif_save_path}"']
+        args = [imager_path, gif_path, "-coalesce", unop_gif_save_path]
     elif decoder == 'gifsicle':
-        args = [imager_path, "-b", "--unoptimize", f'"{gif_path}"', "--output", f'"{unop_gif_save_path}"']
-    cmd = ' '.join(args)
-    # print(cmd)
-    subprocess.run(cmd, shell=True)
+        args = [imager_path, "-b", "--unoptimize", gif_path, "--output", unop_gif_save_path]
+    # print(args)
+    run_process(args)
     return unop_gif_save_path
 
 
@@ -122,8 +127,7 @@ def _reduce_color(gif_path, out_dir, color: int = 256) -> str:
     gifsicle_path = imager_exec_path('gifsicle')
     redux_gif_path = os.path.join(out_dir, os.path.basename(gif_path))
     args = [gifsicle_path, f"--colors={color}", gif_path, "--output", redux_gif_path]
-    cmd = ' '.join(args)
-    subprocess.run(cmd, shell=True)
+    run_process(args)
     return redux_gif_path
 
 
@@ -145,13 +149,9 @@ def _delete_temp_images():
 
 def get_image_delays(image_path, extension: str):
     if extension == 'GIF':
-        with Image.open(image_path) as gif:
-            for i in range(0, gif.n_frames):
-                gif.seek(i)
-                yield gif.info['duration']
+        yield from iter_gif_delays(image_path)
     elif extension == 'PNG':
-        apng = APNG.open(image_path)
-        for png, control in apng.frames:
+        for control in read_apng_chunks(image_path).animation_controls:
             if control:
                 yield control.delay
             else:
@@ -208,7 +208,32 @@ def shout_indices(frame_count: int, percentage_skip: int) -> Dict[int, str]:
     mults = 100 // percentage_skip
     return {round(frame_count / mults * mult): f"{mult * percentage_skip}%" for mult in range(0, mults)}
 
-        
+
+def imap_ordered(func: Callable, items: Iterable, workers: int = 1, prefetch: int = 2) -> Iterator:
+    """ Lazily maps func over items while keeping their order. With more than one worker, the items are processed on a thread pool
+        that reads ahead at most workers * prefetch items, so memory stays bounded no matter how long the sequence is
+    """
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    token = active_token()
+    profiler = active_profiler()
+
+    def _run(item):
+        # The active token and profiler are per-thread, so hand the caller's over to the pool thread
+        with activated(token), profiling(profiler):
+            return func(item)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(_run, item))
+            if len(pending) >= workers * prefetch:
+                yield wait_for(pending.popleft())
+        while pending:
+            yield wait_for(pending.popleft())
+
 
 # def gs_build():
 #     gifsicle_exec = os.path.abspath("./bin/gifsicle-1.92-win64/gifsicle.exe")
@@ -0,0 +1,77 @@
+import time
+import importlib
+import threading
+from typing import Dict, List
+
+from .config import WARMUP_MODULES
+from .imager_backends import imager_backends
+
+
+class EngineWarmup:
+    """ Imports the heavy modules of the engine (Pillow, numpy and the ops modules) and probes the image processing binaries on a background thread,
+        so that the RPC server can be bound as soon as the engine starts.\n
+        Nothing waits for it: a call that needs one of the modules before the warm-up got to it simply imports it itself. status() reports how far it got
+    """
+
+    def __init__(self, modules: List[str] = WARMUP_MODULES):
+        self.modules = modules
+        self.state = "cold"
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        # step name -> seconds taken
+        self.steps: Dict[str, float] = {}
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+
+    def start(self):
+        """ Start warming up on a daemon thread. Only does anything on the first call """
+        with self._lock:
+            if self._thread:
+                return
+            self.state = "warming"
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._warm, name="engine_warmup", daemon=True)
+            self._thread.start()
+
+    def _warm(self):
+        try:
+            for module in self.modules:
+                self._step(module, importlib.import_module, module, __package__.rpartition('.')[0])
+            self._step("imagers", imager_backends.load)
+            self.state = "ready"
+        except Exception as e:
+            self.error = str(e)
+            self.state = "failed"
+        finally:
+            self.finished_at = time.time()
+            self._done.set()
+
+    def _step(self, name: str, func, *args):
+        start = time.perf_counter()
+        func(*args)
+        self.steps[name] = round(time.perf_counter() - start, 4)
+
+    @property
+    def is_finished(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """ Start warming up if it hasn't been, and block until it finishes or timeout seconds pass. Returns whether the engine is ready """
+        self.start()
+        self._done.wait(timeout)
+        return self.state == "ready"
+
+    def status(self) -> Dict:
+        end = self.finished_at or time.time()
+        return {
+            "ready": self.state == "ready",
+            "state": self.state,
+            "error": self.error,
+            "elapsed": round(end - self.started_at, 4) if self.started_at else 0,
+            "steps": dict(self.steps),
+        }
+
+
+engine_warmup = EngineWarmup()
@@ -8,153 +8,363 @@ import math
 import time
 import subprocess
 import tempfile
+import hashlib
 from collections import deque
 from random import choices
 from pprint import pprint
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator, Iterable, Sized, Callable
 from datetime import datetime
 
+import numpy as np
 from PIL import Image
 from apng import APNG, PNG
 
-from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, ABS_CACHE_PATH, imager_exec_path
+from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, ABS_CACHE_PATH, GIF_PALETTE_SAMPLE_PIXELS, GIF_MAX_DELAY, APNG_MAX_DELAY, PNGQUANT_BATCH_SIZE
 from .core_funcs.criterion import CreationCriteria, GIFOptimizationCriteria, APNGOptimizationCriteria, CriteriaBundle
-from .core_funcs.utility import _mk_temp_dir, shout_indices
+from .core_funcs.utility import _mk_temp_dir, shout_indices, imap_ordered
 from .bin_funcs.arg_builder import apngopt_args, pngquant_args
-from .bin_funcs.imager_api import apngopt_render, pngquant_render
+from .core_funcs.gif_writer import GIFAssembler
+from .core_funcs.png_reader import read_apng_chunks
+from .core_funcs.cancellation import checkpoint
+from .core_funcs.instrumentation import stage
+from .core_funcs.scratch import scratch_space
+from .bin_funcs.imager_api import pngquant_render
+from .core_funcs.imager_backends import imager_backends
 
 
-def _create_gifragments(image_paths: List, out_path: str, criteria: CreationCriteria) -> Tuple[str, List[str]]:
-    """ Generate a sequence of GIFs created from the input sequence with the specified criteria, before compiling them into a single animated GIF"""
-    # disposal = 0
-    # if criteria.reverse:
-    #     image_paths.reverse()
-    # temp_gifs = []
-    fcount = len(image_paths)
-    yield {"msg": f"Criteria start frame {criteria.start_frame}"}
+def _transform_image(im: Image.Image, criteria: CreationCriteria) -> Image.Image:
+    """ Flip, resize and rotate an image with the specified criteria """
+    orig_width, orig_height = im.size
+    must_resize = criteria.resize_width != orig_width or criteria.resize_height != orig_height
+    # raise Exception(criteria.resize_width, criteria.resize_height, im.size, must_resize)
+    with stage("transform"):
+        if criteria.flip_h:
+            im = im.transpose(Image.FLIP_LEFT_RIGHT)
+        if criteria.flip_v:
+            im = im.transpose(Image.FLIP_TOP_BOTTOM)
+        if must_resize:
+            resize_method_enum = getattr(Image, criteria.resize_method)
+            im = im.resize((round(criteria.resize_width) , round(criteria.resize_height)), resample=resize_method_enum)
+        if criteria.rotation:
+            im = im.rotate(criteria.rotation, expand=True)
+    return im
+
+
+def _palettize_gifragment(im: Image.Image, transparency, criteria: CreationCriteria) -> Image.Image:
+    """ Convert an image into a palettized GIF frame. Transparent pixels are mapped to palette index 255 """
+    with stage("quantize", "palettize"):
+        return _palettize(im, transparency, criteria)
+
+
+def _quantize_transparent(im: Image.Image, alpha_threshold: int) -> Image.Image:
+    """ Quantize an RGBA image to 255 colors, then map every pixel whose alpha is at or below alpha_threshold to palette index 255 in a single array operation """
+    alpha = np.asarray(im.getchannel('A'))
+    pim = im.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
+    transparent = alpha <= alpha_threshold
+    if transparent.any():
+        indices = np.asarray(pim)
+        pim.frombytes(np.where(transparent, np.uint8(255), indices).tobytes())
+    pim.info['transparency'] = 255
+    return pim
+
+
+def _opaque_rgba(im: Image.Image, criteria: CreationCriteria) -> Image.Image:
+    """ Convert an image to RGBA, composited over black if the criteria does not keep transparency """
+    im = im.convert('RGBA')
+    if not criteria.transparent:
+        black_bg = Image.new("RGBA", size=im.size)
+        black_bg.alpha_composite(im)
+        im = black_bg
+    return im
+
+
+def _sample_palette_colors(im: Image.Image, criteria: CreationCriteria, budget: int) -> np.ndarray:
+    """ Evenly sample about budget RGB pixels out of an image, leaving out the ones that will become transparent """
+    pixels = np.asarray(_opaque_rgba(im, criteria))
+    step = max(math.ceil(math.sqrt(pixels.shape[0] * pixels.shape[1] / budget)), 1)
+    sample = pixels[::step, ::step].reshape(-1, 4)
+    if criteria.transparent:
+        sample = sample[sample[:, 3] > criteria.alpha_threshold]
+    return sample[:, :3]
+
+
+def _sample_frame_colors(item, criteria: CreationCriteria, budget: int) -> np.ndarray:
+    """ Sample the colors of an image path or in-memory frame """
+    if isinstance(item, str):
+        with Image.open(item) as im:
+            with stage("decode"):
+                im.load()
+            return _sample_palette_colors(im, criteria, budget)
+    return _sample_palette_colors(item, criteria, budget)
+
+
+def _build_global_palette(items: List, criteria: CreationCriteria) -> Image.Image:
+    """ Median-cut a single 255-color palette out of a histogram sampled across every frame, given as image paths or in-memory frames.
+        Returns it as a P image to be mapped onto with quantize().\n
+        The palette is padded to 256 entries with copies of its first color, so that index 255 is free for transparency
+    """
+    yield {"msg": "Building global palette..."}
+    budget = max(GIF_PALETTE_SAMPLE_PIXELS // len(items), 1024)
+    shout_nums = shout_indices(len(items), 5)
+    samples = []
+    sampled = imap_ordered(lambda item: _sample_frame_colors(item, criteria, budget), items, criteria.workers)
+    for index, sample in enumerate(sampled):
+        checkpoint()
+        if shout_nums.get(index):
+            yield {"msg": f'Sampling frame colors... ({shout_nums.get(index)})'}
+        samples.append(sample)
+    pixels = np.concatenate(samples)
+    if not len(pixels):
+        pixels = np.zeros((1, 3), dtype=np.uint8)
+    pixels = np.ascontiguousarray(pixels.reshape(-1, 1, 3))
+    with stage("quantize", "global_palette"):
+        palette = Image.fromarray(pixels).quantize(colors=255, method=Image.MEDIANCUT)
+    colors = palette.getpalette()[:255 * 3]
+    palette.putpalette(colors + colors[:3] * (256 - len(colors) // 3))
+    return palette
+
+
+def _map_to_palette(im: Image.Image, palette: Image.Image, criteria: CreationCriteria) -> Image.Image:
+    """ Map an image onto the global palette without dithering, so that unchanged areas keep the same indices from frame to frame """
+    with stage("quantize", "map_palette"):
+        im = _opaque_rgba(im, criteria)
+        pim = im.convert('RGB').quantize(palette=palette, dither=Image.NONE)
+        if criteria.transparent:
+            indices = np.asarray(pim)
+            transparent = np.asarray(im.getchannel('A')) <= criteria.alpha_threshold
+            # Index 255 is a copy of index 0, only transparent pixels may keep it
+            pim.frombytes(np.where(transparent, np.uint8(255), np.where(indices == 255, np.uint8(0), indices)).tobytes())
+            pim.info['transparency'] = 255
+    return pim
+
+
+def _palettize(im: Image.Image, transparency, criteria: CreationCriteria) -> Image.Image:
+    if im.mode == 'RGBA':
+        if criteria.transparent:
+            im = _quantize_transparent(im, criteria.alpha_threshold)
+        else:
+            black_bg = Image.new("RGBA", size=im.size)
+            black_bg.alpha_composite(im)
+            # im.show()
+            im = black_bg
+            # black_bg.show()
+            im = im.convert('P', palette=Image.ADAPTIVE)
+    elif im.mode == 'RGB':
+        im = im.convert('RGB').convert('P', palette=Image.ADAPTIVE)
+    elif im.mode == 'P':
+        if transparency:
+            if type(transparency) is int:
+                im.info['transparency'] = transparency
+            else:
+                im = _quantize_transparent(im.convert('RGBA'), criteria.alpha_threshold)
+    return im
+
+
+def _gifragment(im: Image.Image, criteria: CreationCriteria, palette: Image.Image = None) -> Image.Image:
+    """ Transform and palettize an image with the specified criteria into a GIF frame, mapping it onto the global palette if one is given """
+    transparency = im.info.get("transparency", False)
+    im = _transform_image(im, criteria)
+    if palette:
+        return _map_to_palette(im, palette, criteria)
+    return _palettize_gifragment(im, transparency, criteria)
+
+
+def _create_gifragment(ipath: str, criteria: CreationCriteria, palette: Image.Image = None) -> Image.Image:
+    """ Load a single input image, then transform and palettize it with the specified criteria into an in-memory GIF frame """
+    with Image.open(ipath) as im:
+        im: Image.Image
+        with stage("decode"):
+            im.load()
+        frame = _gifragment(im, criteria, palette)
+        if frame is im:
+            frame = im.copy()
+    return frame
+
+
+def _order_frames(items: List, criteria: CreationCriteria) -> List:
+    """ Shift the sequence so that it begins from the criteria's start frame, then reverse it if needed """
     if criteria.start_frame:
-        shift_items = deque(image_paths)
-        shift = -criteria.start_frame
-        yield {"SHIFT!": shift}
+        shift_items = deque(items)
         shift_items.rotate(-criteria.start_frame)
-        image_paths = list(shift_items)
-    perc_skip = 5
-    shout_nums = shout_indices(fcount, perc_skip)
-    for index, ipath in enumerate(image_paths):
-        if shout_nums.get(index):
-            yield {"msg": f'Processing frames... ({shout_nums.get(index)})'}
-        with Image.open(ipath) as im:
-            im: Image.Image
-            transparency = im.info.get("transparency", False)
-            orig_width, orig_height = im.size
-            must_resize = criteria.resize_width != orig_width or criteria.resize_height != orig_height
-            # raise Exception(criteria.resize_width, criteria.resize_height, im.size, must_resize)
-            alpha = None
-            if criteria.flip_h:
-                im = im.transpose(Image.FLIP_LEFT_RIGHT)
-            if criteria.flip_v:
-                im = im.transpose(Image.FLIP_TOP_BOTTOM)
-            if must_resize:
-                resize_method_enum = getattr(Image, criteria.resize_method)
-                # yield {"resize_method_enum": resize_method_enum}
-                im = im.resize((round(criteria.resize_width) , round(criteria.resize_height)), resample=resize_method_enum)
-            if criteria.rotation:
-                im = im.rotate(criteria.rotation, expand=True)
-            fragment_name = os.path.splitext(f"{str.zfill(str(index), 6)}_{os.path.basename(ipath)}")[0]
-            if criteria.reverse:
-                reverse_index = len(image_paths) - (index + 1)
-                fragment_name = f"rev_{str.zfill(str(reverse_index), 3)}_{fragment_name}"
-            save_path = f'{os.path.join(out_path, fragment_name)}.gif'
-            if im.mode == 'RGBA':
-                if criteria.transparent:
-                    alpha = im.getchannel('A')
-                    im = im.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
-                    mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
-                    im.paste(255, mask)
-                    im.info['transparency'] = 255
-                else:
-                    black_bg = Image.new("RGBA", size=im.size)
-                    black_bg.alpha_composite(im)
-                    # im.show()
-                    im = black_bg
-                    # black_bg.show()
-                    im = im.convert('P', palette=Image.ADAPTIVE)
-                im.save(save_path)
-            elif im.mode == 'RGB':
-                im = im.convert('RGB').convert('P', palette=Image.ADAPTIVE)
-                im.save(save_path)
-            elif im.mode == 'P':
-                if transparency:
-                    if type(transparency) is int:
-                        im.save(save_path, transparency=transparency)
-                    else:
-                        im = im.convert('RGBA')
-                        alpha = im.getchannel('A')
-                        im = im.convert('RGB').convert('P', palette=Image.ADAPTIVE, colors=255)
-                        mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
-                        im.paste(255, mask)
-                        im.info['transparency'] = 255
-                        im.save(save_path)
-                else:
-                    im.save(save_path)
-            # yield {"msg": f"Save path: {save_path}"}
-            # if absolute_paths:
-                # temp_gifs.append(save_path)
-            # else:
-                # temp_gifs.append(os.path.relpath(save_path, os.getcwd()))
+        items = list(shift_items)
+    if criteria.reverse:
+        items = list(reversed(items))
+    return items
 
 
-def _build_gif(image_paths: List, out_full_path: str, crbundle: CriteriaBundle):
-    yield {"CRT IMAGE PATHS": image_paths}
-    gifragment_dir = _mk_temp_dir(prefix_name="tmp_gifrags")
+def _rotate_frames(frames: Iterable, fcount: int, start_frame: int) -> Iterator:
+    """ Lazy version of the shift in _order_frames, for frames that are decoded on the fly. Only the frames before the start frame are held back until the end """
+    shift = start_frame % fcount if start_frame and fcount else 0
+    held = []
+    for frame in frames:
+        if len(held) < shift:
+            held.append(frame)
+            continue
+        yield frame
+    yield from held
+
+
+def _merge_identical_frames(frames: Iterator, delay: int, max_delay: int, key: Callable = None) -> Iterator[Tuple[object, int, int]]:
+    """ Pair up every frame with its delay and the number of input frames it stands for.\n
+        With a key function, runs of consecutive frames with equal keys are merged into their first frame, whose delay becomes the sum of the run's delays (up to max_delay)
+    """
+    run_frame, run_key, run_delay, run_count = None, None, 0, 0
+    for frame in frames:
+        frame_key = key(frame) if key else None
+        if run_count and key and frame_key == run_key and run_delay + delay <= max_delay:
+            run_delay += delay
+            run_count += 1
+            continue
+        if run_count:
+            yield run_frame, run_delay, run_count
+        run_frame, run_key, run_delay, run_count = frame, frame_key, delay, 1
+    if run_count:
+        yield run_frame, run_delay, run_count
+
+
+def _gifragment_key(im: Image.Image) -> bytes:
+    digest = hashlib.blake2b(im.tobytes(), digest_size=16)
+    digest.update(bytes(im.getpalette() or []))
+    digest.update(str(im.info.get("transparency")).encode())
+    return digest.digest()
+
+
+def _png_key(png_bytes: bytes) -> bytes:
+    return hashlib.blake2b(png_bytes, digest_size=16).digest()
+
+
+def _assemble_gif(gifragments: Iterator[Image.Image], fcount: int, out_full_path: str, crbundle: CriteriaBundle):
+    """ Splice palettized in-memory frames into a single animated GIF, and stream it through gifsicle over stdin along with the optimization criteria """
     criteria = crbundle.create_aimg
     gif_criteria = crbundle.gif_opt
-    yield from _create_gifragments(image_paths, gifragment_dir, criteria)
-    executable = str(imager_exec_path('gifsicle'))
+    shout_nums = shout_indices(fcount, 5)
+    if criteria.workers > 1:
+        yield {"msg": f"Processing frames with {criteria.workers} workers..."}
+    assembler = GIFAssembler(loop_count=criteria.loop_count, share_color_table=criteria.global_palette)
     delay = int(criteria.delay * 100)
-    disposal = "background"
-    loop_arg = "--loopcount"
-    opti_mode = "--unoptimize"
-    colorspace_arg = ""
-    lossy_arg = ""
-    if (not criteria.loop_count or criteria.loop_count == 0):
-        loop_arg = "--loopcount"
-    elif (criteria.loop_count == 1):
-        loop_arg = '--no-loopcount'
-    elif (criteria.loop_count > 1):
-        loop_arg = f'--loopcount={criteria.loop_count - 1}'
-    globstar_path = "*.gif"
-
-    if gif_criteria:
-        if gif_criteria.is_optimized and gif_criteria.optimization_level:
-            opti_mode = f"--optimize={gif_criteria.optimization_level}"
-        if gif_criteria.is_lossy and gif_criteria.lossy_value:
-            lossy_arg = f"--lossy={gif_criteria.lossy_value}"
-        if gif_criteria.is_reduced_color and gif_criteria.color_space:
-            colorspace_arg = f"--colors={gif_criteria.color_space}"
-
-    ROOT_PATH = str(os.getcwd())
-    if os.getcwd() != gifragment_dir:
-        yield {"msg": f"Changing directory from {os.getcwd()} to {gifragment_dir}"}
-        os.chdir(gifragment_dir)
-    yield {"msg": f"Obtained gifsicle exec path: {executable}"}
-    args = [executable, opti_mode, lossy_arg, colorspace_arg, f"--delay={delay}", f"--disposal={disposal}", loop_arg, globstar_path, "--output", f'"{out_full_path}"']
-    cmd = ' '.join(args)
-    yield {"cmd": cmd}
-    # yield {"shlexed cmd": cmd}
+    merged = _merge_identical_frames(gifragments, delay, GIF_MAX_DELAY, _gifragment_key if criteria.merge_identical else None)
+    consumed = 0
+    for im, frame_delay, run_count in merged:
+        checkpoint()
+        shout = next((shout_nums[index] for index in range(consumed, consumed + run_count) if index in shout_nums), None)
+        if shout:
+            yield {"msg": f'Processing frames... ({shout})'}
+        consumed += run_count
+        with stage("encode", "gif_frame"):
+            assembler.append(im, frame_delay)
+    if len(assembler.frame_blocks) < fcount:
+        yield {"msg": f"Merged {fcount} frames into {len(assembler.frame_blocks)}"}
     yield {"msg": "Combining frames..."}
-    result = subprocess.run(cmd, shell=True, capture_output=True)
-    yield {"gifsicle STDOUT": result.stdout.decode('utf-8')}
-    yield {"gifsicle STDERR": result.stderr.decode('utf-8')}
-    # if result.stderr:
-    #     raise Exception(result.stderr)
-    os.chdir(ROOT_PATH)
-    # shutil.rmtree(gifragment_dir)
+    with stage("encode", "gif"):
+        gif_bytes = assembler.to_bytes()
+    # Always passed through gifsicle, as its LZW encoder compresses tighter than Pillow's
+    sicle_args = _gif_opt_args(criteria, gif_criteria)
+    job_size = assembler.width * assembler.height * len(assembler.frame_blocks)
+    out_full_path = yield from imager_backends.run("optimize_gif", job_size, sicle_args, gif_bytes, out_full_path)
     yield {"preview_path": out_full_path}
     yield {"CONTROL": "CRT_FINISH"}
     return out_full_path
 
 
+def _build_gif(image_paths: List, out_full_path: str, crbundle: CriteriaBundle):
+    """ Build a GIF out of a sequence of image paths. Frames are transformed and palettized in memory, disk is only touched for the final output """
+    yield {"CRT IMAGE PATHS": image_paths}
+    criteria = crbundle.create_aimg
+    image_paths = _order_frames(image_paths, criteria)
+    palette = None
+    if criteria.global_palette:
+        palette = yield from _build_global_palette(image_paths, criteria)
+    gifragments = imap_ordered(lambda ipath: _create_gifragment(ipath, criteria, palette), image_paths, criteria.workers)
+    out_full_path = yield from _assemble_gif(gifragments, len(image_paths), out_full_path, crbundle)
+    return out_full_path
+
+
+def _transform_png(ipath: str, criteria: CreationCriteria) -> bytes:
+    """ Resize, flip and rotate a single input image with the specified criteria. Returns the PNG-encoded bytes of the result """
+    with io.BytesIO() as bytebox:
+        with Image.open(ipath) as im:
+            im: Image.Image
+            with stage("decode"):
+                if im.mode == 'P':
+                    # APNG frames cannot have palettes of their own
+                    im = im.convert("RGBA")
+                else:
+                    im.load()
+            im = _transform_image(im, criteria)
+            with stage("encode", "png"):
+                im.save(bytebox, "PNG")
+        return bytebox.getvalue()
+
+
+def _encode_apng_frame(im: Image.Image, criteria: CreationCriteria) -> Tuple[bytes, int]:
+    """ Transform an in-memory frame, and return it as PNG bytes along with its pixel count """
+    im = _transform_image(im, criteria)
+    with stage("encode", "png"), io.BytesIO() as bytebox:
+        im.save(bytebox, "PNG")
+        return bytebox.getvalue(), im.width * im.height
+
+
+def _quantize_png_stream(encoded_frames: Iterator[Tuple[bytes, int]], pq_args, batch_size: int = PNGQUANT_BATCH_SIZE) -> Iterator[bytes]:
+    """ Quantize a stream of PNG-encoded frames with PNGQuant, batch_size frames per invocation with up to one invocation per CPU running at once.
+        Only the batches being quantized are written to a scratch directory. The quantized frames are converted back to RGBA, as APNG frames cannot have palettes of their own
+    """
+    quant_dir = _mk_temp_dir(prefix_name="quant_stream")
+
+    def write_batches() -> Iterator[Tuple[List[str], int]]:
+        batch, batch_pixels = [], 0
+        for sequence, (png_bytes, pixels) in enumerate(encoded_frames):
+            path = os.path.join(quant_dir, f"{sequence:06d}.png")
+            with stage("write", "png"), open(path, "wb") as png_file:
+                png_file.write(png_bytes)
+            batch.append(path)
+            batch_pixels += pixels
+            if len(batch) == batch_size:
+                yield batch, batch_pixels
+                batch, batch_pixels = [], 0
+        if batch:
+            yield batch, batch_pixels
+
+    try:
+        quantized = imap_ordered(lambda job: imager_backends.run("quantize_png", job[1], pq_args, job[0]), write_batches(), os.cpu_count() or 1)
+        for batch in quantized:
+            for path in batch:
+                png_bytes = _read_png(path)
+                os.remove(path)
+                yield png_bytes
+    finally:
+        scratch_space.release(quant_dir)
+
+
+def _apng_job_size(apng_path: str) -> int:
+    chunks = read_apng_chunks(apng_path)
+    return chunks.width * chunks.height * max(len(chunks.animation_controls), 1)
+
+
+def _read_png(ipath: str) -> bytes:
+    with stage("decode", "png_file"), open(ipath, "rb") as png_file:
+        return png_file.read()
+
+
+def _assemble_apng(png_bytes: Iterator[bytes], fcount: int, criteria: CreationCriteria) -> APNG:
+    """ Append PNG-encoded frames to a new APNG with the criteria's delay, merging runs of identical frames if the criteria asks for it """
+    apng = APNG()
+    shout_nums = shout_indices(fcount, 5)
+    delay = int(criteria.delay * 1000)
+    merged = _merge_identical_frames(png_bytes, delay, APNG_MAX_DELAY, _png_key if criteria.merge_identical else None)
+    consumed = 0
+    for pbytes, frame_delay, run_count in merged:
+        checkpoint()
+        shout = next((shout_nums[index] for index in range(consumed, consumed + run_count) if index in shout_nums), None)
+        if shout:
+            yield {"msg": f'Processing frames... ({shout})'}
+        consumed += run_count
+        with stage("encode", "apng_frame"):
+            apng.append(PNG.from_bytes(pbytes), delay=frame_delay)
+    if len(apng.frames) < fcount:
+        yield {"msg": f"Merged {fcount} frames into {len(apng.frames)}"}
+    return apng
+
+
 def _build_apng(image_paths, out_full_path, crbundle: CriteriaBundle) -> APNG:
     criteria = crbundle.create_aimg
     aopt_criteria = crbundle.apng_opt
@@ -162,61 +372,103 @@ def _build_apng(image_paths, out_full_path, crbundle: CriteriaBundle) -> APNG:
     aopt_args = apngopt_args(aopt_criteria) if aopt_criteria else []
     pq_args = pngquant_args(aopt_criteria) if aopt_criteria else []
 
+    with Image.open(image_paths[0]) as first_im:
+        first_width, first_height = first_im.size
+    first_must_resize = criteria.resize_width != first_width or criteria.resize_height != first_height
+    must_transform = criteria.flip_h or criteria.flip_v or first_must_resize or criteria.rotation
+
     if pq_args:
         qtemp_dir = _mk_temp_dir(prefix_name="quant_temp")
         temp_dirs.append(qtemp_dir)
-        image_paths = yield from pngquant_render(pq_args, image_paths, optional_out_path=qtemp_dir)
+        # The transform step converts the palette PNGs to RGBA by itself, so the quantized frames only need to be re-saved as RGBA without it
+        image_paths = yield from pngquant_render(pq_args, image_paths, optional_out_path=qtemp_dir, keep_palette=must_transform)
 
     if criteria.reverse:
         image_paths.reverse()
     
-    apng = APNG()
-    first_width, first_height = Image.open(image_paths[0]).size
-    first_must_resize = criteria.resize_width != first_width or criteria.resize_height != first_height
-    shout_nums = shout_indices(len(image_paths), 5)
     yield criteria.__dict__
-    if criteria.flip_h or criteria.flip_v or first_must_resize or criteria.rotation:
-        for index, ipath in enumerate(image_paths):
-            if shout_nums.get(index):
-                yield {"msg": f'Processing frames... ({shout_nums.get(index)})'}
-            with io.BytesIO() as bytebox:
-                with Image.open(ipath) as im:
-                    # im = Image.open(ipath)
-                    im: Image.Image
-                    orig_width, orig_height = im.size
-                    must_resize = criteria.resize_width != orig_width or criteria.resize_height != orig_height
-                    if must_resize:
-                        resize_method_enum = getattr(Image, criteria.resize_method)
-                        # yield {"resize_method_enum": resize_method_enum}
-                        im = im.resize((round(criteria.resize_width), round(criteria.resize_height)), resize_method_enum)
-                    if criteria.flip_h:
-                        im = im.transpose(Image.FLIP_LEFT_RIGHT)
-                    if criteria.flip_v:
-                        im = im.transpose(Image.FLIP_TOP_BOTTOM)
-                    if criteria.rotation:
-                        im = im.rotate(criteria.rotation, expand=True)
-                    im.save(bytebox, "PNG")
-                apng.append(PNG.from_bytes(bytebox.getvalue()), delay=int(criteria.delay * 1000))
+    if must_transform:
+        if criteria.workers > 1:
+            yield {"msg": f"Processing frames with {criteria.workers} workers..."}
+        png_bytes = imap_ordered(lambda ipath: _transform_png(ipath, criteria), image_paths, criteria.workers)
+        apng = yield from _assemble_apng(png_bytes, len(image_paths), criteria)
         yield {"msg": "Saving APNG...."}
-        apng.num_plays = criteria.loop_count
-        apng.save(out_full_path)
     else:
+        png_bytes = imap_ordered(_read_png, image_paths)
+        apng = yield from _assemble_apng(png_bytes, len(image_paths), criteria)
         yield {"msg": "Saving APNG..."}
-        apng = APNG.from_files(image_paths, delay=int(criteria.delay * 1000))
-        apng.num_plays = criteria.loop_count
+    apng.num_plays = criteria.loop_count
+    with stage("write", "apng"):
         apng.save(out_full_path)
     
     if aopt_args:
-        out_full_path = yield from apngopt_render(aopt_args, out_full_path, out_full_path)
+        out_full_path = yield from imager_backends.run("optimize_apng", _apng_job_size(out_full_path), aopt_args, out_full_path, out_full_path)
 
-    # for td in temp_dirs:
-    #     shutil.rmtree(td)
+    for td in temp_dirs:
+        scratch_space.release(td)
     yield {"preview_path": out_full_path}
     yield {"CONTROL": "CRT_FINISH"}
 
     return out_full_path
 
 
+def _gif_opt_args(criteria: CreationCriteria, gif_criteria: GIFOptimizationCriteria) -> List[Tuple[str, str]]:
+    """ Gifsicle arguments for the optimization, lossy and color reduction criteria of a newly created GIF """
+    args = []
+    if gif_criteria:
+        if gif_criteria.is_optimized and gif_criteria.optimization_level:
+            args.append((f"--optimize={gif_criteria.optimization_level}", f"Optimizing GIF with level {gif_criteria.optimization_level}..."))
+        if gif_criteria.is_lossy and gif_criteria.lossy_value:
+            args.append((f"--lossy={gif_criteria.lossy_value}", f"Lossy compressing with value: {gif_criteria.lossy_value}..."))
+        if gif_criteria.is_reduced_color and gif_criteria.color_space:
+            args.append((f"--colors={gif_criteria.color_space}", f"Reducing colors to: {gif_criteria.color_space}..."))
+    return args
+
+
+def _build_gif_frames(frames: Sized, out_full_path: str, crbundle: CriteriaBundle):
+    """ Build a GIF out of in-memory frames, streaming them through the transform and assembly one at a time. Disk is only touched for the final output.\n
+        frames is iterated over a second time to sample the global palette. Reversing holds on to every palettized frame, instead of the decoded ones
+    """
+    criteria = crbundle.create_aimg
+    palette = None
+    if criteria.global_palette:
+        palette = yield from _build_global_palette(frames, criteria)
+    ordered_frames = _rotate_frames(frames, len(frames), criteria.start_frame)
+    gifragments = imap_ordered(lambda fr: _gifragment(fr, criteria, palette), ordered_frames, criteria.workers)
+    if criteria.reverse:
+        gifragments = reversed(list(gifragments))
+    out_full_path = yield from _assemble_gif(gifragments, len(frames), out_full_path, crbundle)
+    return out_full_path
+
+
+def _build_apng_frames(frames: Sized, out_full_path: str, crbundle: CriteriaBundle):
+    """ Build an APNG out of in-memory frames, streaming them through the transform and assembly one at a time. Disk is only touched for the final output.\n
+        Reversing holds on to every encoded PNG, instead of the decoded frames
+    """
+    criteria = crbundle.create_aimg
+    aopt_criteria = crbundle.apng_opt
+    aopt_args = apngopt_args(aopt_criteria) if aopt_criteria else []
+    pq_args = pngquant_args(aopt_criteria) if aopt_criteria else []
+    encoded_frames = imap_ordered(lambda fr: _encode_apng_frame(fr, criteria), frames, criteria.workers)
+    if pq_args:
+        yield {"msg": "Quantizing PNG..."}
+        png_bytes = _quantize_png_stream(encoded_frames, pq_args)
+    else:
+        png_bytes = (png_bytes for png_bytes, pixels in encoded_frames)
+    if criteria.reverse:
+        png_bytes = reversed(list(png_bytes))
+    apng = yield from _assemble_apng(png_bytes, len(frames), criteria)
+    yield {"msg": "Saving APNG..."}
+    apng.num_plays = criteria.loop_count
+    with stage("write", "apng"):
+        apng.save(out_full_path)
+    if aopt_args:
+        out_full_path = yield from imager_backends.run("optimize_apng", _apng_job_size(out_full_path), aopt_args, out_full_path, out_full_path)
+    yield {"preview_path": out_full_path}
+    yield {"CONTROL": "CRT_FINISH"}
+    return out_full_path
+
+
 def create_aimg(image_paths: List[str], out_dir: str, filename: str, crbundle: CriteriaBundle):
     """ Umbrella generator for creating animated images from a sequence of images """
     abs_image_paths = [os.path.abspath(ip) for ip in image_paths if os.path.exists(ip)]
@@ -242,3 +494,22 @@ def create_aimg(image_paths: List[str], out_dir: str, filename: str, crbundle: C
     elif img_format == 'PNG':
         out_full_path = os.path.join(out_dir, f"{filename}.png")
         return _build_apng(img_paths, out_full_path, crbundle)
+
+
+def create_aimg_frames(frames: Sized, out_dir: str, filename: str, crbundle: CriteriaBundle):
+    """ Umbrella generator for creating animated images from a sequence of in-memory PIL.Image.Images, such as the FrameSequence of split_aimg_frames """
+    img_format = crbundle.create_aimg.extension
+    if len(frames) < 2:
+        raise Exception(f"At least 2 images is needed for an animated {img_format}!")
+    fname, ext = os.path.splitext(filename)
+    if ext:
+        filename = fname
+    out_dir = os.path.abspath(out_dir)
+    if not os.path.exists(out_dir):
+        raise Exception(f"The specified absolute out_dir does not exist!\n{out_dir}")
+    if img_format == 'GIF':
+        out_full_path = os.path.join(out_dir, f"{filename}.gif")
+        return _build_gif_frames(frames, out_full_path, crbundle)
+    elif img_format == 'PNG':
+        out_full_path = os.path.join(out_dir, f"{filename}.png")
+        return _build_apng_frames(frames, out_full_path, crbundle)
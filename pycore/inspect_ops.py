@@ -13,67 +13,69 @@ from apng import APNG
 
 from .core_funcs.config import IMG_EXTS, STATIC_IMG_EXTS, ANIMATED_IMG_EXTS
 from .core_funcs.utility import _filter_images, read_filesize, shout_indices, sequence_nameget
+from .core_funcs.inspect_cache import inspection_cache
+from .core_funcs.gif_reader import GIFBlocks, read_gif_blocks
+from .core_funcs.png_reader import APNGChunks, read_apng_chunks
 
 
 def inspect_general(image_path, filter_on="", skip=False) -> Dict:
-    """ Main single image inspection handler function.
+    """ Main single image inspection handler function. Results are served from the inspection cache when the file has not changed.
     :param `image_path`: Input path.
     :param `filter_on`: "" no filter, "static": "Throws error on detecting an animated image", "animated": "Throws error on detecting a static image"
     :param `skip`: Returns an empty dict instead of throwing an error. Used in conjuntion with fitler_on
     """
     abspath = os.path.abspath(image_path)
+    info = inspection_cache.get(abspath)
+    if info is None:
+        info = _inspect_uncached(abspath)
+        if info:
+            inspection_cache.put(abspath, info)
+    if not info:
+        return info
+    gen_info = info['general_info']
+    filename = gen_info['name']['value']
+    base_fname = os.path.splitext(filename)[0]
+    fmt = gen_info['format']['value']
+    if gen_info['is_animated']['value'] and filter_on == "static":
+        if skip:
+            return {}
+        elif fmt == 'PNG':
+            raise Exception(f"The APNG ({filename}) is not static!")
+        else:
+            raise Exception(f"The {fmt} {base_fname} is not static!")
+    elif not gen_info['is_animated']['value'] and filter_on == "animated" and fmt in ('GIF', 'PNG'):
+        if skip:
+            return {}
+        else:
+            raise Exception(f"The {fmt} {base_fname} is not animated!")
+    return info
+
+
+def _inspect_uncached(abspath: str) -> Dict:
+    """ Inspects an image by its absolute path, dispatching to the static, animated GIF or APNG inspection """
     filename = str(os.path.basename(abspath))
     base_fname, ext = os.path.splitext(filename)
     ext = ext.lower()
     if ext == '.gif':
         try:
-            gif: Image = Image.open(abspath)
+            blocks = read_gif_blocks(abspath, keep_image_data=False)
         except Exception:
             raise Exception(f'The chosen file ({filename}) is not a valid GIF image')
-            
-        # raise Exception(gif.is_animated, filter_on, skip)
-        if gif.format == 'GIF':
-            if gif.is_animated:
-                if filter_on == "static":
-                    if skip:
-                        return {}
-                    else:
-                        raise Exception(f"The GIF {base_fname} is not static!")
-                else:
-                    return _inspect_agif(image_path, gif)
-            else:
-                if filter_on == "animated":
-                    if skip:
-                        return {}
-                    else:
-                        raise Exception(f"The GIF {base_fname} is not animated!")
-                else:
-                    return _inspect_simg(image_path)
+        if len(blocks.frames) > 1:
+            return _inspect_agif(abspath, blocks)
+        else:
+            return _inspect_simg(abspath)
     elif ext == '.png':
         try:
-            apng: APNG = APNG.open(abspath)
+            chunks = read_apng_chunks(abspath)
         except Exception:
             raise Exception(f'The chosen file ({filename}) is not a valid PNG image')
-        frames = apng.frames
-        frame_count = len(frames)
-        if frame_count > 1:
-            if filter_on == "static":
-                if skip:
-                    return {}
-                else:
-                    raise Exception(f"The APNG ({filename}) is not static!")
-            else:
-                return _inspect_apng(image_path, apng)
+        if len(chunks.frame_controls) > 1:
+            return _inspect_apng(abspath, chunks)
         else:
-            if filter_on == "animated":
-                if skip:
-                    return {}
-                else:
-                    raise Exception(f"The PNG {base_fname} is not animated!")
-            else:
-                return _inspect_simg(image_path)
+            return _inspect_simg(abspath)
     else:
-        return _inspect_simg(image_path)
+        return _inspect_simg(abspath)
 
 
 def _inspect_simg(image):
@@ -130,15 +132,16 @@ def _inspect_simg(image):
     return img_metadata
 
 
-def _inspect_agif(abspath: str, gif: Image):
+def _inspect_agif(abspath: str, blocks: GIFBlocks):
+    """ Returns information of an animated GIF, read from its blocks without decoding any frame """
     filename = str(os.path.basename(abspath))
     base_fname, ext = os.path.splitext(filename)
     base_fname = sequence_nameget(base_fname)
-    width, height = gif.size
-    frame_count = gif.n_frames
+    width, height = blocks.width, blocks.height
+    frame_count = len(blocks.frames)
     fsize = os.stat(abspath).st_size
     fsize_hr = read_filesize(fsize)
-    loop_info = gif.info.get('loop')
+    loop_info = blocks.loop
     if loop_info == None:
         loop_count = 1
     elif loop_info == 0:
@@ -147,10 +150,15 @@ def _inspect_agif(abspath: str, gif: Image):
         loop_count = loop_info + 1
     delays = []
     comments = []
-    for f in range(0, gif.n_frames):
-        gif.seek(f)
-        delays.append(gif.info['duration'])
-        comments.append(gif.info.get('comment', ""))
+    comment = ""
+    transparency = "No"
+    for frame in blocks.frames:
+        delays.append(frame.delay * 10)
+        # Like Pillow's frame info, comments and transparency stay in effect until a later frame overrides them
+        comment = frame.comment or comment
+        comments.append(comment)
+        if frame.transparency is not None:
+            transparency = frame.transparency
     min_duration = min(delays)
     if min_duration == 0:
         frame_count_ds = frame_count
@@ -162,8 +170,8 @@ def _inspect_agif(abspath: str, gif: Image):
     fps = round(1000.0 / avg_delay, 3) if avg_delay != 0 else 0
     loop_duration = round(frame_count / fps, 3) if fps != 0 else 0
     fmt = 'GIF'
-    full_format = str(gif.info.get('version') or "")
-    transparency = gif.info.get('transparency', "No")
+    # Same representation as Pillow's info['version']
+    full_format = str(f"GIF{blocks.version}".encode("ascii"))
     # alpha = gif.getchannel('A')
     image_info = {
         "general_info": {
@@ -192,25 +200,23 @@ def _inspect_agif(abspath: str, gif: Image):
             "loop_count": {"value": loop_count, "label": "Loop count"},
         }
     }
-    gif.close()
     return image_info
 
 
-def _inspect_apng(abspath, apng: APNG):  
+def _inspect_apng(abspath, chunks: APNGChunks):
+    """ Returns information of an APNG, read from its chunks without decompressing any frame """
     filename = str(os.path.basename(abspath))
     base_fname, ext = os.path.splitext(filename)
     base_fname = sequence_nameget(base_fname)
-    frames = apng.frames
-    frame_count = len(frames)
-    loop_count = apng.num_plays
-    png_one, controller_one = frames[0]
+    frame_controls = chunks.animation_controls
+    frame_count = len(frame_controls)
+    loop_count = chunks.num_plays
     fmt = 'PNG'
     fsize = os.stat(abspath).st_size
     fsize_hr = read_filesize(fsize)
-    width = png_one.width
-    height = png_one.height
-    # raise Exception(frames)
-    delays = [f[1].delay if f[1] else 0 for f in frames]
+    width = chunks.width
+    height = chunks.height
+    delays = [fc.delay if fc else 0 for fc in frame_controls]
     min_duration = min(delays)
     if min_duration == 0:
         frame_count_ds = frame_count
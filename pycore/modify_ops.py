@@ -11,23 +11,32 @@ from pprint import pprint
 from urllib.parse import urlparse
 from typing import List, Dict, Tuple
 from datetime import datetime
+from copy import copy
 
 from PIL import Image
 from apng import APNG, PNG
 
-from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, ABS_CACHE_PATH, ABS_TEMP_PATH, imager_exec_path
-from .core_funcs.criterion import CriteriaBundle, CreationCriteria, SplitCriteria, ModificationCriteria, APNGOptimizationCriteria
+from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, ABS_CACHE_PATH, ABS_TEMP_PATH, GIF_ALPHA_THRESHOLD
+from .core_funcs.criterion import CriteriaBundle, CreationCriteria, SplitCriteria, ModificationCriteria, APNGOptimizationCriteria, PreviewCriteria
 from .core_funcs.utility import _mk_temp_dir, _reduce_color, _unoptimize_gif, _log, shout_indices
+from .core_funcs.gif_reader import read_gif_blocks, iter_gif_delays
+from .core_funcs.gif_writer import GIFAssembler
+from .core_funcs.png_reader import read_apng_chunks
+from .core_funcs.cancellation import checkpoint
+from .core_funcs.instrumentation import stage
+from .core_funcs.scratch import scratch_space
+from .core_funcs.preview_cache import preview_cache
+from .core_funcs.stage_cache import stage_cache
 from .bin_funcs.imager_api import gifsicle_render, imagemagick_render, apngopt_render, pngquant_render
 from .bin_funcs.arg_builder import gifsicle_args, imagemagick_args, apngopt_args, pngquant_args
-from .create_ops import create_aimg
-from .split_ops import split_aimg, _fragment_gif_frames, _fragment_apng_frames
+from .create_ops import create_aimg, create_aimg_frames, _quantize_transparent
+from .split_ops import split_aimg, split_aimg_frames, _fragment_gif_frames, _fragment_apng_frames, _gif_frame_iterator, _apng_frame_iterator
 
 
 def rebuild_aimg(img_path: str, out_dir: str, crbundle: CriteriaBundle):
+    """ Splits the animated image into in-memory frames and creates a new one out of them, streaming the frames from the decoder to the assembly. Disk is only touched for the final output """
     mod_criteria = crbundle.modify_aimg
     apngopt_criteria = crbundle.apng_opt
-    frames_dir = _mk_temp_dir(prefix_name="rebuild_aimg")
     # is_unoptimized = mod_criteria.is_unoptimized or mod_criteria.apng_is_unoptimized or mod_criteria.change_format()
     split_criteria = SplitCriteria({
         'pad_count': 6,
@@ -37,15 +46,10 @@ def rebuild_aimg(img_path: str, out_dir: str, crbundle: CriteriaBundle):
         "new_name": "",
         "will_generate_delay_info": False,
     })
-    frame_paths = yield from split_aimg(img_path, frames_dir, split_criteria)
-    yield {"MOD split frames": frame_paths}
+    frames = yield from split_aimg_frames(img_path, split_criteria)
+    yield {"MOD split frames": len(frames)}
     # if mod_criteria.is_reversed:
     #     frames.reverse()
-    pq_args = pngquant_args(apngopt_criteria)
-    if mod_criteria.format == 'PNG' and pq_args:
-        yield {"DEBUG": "PNG QUANTIZATION SELECTED"}
-        frame_paths = yield from pngquant_render(pq_args, frame_paths)
-        yield {"QUANTPATHS": frame_paths}
     ds_fps = mod_criteria.orig_frame_count_ds / mod_criteria.orig_loop_duration
     # ds_delay = 1 / ds_fps
     ds_delay = mod_criteria.delay
@@ -66,17 +70,80 @@ def rebuild_aimg(img_path: str, out_dir: str, crbundle: CriteriaBundle):
         'start_frame': 1,
         'reverse': mod_criteria.is_reversed,
         'rotation': mod_criteria.rotation,
+        'workers': mod_criteria.workers,
+        'alpha_threshold': mod_criteria.alpha_threshold,
+        'global_palette': mod_criteria.global_palette,
+        'merge_identical': mod_criteria.merge_identical,
     })
     yield {"e": create_criteria.name}
+    # Only the lossy part of the APNG criteria is applied here, apngopt is run later by modify_aimg
+    quant_criteria = APNGOptimizationCriteria({
+        'apng_is_optimized': False,
+        'apng_optimization_level': 0,
+        'apng_is_lossy': apngopt_criteria.is_lossy,
+        'apng_lossy_value': apngopt_criteria.lossy_value,
+        'apng_is_unoptimized': False,
+    })
+    if mod_criteria.format == 'PNG' and quant_criteria.must_opt():
+        yield {"DEBUG": "PNG QUANTIZATION SELECTED"}
     crbundle = CriteriaBundle({
-        "create_aimg": create_criteria
+        "create_aimg": create_criteria,
+        "apng_opt": quant_criteria,
     })
-    new_image_path = yield from create_aimg(frame_paths, out_dir, create_criteria.name, crbundle)
+    new_image_path = yield from create_aimg_frames(frames, out_dir, create_criteria.name, crbundle)
     yield {"new_image_path": new_image_path}
     return new_image_path
 
 
+_UNKEYED_FIELDS = ('name', 'orig_name', 'orig_base_name', 'workers')
+
+
+def _cached_stage(stage_key: str, ext: str, description: str, render):
+    """ Run one stage of the modify pipeline, unless its output for the same input and parameters is already cached.\n
+        render(work_dir) is a generator that writes the output of the stage into work_dir and returns its path. Returns the path of the cached output
+    """
+    cached_path = stage_cache.get(stage_key, ext)
+    if cached_path:
+        yield {"msg": f"{description} (cached)"}
+        return cached_path
+    work_dir = _mk_temp_dir(prefix_name="modify_stage")
+    try:
+        out_path = yield from render(work_dir)
+        return stage_cache.put(stage_key, out_path, ext)
+    finally:
+        scratch_space.release(work_dir)
+
+
+def _rebuild_stage(source_key: str, img_path: str, crbundle: CriteriaBundle):
+    """ Split, transform, quantize and assemble the image as a single cached stage. Returns the key and path of its output """
+    criteria = crbundle.modify_aimg
+    if criteria.format == 'GIF':
+        # The loop count of a GIF is set again by gifsicle afterwards, so leaving it out of the rebuild means changing it only re-runs that pass
+        criteria = copy(criteria)
+        criteria.loop_count = criteria.orig_loop_count
+        crbundle = CriteriaBundle({'modify_aimg': criteria, 'gif_opt': crbundle.gif_opt, 'apng_opt': crbundle.apng_opt})
+    key_criteria = {name: value for name, value in vars(criteria).items() if name not in _UNKEYED_FIELDS}
+    if criteria.format == 'PNG':
+        key_criteria.update(apng_is_lossy=crbundle.apng_opt.is_lossy, apng_lossy_value=crbundle.apng_opt.lossy_value)
+    stage_key = stage_cache.key(source_key, "rebuild", key_criteria)
+    out_path = yield from _cached_stage(stage_key, criteria.format.lower(), "Rebuilding image...",
+                                        lambda work_dir: rebuild_aimg(img_path, work_dir, crbundle))
+    return stage_key, out_path
+
+
+def _pass_stages(tool: str, render, args: List[Tuple[str, str]], stage_key: str, target_path: str, ext: str, total_ops: int, shift_index=0):
+    """ Run every argument of an external binary as a cached stage of its own, chained onto the previous one. Returns the key and path of the last output """
+    for index, (arg, description) in enumerate(args, start=shift_index + 1):
+        stage_key = stage_cache.key(stage_key, tool, arg)
+        target_path = yield from _cached_stage(stage_key, ext, f"[{index}/{total_ops}] {description}",
+                                               lambda work_dir: render([(arg, description)], target_path, os.path.join(work_dir, f"{tool}.{ext}"), total_ops, index - 1))
+    return stage_key, target_path
+
+
 def modify_aimg(img_path: str, out_dir: str, crbundle: CriteriaBundle):
+    """ Modify an animated image through a pipeline of cached stages: rebuilding it (splitting, transforming, quantizing and assembling), followed by
+        one pass for each gifsicle, ImageMagick or apngopt argument. A stage only runs if its input or parameters changed since it was last cached
+    """
     criteria = crbundle.modify_aimg
     gifopt_criteria = crbundle.gif_opt
     apngopt_criteria = crbundle.apng_opt
@@ -86,59 +153,169 @@ def modify_aimg(img_path: str, out_dir: str, crbundle: CriteriaBundle):
         raise Exception("Cannot Preview/Modify the image. The original file in the system may been removed.")
     out_dir = os.path.abspath(out_dir)
     full_name = f"{criteria.name}.{criteria.format.lower()}"
-    orig_full_name = f"{criteria.name}.{criteria.orig_format.lower()}"
-    # temp_dir = _mk_temp_dir(prefix_name="temp_mods")
-    # temp_save_path = os.path.join(temp_dir, full_name)
     out_full_path = os.path.join(out_dir, full_name)
-    orig_out_full_path = os.path.join(out_dir, orig_full_name)
     yield {"OUTFULLPATH": f"{out_full_path}"}
     sicle_args = gifsicle_args(criteria, gifopt_criteria)
     magick_args = imagemagick_args(gifopt_criteria)
     aopt_args = apngopt_args(apngopt_criteria)
     pq_args = pngquant_args(apngopt_criteria)
-    # yield sicle_args
+    ext = criteria.format.lower()
     target_path = str(img_path)
-    total_ops = 0
+    stage_key = stage_cache.source_key(img_path)
     yield {"CHANGE FORMAT???": criteria.change_format()}
-    if criteria.change_format():
-        if criteria.format == "PNG":
-            # if sicle_args:
-            #     target_path = yield from _gifsicle_modify(sicle_args, target_path, orig_out_full_path, total_ops)
-            # if magick_args:
-            #     target_path = yield from _imagemagick_modify(magick_args, target_path, orig_out_full_path, total_ops, len(sicle_args))
-            # yield {"preview_path": target_path}
-            yield {"msg": f"Changing format ({criteria.orig_format} -> {criteria.format})"}
-            target_path = yield from rebuild_aimg(target_path, out_dir, crbundle)
-            if aopt_args:
-                target_path = yield from apngopt_render(aopt_args, target_path, out_full_path, total_ops, len(sicle_args) + len(magick_args))
-        elif criteria.format == "GIF":
-            yield {"msg": f"Changing format ({criteria.orig_format} -> {criteria.format})"}
-            target_path = yield from rebuild_aimg(target_path, out_dir, crbundle)
-            out_full_path = str(target_path)
-            if sicle_args:
-                target_path = yield from gifsicle_render(sicle_args, target_path, out_full_path, total_ops)
-            if magick_args:
-                target_path = yield from imagemagick_render(magick_args, target_path, out_full_path, total_ops, len(sicle_args))             
-            # yield {"preview_path": target_path}
-    else:
-        if criteria.orig_format == "GIF":
-            if criteria.gif_mustsplit_alteration():
-                target_path = yield from rebuild_aimg(target_path, out_dir, crbundle)
-            if sicle_args or criteria.renamed():
-                target_path = yield from gifsicle_render(sicle_args, target_path, orig_out_full_path, total_ops)
-            if magick_args:
-                target_path = yield from imagemagick_render(magick_args, target_path, orig_out_full_path, total_ops, len(sicle_args))
-            # yield {"preview_path": target_path}
-        elif criteria.orig_format == "PNG":
-            if criteria.apng_mustsplit_alteration() or pq_args or apngopt_criteria.is_unoptimized:
-                target_path = yield from rebuild_aimg(target_path, out_dir, crbundle)
-            if aopt_args:
-                yield {"MSGGGGGGGGGGGGG": "AOPT ARGS"}
-                target_path = yield from apngopt_render(aopt_args, target_path, out_full_path, total_ops, len(sicle_args) + len(magick_args))
-            # elif criteria.renamed():
-            #     yield {"MSGGGGGGGGGGGGG": "RENAME"}
-                if target_path != out_full_path:
-                    shutil.copy(target_path, out_full_path)
+    if criteria.format == "GIF":
+        if criteria.change_format() or criteria.gif_mustsplit_alteration():
+            if criteria.change_format():
+                yield {"msg": f"Changing format ({criteria.orig_format} -> {criteria.format})"}
+            stage_key, target_path = yield from _rebuild_stage(stage_key, target_path, crbundle)
+        total_ops = len(sicle_args) + len(magick_args)
+        stage_key, target_path = yield from _pass_stages("gifsicle", gifsicle_render, sicle_args, stage_key, target_path, ext, total_ops)
+        stage_key, target_path = yield from _pass_stages("imagemagick", imagemagick_render, magick_args, stage_key, target_path, ext, total_ops, len(sicle_args))
+    elif criteria.format == "PNG":
+        if criteria.change_format() or criteria.apng_mustsplit_alteration() or pq_args or apngopt_criteria.is_unoptimized:
+            if criteria.change_format():
+                yield {"msg": f"Changing format ({criteria.orig_format} -> {criteria.format})"}
+            stage_key, target_path = yield from _rebuild_stage(stage_key, target_path, crbundle)
+        stage_key, target_path = yield from _pass_stages("apngopt", apngopt_render, aopt_args, stage_key, target_path, ext, len(aopt_args))
+    # An image that no stage had to touch is previewed as it is
+    if target_path != img_path:
+        target_path = shutil.copyfile(target_path, out_full_path)
     yield {"preview_path": target_path}
 
     yield {"CONTROL": "MOD_FINISH"}
+
+
+def _aimg_delays(img_path: str, fmt: str) -> List[int]:
+    """ Delay of every frame of a GIF/APNG in milliseconds. Frames without a delay get the shortest one """
+    if fmt == 'GIF':
+        delays = list(iter_gif_delays(img_path))
+    else:
+        delays = [round(fc.delay * 1000 / (fc.delay_den or 100)) if fc else 0 for fc in read_apng_chunks(img_path).animation_controls]
+    shortest = min((delay for delay in delays if delay), default=100)
+    return [delay or shortest for delay in delays]
+
+
+def _aimg_size(img_path: str, fmt: str) -> Tuple[int, int]:
+    if fmt == 'GIF':
+        blocks = read_gif_blocks(img_path, keep_image_data=False)
+        return blocks.width, blocks.height
+    chunks = read_apng_chunks(img_path)
+    return chunks.width, chunks.height
+
+
+def _build_proxy(img_path: str, fmt: str, loop_count: int, preview: PreviewCriteria, out_path: str):
+    """ Render a low-resolution copy of a GIF/APNG into out_path, no larger than preview.max_size on either side and with at most preview.max_frames frames.
+
+        The frames are thinned out by keeping the first frame of every run of consecutive frames, whose delays are added up so that the loop keeps its duration
+    """
+    delays = _aimg_delays(img_path, fmt)
+    width, height = _aimg_size(img_path, fmt)
+    scale = min(preview.max_size / max(width, height, 1), 1)
+    proxy_size = (max(round(width * scale), 1), max(round(height * scale), 1))
+    fcount = len(delays)
+    step = math.ceil(fcount / preview.max_frames)
+    shout_nums = shout_indices(fcount, 5)
+    frames = _gif_frame_iterator(img_path, coalesce=True) if fmt == 'GIF' else _apng_frame_iterator(img_path, coalesce=True)
+    proxy_frames = []
+    for index, (frame, delay) in enumerate(zip(frames, delays)):
+        checkpoint()
+        if shout_nums.get(index):
+            yield {"msg": f"Rendering preview proxy... ({shout_nums.get(index)})"}
+        if index % step == 0:
+            if scale < 1:
+                with stage("transform", "resize"):
+                    frame = frame.resize(proxy_size, Image.BILINEAR)
+            proxy_frames.append([frame, delay])
+        else:
+            proxy_frames[-1][1] += delay
+    with stage("encode", fmt.lower()):
+        if fmt == 'GIF':
+            assembler = GIFAssembler(loop_count=loop_count)
+            for frame, delay in proxy_frames:
+                assembler.append(_quantize_transparent(frame, GIF_ALPHA_THRESHOLD), max(round(delay / 10), 1))
+            with open(out_path, "wb") as gif_file:
+                gif_file.write(assembler.to_bytes())
+        else:
+            apng = APNG()
+            apng.num_plays = loop_count
+            for frame, delay in proxy_frames:
+                with io.BytesIO() as bytebox:
+                    frame.save(bytebox, "PNG")
+                    apng.append(PNG.from_bytes(bytebox.getvalue()), delay=delay)
+            apng.save(out_path)
+    return out_path
+
+
+def _proxy_criteria(criteria: ModificationCriteria, proxy_path: str) -> ModificationCriteria:
+    """ Copy of the modification criteria to apply to a proxy instead of the original image, with the dimensions and delays scaled to the proxy's """
+    fmt = criteria.orig_format.upper()
+    delays = _aimg_delays(proxy_path, fmt)
+    width, height = _aimg_size(proxy_path, fmt)
+    proxy = copy(criteria)
+    proxy.orig_name = os.path.basename(proxy_path)
+    proxy.orig_base_name = os.path.splitext(proxy.orig_name)[0]
+    proxy.orig_width, proxy.orig_height = width, height
+    if criteria.must_resize():
+        proxy.width = max(round(criteria.width * width / (criteria.orig_width or width)), 1)
+        proxy.height = max(round(criteria.height * height / (criteria.orig_height or height)), 1)
+    else:
+        proxy.width, proxy.height = width, height
+    shortest = min(delays)
+    proxy.orig_frame_count = len(delays)
+    proxy.orig_frame_count_ds = sum(delay // shortest for delay in delays)
+    # Each proxy frame stands for this many frames of the original, so its delays are stretched by as much to keep the loop's duration
+    ratio = (criteria.orig_frame_count_ds or proxy.orig_frame_count_ds) / proxy.orig_frame_count_ds
+    proxy.orig_delay = criteria.orig_delay * ratio
+    proxy.delay = criteria.delay * ratio
+    proxy.fps = criteria.fps / ratio
+    return proxy
+
+
+def _preview_key_criteria(crbundle: CriteriaBundle) -> Dict:
+    """ The parts of the criteria that make up a preview, leaving out the output name and worker count """
+    modify_criteria = {name: value for name, value in vars(crbundle.modify_aimg).items() if name not in _UNKEYED_FIELDS}
+    return {"modify_aimg": modify_criteria, "gif_opt": vars(crbundle.gif_opt), "apng_opt": vars(crbundle.apng_opt)}
+
+
+def preview_aimg(img_path: str, crbundle: CriteriaBundle):
+    """ Preview a modification by rendering it on a low-resolution, frame-limited proxy of the image instead of the image itself.
+
+        The proxy is cached by the image's content hash and the preview by that and the criteria, so only the first preview of an image decodes it at full size,
+        and previewing criteria again is instant. Full resolution rendering is left to modify_aimg when the image is exported
+    """
+    criteria = crbundle.modify_aimg
+    preview = crbundle.preview or PreviewCriteria({})
+    img_path = os.path.abspath(img_path)
+    if not os.path.isfile(img_path):
+        raise Exception("Cannot Preview the image. The original file in the system may been removed.")
+    fmt = criteria.orig_format.upper()
+    proxy_key = preview_cache.key(preview_cache.source_key(img_path), preview, criteria.orig_loop_count)
+    preview_key = preview_cache.key(proxy_key, _preview_key_criteria(crbundle))
+    preview_path = preview_cache.get(preview_key, criteria.format.lower())
+    if preview_path:
+        yield {"msg": "Loaded the preview from the cache"}
+    else:
+        work_dir = _mk_temp_dir(prefix_name="preview")
+        try:
+            proxy_path = preview_cache.get(proxy_key, fmt.lower())
+            if not proxy_path:
+                proxy_path = yield from _build_proxy(img_path, fmt, criteria.orig_loop_count, preview, os.path.join(work_dir, f"proxy.{fmt.lower()}"))
+                proxy_path = preview_cache.put(proxy_key, proxy_path, fmt.lower())
+            proxy_bundle = CriteriaBundle({
+                'modify_aimg': _proxy_criteria(criteria, proxy_path),
+                'gif_opt': crbundle.gif_opt,
+                'apng_opt': crbundle.apng_opt,
+            })
+            out_dir = os.path.join(work_dir, "out")
+            os.mkdir(out_dir)
+            for msg in modify_aimg(proxy_path, out_dir, proxy_bundle):
+                if "preview_path" in msg:
+                    preview_path = msg["preview_path"]
+                elif "CONTROL" not in msg:
+                    yield msg
+            preview_path = preview_cache.put(preview_key, preview_path, criteria.format.lower())
+        finally:
+            scratch_space.release(work_dir)
+    yield {"preview_path": preview_path}
+    yield {"CONTROL": "MOD_FINISH"}
+    return preview_path
@@ -6,58 +6,53 @@ import math
 import time
 import subprocess
 import tempfile
+import hashlib
 from random import choices
 from pprint import pprint
 from urllib.parse import urlparse
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator, Callable
 from datetime import datetime
 from copy import deepcopy
 from heapq import nsmallest
 
+import numpy as np
 from PIL import Image, ImageChops
 from PIL.GifImagePlugin import GifImageFile
 from apng import APNG, PNG
 
-from .bin_funcs.imager_api import apngdis_split
-from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, ABS_CACHE_PATH, imager_exec_path
+from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, ABS_CACHE_PATH
 from .core_funcs.criterion import SplitCriteria
-from .core_funcs.utility import _mk_temp_dir, _reduce_color, _unoptimize_gif, _log, shout_indices, generate_delay_file
+from .core_funcs.utility import _mk_temp_dir, _reduce_color, _log, shout_indices, generate_delay_file
+from .core_funcs.gif_reader import read_gif_blocks, iter_gif_delays
+from .core_funcs.png_reader import read_apng_chunks, iter_apng_frames
+from .core_funcs.cancellation import checkpoint
+from .core_funcs.instrumentation import stage
+from .core_funcs.scratch import scratch_space
+from .core_funcs.imager_backends import imager_backends
 
 
 def _get_aimg_delay_ratios(aimg_path: str, aimg_type: str, duration_sensitive: bool = False) -> List[Tuple[str, str]]:
     """ Returns a list of dual-valued tuples, first value being the frame numbers of the GIF, second being the ratio of the frame's delay to the lowest delay"""
     indexed_ratios = []
     if aimg_type == 'GIF':
-        with Image.open(aimg_path) as gif:
-            indices = list(range(0, gif.n_frames))
-            delays = []
-            for i in indices:
-                gif.seek(i)
-                delays.append(gif.info['duration'])
-            min_delays = min(delays)
-            if duration_sensitive:
-                ratios = [d//min_delays for d in delays]
-            else:
-                ratios = [1 for d in delays]
-            indexed_ratios.extend(list(zip(indices, ratios)))
+        delays = list(iter_gif_delays(aimg_path))
     elif aimg_type == 'PNG':
-        frames = APNG.open(aimg_path).frames
-        indices = list(range(0, len(frames)))
-        # Get the delay of every frames. Set zero if frame control chunk f[1] is None (this may occur in some APNGs)
-        delays = [f[1].delay if f[1] else 0 for f in frames]
-        # raise Exception(list(delays))
-        # Delays fix for frames with no control chunks
-        if 0 in delays:
-            actual_min = nsmallest(2, set(delays))[-1]
-            # Replace those zeroes in the delays generator
-            delays = [actual_min if d == 0 else d for d in delays]
-            # raise Exception(actual_min, list(delays))
-        min_delays = min(delays)
-        if duration_sensitive:
-            ratios = [d//min_delays for d in delays]
-        else:
-            ratios = [1 for d in delays]
-        indexed_ratios.extend(list(zip(indices, ratios)))
+        frame_controls = read_apng_chunks(aimg_path).animation_controls
+        # Get the delay of every frames. Set zero if the frame control chunk is None (this may occur in some APNGs)
+        delays = [fc.delay if fc else 0 for fc in frame_controls]
+    else:
+        return indexed_ratios
+    indices = list(range(0, len(delays)))
+    # Delays fix for zero-delay frames, which get the lowest non-zero delay. If every delay is zero, the frames are kept once each
+    if 0 in delays:
+        actual_min = nsmallest(2, set(delays))[-1] or 1
+        delays = [actual_min if d == 0 else d for d in delays]
+    min_delays = min(delays)
+    if duration_sensitive:
+        ratios = [d//min_delays for d in delays]
+    else:
+        ratios = [1 for d in delays]
+    indexed_ratios.extend(list(zip(indices, ratios)))
     return indexed_ratios
     
 
@@ -80,51 +75,111 @@ def _get_aimg_delay_ratios(aimg_path: str, aimg_type: str, duration_sensitive: b
 #             sequence += 1
 
 
-def _fragment_gif_frames(unop_gif_path: str, name: str, criteria: SplitCriteria) -> List[Image.Image]:
-    fragment_dir = _mk_temp_dir(prefix_name="fragment_dir")
-    """ Split GIF frames and return them as a list of PIL.Image.Images using Gifsicle based on the specified criteria"""
-    frames = []
-    indexed_ratios = _get_aimg_delay_ratios(unop_gif_path, "GIF", criteria.is_duration_sensitive)
+def _iter_gif_frames(gif_path: str, coalesce: bool = True):
+    """ Decode every frame of a GIF exactly once, and yield them as RGBA PIL.Image.Images of the GIF's logical screen size.\n
+        With coalesce, each frame is composited over the previous ones according to their disposal methods, otherwise each frame is placed alone on a transparent canvas
+    """
+    blocks = read_gif_blocks(gif_path)
+    canvas = Image.new("RGBA", (blocks.width, blocks.height))
+    for block in blocks.frames:
+        with stage("decode", "gif_frame"):
+            with io.BytesIO(block.standalone_bytes(blocks.global_color_table, blocks.gct_packed)) as bytebox:
+                with Image.open(bytebox) as fragment:
+                    fragment = fragment.convert("RGBA")
+        if not coalesce:
+            with stage("transform", "place"):
+                frame = Image.new("RGBA", canvas.size)
+                frame.paste(fragment, (block.left, block.top), fragment)
+            yield frame
+            continue
+        with stage("transform", "composite"):
+            previous = canvas.copy() if block.disposal == 3 else None
+            canvas.paste(fragment, (block.left, block.top), fragment)
+            frame = canvas.copy()
+        yield frame
+        if block.disposal == 2:
+            canvas.paste((0, 0, 0, 0), block.box())
+        elif block.disposal == 3:
+            canvas = previous
+
+
+def _save_rationed_frames(frames: Iterator[Image.Image], indexed_ratios: List[Tuple[int, int]], out_dir: str, save_name: str, pad_count: int, report_runs: bool = False):
+    """ Streams the frames to disk as soon as each of them is decoded. Every frame is PNG-encoded once, and the duplicates required by its delay ratio
+        are written from the same encoded bytes. Returns the list of saved paths.\n
+        With report_runs, runs of identical frames (consecutive identical frames as well as delay ratio duplicates) are saved only once,
+        and reported as {"frame_runs": [{"path", "start", "count"}, ...]} where start is the run's position in the full sequence
+    """
+    if report_runs:
+        frame_paths = yield from _save_frame_runs(frames, indexed_ratios, out_dir, save_name, pad_count)
+        return frame_paths
+    frame_paths = []
     total_frames = sum([ir[1] for ir in indexed_ratios])
-    cumulative_index = 0
-    gifsicle_path = imager_exec_path('gifsicle')
     shout_nums = shout_indices(total_frames, 5)
-    for index, ratio in indexed_ratios:
-        if shout_nums.get(cumulative_index):
-            yield {"msg": f'Splitting frames... ({shout_nums.get(index)})'}
-        selector = f'"#{index}"'
+    for (index, ratio), frame in zip(indexed_ratios, frames):
+        checkpoint()
+        with stage("encode", "png"), io.BytesIO() as bytebox:
+            frame.save(bytebox, "PNG")
+            png_bytes = bytebox.getvalue()
+        frame.close()
         for n in range(0, ratio):
-            # yield {"msg": f"Splitting GIF... ({cumulative_index + 1}/{total_frames})"}
-            dir_path = os.path.join(fragment_dir, f'{name}_{str.zfill(str(cumulative_index), criteria.pad_count)}.png')
-            args = [gifsicle_path, f'"{unop_gif_path}"', selector, "--output", f'"{dir_path}"']
-            cmd = ' '.join(args)
-            subprocess.run(cmd, shell=True)
-            cumulative_index += 1
-            with Image.open(dir_path).convert("RGBA") as im:
-            # if gif.info.get('transparency'):
-            #     yield {"msg": "Palette has transparency"}
-            #     gif = gif.convert('RGBA')
-            # else:
-            #     yield {"msg": "Palette has no transparency"}
-            #     gif = gif.convert('RGB')
-                frames.append(im)
-    # shutil.rmtree(fragment_dir)
-    return frames
+            sequence = len(frame_paths)
+            if shout_nums.get(sequence):
+                yield {"msg": f'Saving frames... ({shout_nums.get(sequence)})'}
+            save_path = os.path.join(out_dir, f'{save_name}_{str.zfill(str(sequence), pad_count)}.png')
+            with stage("write", "png"), open(save_path, "wb") as png_file:
+                png_file.write(png_bytes)
+            frame_paths.append(save_path)
+    return frame_paths
+
+
+def _save_frame_runs(frames: Iterator[Image.Image], indexed_ratios: List[Tuple[int, int]], out_dir: str, save_name: str, pad_count: int):
+    """ Save every run of identical frames once, and report the runs instead of materializing their duplicates. Returns the list of saved paths """
+    runs = []
+    run_key = None
+    sequence = 0
+    shout_nums = shout_indices(len(indexed_ratios), 5)
+    for (index, ratio), frame in zip(indexed_ratios, frames):
+        checkpoint()
+        if shout_nums.get(index):
+            yield {"msg": f'Saving frames... ({shout_nums.get(index)})'}
+        frame_key = hashlib.blake2b(frame.tobytes(), digest_size=16).digest()
+        if runs and frame_key == run_key:
+            runs[-1]["count"] += ratio
+        else:
+            save_path = os.path.join(out_dir, f'{save_name}_{str.zfill(str(len(runs)), pad_count)}.png')
+            with stage("write", "png"):
+                frame.save(save_path, "PNG")
+            runs.append({"path": save_path, "start": sequence, "count": ratio})
+            run_key = frame_key
+        sequence += ratio
+        frame.close()
+    yield {"frame_runs": runs}
+    return [run["path"] for run in runs]
+
+
+def _fragment_gif_frames(gif_path: str, name: str, criteria: SplitCriteria) -> Iterator[Image.Image]:
+    """ Split GIF frames in-process based on the specified criteria, and lazily yield them as PIL.Image.Images. Each frame is yielded as many times as its delay ratio """
+    indexed_ratios = _get_aimg_delay_ratios(gif_path, "GIF", criteria.is_duration_sensitive)
+    decoded_frames = _gif_frame_iterator(gif_path, criteria.is_unoptimized)
+    for (index, ratio), frame in zip(indexed_ratios, decoded_frames):
+        checkpoint()
+        for n in range(0, ratio):
+            yield frame
 
 
 def _split_gif(gif_path: str, out_dir: str, criteria: SplitCriteria):
     """ Unoptimizes GIF, and then splits the frames into separate images """
-    frame_paths = []
     name = os.path.splitext(os.path.basename(gif_path))[0]
-    unop_dir = _mk_temp_dir(prefix_name="unop_gif")
     color_space = criteria.color_space
     target_path = gif_path
+    redux_dir = None
     if color_space:
         if color_space < 2 or color_space > 256:
             raise Exception("Color space must be between 2 and 256!")
         else:
             yield {"msg": f"Reducing colors to {color_space}..."}
-            target_path = _reduce_color(gif_path, unop_dir, color=color_space)
+            redux_dir = _mk_temp_dir(prefix_name="redux_gif")
+            target_path = _reduce_color(gif_path, redux_dir, color=color_space)
 
     # ===== Start test splitting code =====
     # gif: GifImageFile = GifImageFile(gif_path)
@@ -140,215 +195,156 @@ def _split_gif(gif_path: str, out_dir: str, criteria: SplitCriteria):
         # yield {"GIFINFO": [f"{d} {getattr(gif, d, '')}" for d in gif.__dir__()]}
     # ===== End test splitting code =====
 
-
-    if criteria.is_unoptimized:
-        yield {"msg": f"Unoptimizing GIF..."}
-        target_path = _unoptimize_gif(gif_path, unop_dir, "imagemagick")
-
-    frames = yield from _fragment_gif_frames(target_path, name, criteria)
-    shout_nums = shout_indices(len(frames), 5)
+    indexed_ratios = _get_aimg_delay_ratios(target_path, "GIF", criteria.is_duration_sensitive)
+    frames = _gif_frame_iterator(target_path, criteria.is_unoptimized)
     save_name = criteria.new_name or name
-    for index, fr in enumerate(frames):
-        if shout_nums.get(index):
-            yield {"msg": f'Saving frames... ({shout_nums.get(index)})'}
-        save_path = os.path.join(out_dir, f'{save_name}_{str.zfill(str(index), criteria.pad_count)}.png')
-        fr.save(save_path, "PNG")
-        frame_paths.append(save_path)
+    frame_paths = yield from _save_rationed_frames(frames, indexed_ratios, out_dir, save_name, criteria.pad_count, criteria.will_report_runs)
+    if redux_dir:
+        scratch_space.release(redux_dir)
     if criteria.will_generate_delay_info:
         yield {"msg": "Generating delay information file..."}
         generate_delay_file(gif_path, "GIF", out_dir)
     return frame_paths
 
 
-def _fragment_apng_frames(apng_path: str, criteria: SplitCriteria) -> List[Image.Image]:
-    """ Accepts the path of an APNG, and then returns a list of PIL.Image.Images for each of the frames. """
-# def _fragment_apng_frames(apng: APNG, criteria: SplitCriteria) -> List[Image.Image]:
-#     """ Accepts an APNG, and then returns a list of PIL.Image.Images for each of the frames. """
-    frames = []
-    indexed_ratios = _get_aimg_delay_ratios(apng_path, "PNG", duration_sensitive=criteria.is_duration_sensitive)
-    yield {"INDEXED RATIOS": list(indexed_ratios)}
+def _blend_over(dst: np.ndarray, src: np.ndarray) -> np.ndarray:
+    """ Alpha-blend the RGBA src array over the RGBA dst array of the same shape (APNG_BLEND_OP_OVER), with the same integer arithmetic as apngdis """
+    src = src.astype(np.uint32)
+    dst = dst.astype(np.uint32)
+    src_a = src[..., 3:4]
+    dst_a = dst[..., 3:4]
+    u = src_a * 255
+    v = (255 - src_a) * dst_a
+    total = np.maximum(u + v, 1)
+    blended = np.empty_like(src)
+    blended[..., :3] = (src[..., :3] * u + dst[..., :3] * v) // total
+    blended[..., 3:4] = (u + v) // 255
+    use_src = (src_a == 255) | ((src_a != 0) & (dst_a == 0))
+    out = np.where(use_src, src, np.where(src_a == 0, dst, blended))
+    return out.astype(np.uint8)
+
+
+def _iter_apng_frames(apng_path: str, coalesce: bool = False) -> Iterator[Image.Image]:
+    """ Decodes the frames of an APNG one at a time as RGBA PIL.Image.Images.\n
+        With coalesce, every frame is rendered onto a persistent canvas following its fcTL offsets, dispose_op and blend_op, and the full canvas is yielded.
+        Otherwise each frame is yielded at the size of its own frame region
+    """
+    chunks = read_apng_chunks(apng_path)
+    canvas = np.zeros((chunks.height, chunks.width, 4), dtype=np.uint8) if coalesce else None
+    is_animated = any(chunks.frame_controls)
+    is_first_control = True
+    for png_bytes, control in iter_apng_frames(apng_path):
+        if is_animated and not control:
+            # Default image that is not part of the animation
+            continue
+        with stage("decode", "apng_frame"):
+            with io.BytesIO(png_bytes) as bytebox:
+                with Image.open(bytebox) as im:
+                    im = im.convert("RGBA")
+        if not coalesce:
+            yield im
+            continue
+        if not control:
+            # Only image of a static PNG
+            yield im
+            continue
+        left, top = control.x_offset, control.y_offset
+        right = min(left + control.width, chunks.width)
+        bottom = min(top + control.height, chunks.height)
+        region = (slice(top, bottom), slice(left, right))
+        fragment = np.asarray(im)[:bottom - top, :right - left]
+        depose_op = control.depose_op
+        if is_first_control and depose_op == 2:
+            # APNG_DISPOSE_OP_PREVIOUS on the first frame is treated as APNG_DISPOSE_OP_BACKGROUND
+            depose_op = 1
+        is_first_control = False
+        with stage("transform", "composite"):
+            previous = canvas[region].copy() if depose_op == 2 else None
+            if control.blend_op == 1:
+                canvas[region] = _blend_over(canvas[region], fragment)
+            else:
+                canvas[region] = fragment
+            frame = Image.fromarray(canvas.copy())
+        yield frame
+        if depose_op == 1:
+            canvas[region] = 0
+        elif depose_op == 2:
+            canvas[region] = previous
+
+
+@imager_backends.backend("coalesce_gif", "pillow")
+def _pillow_coalesce_gif(gif_path: str) -> Iterator[Image.Image]:
+    return _iter_gif_frames(gif_path, coalesce=True)
+
+
+@imager_backends.backend("coalesce_apng", "pillow")
+def _pillow_coalesce_apng(apng_path: str) -> Iterator[Image.Image]:
+    return _iter_apng_frames(apng_path, coalesce=True)
+
+
+@imager_backends.sample("coalesce_gif")
+def _sample_gif(sample_dir: str, width: int, height: int, frames: int) -> Tuple[str]:
+    sample_path = os.path.join(sample_dir, "sample.gif")
+    rng = np.random.default_rng(0)
+    palette = rng.integers(0, 256, 768, dtype=np.uint8).tobytes()
+    images = [Image.fromarray(frame, "L").convert("P") for frame in rng.integers(0, 256, (frames, height, width), dtype=np.uint8)]
+    for im in images:
+        im.putpalette(palette)
+    images[0].save(sample_path, save_all=True, append_images=images[1:], optimize=False)
+    return (sample_path,)
+
+
+@imager_backends.sample("coalesce_apng")
+def _sample_apng(sample_dir: str, width: int, height: int, frames: int) -> Tuple[str]:
+    sample_path = os.path.join(sample_dir, "sample.png")
+    noise = np.random.default_rng(0).integers(0, 256, (frames, height, width, 4), dtype=np.uint8)
+    apng = APNG()
+    for frame in noise:
+        with io.BytesIO() as bytebox:
+            Image.fromarray(frame).save(bytebox, "PNG")
+            apng.append(PNG.from_bytes(bytebox.getvalue()), delay=40)
+    apng.save(sample_path)
+    return (sample_path,)
+
+
+def _gif_frame_iterator(gif_path: str, coalesce: bool) -> Iterator[Image.Image]:
+    """ Frames of a GIF as _iter_gif_frames decodes them. Coalescing goes through the imager backends, sized by the GIF's screen and frame count """
+    if not coalesce:
+        return _iter_gif_frames(gif_path, coalesce=False)
+    blocks = read_gif_blocks(gif_path)
+    return imager_backends.run("coalesce_gif", blocks.width * blocks.height * len(blocks.frames), gif_path)
+
+
+def _apng_frame_iterator(apng_path: str, coalesce: bool) -> Iterator[Image.Image]:
+    """ Frames of an APNG as _iter_apng_frames decodes them. Coalescing goes through the imager backends, sized by the APNG's canvas and frame count """
+    if not coalesce:
+        return _iter_apng_frames(apng_path, coalesce=False)
+    chunks = read_apng_chunks(apng_path)
+    return imager_backends.run("coalesce_apng", chunks.width * chunks.height * len(chunks.animation_controls), apng_path)
+
+
+def _apng_frame_source(apng_path: str, criteria: SplitCriteria):
+    """ Returns a lazy iterator over the frames of an APNG, composited if the criteria asks for unoptimized frames """
     if criteria.is_unoptimized:
         yield {"msg": "Unoptimizing and splitting APNG..."}
-        fragment_paths = yield from apngdis_split(apng_path, criteria.new_name)
-        fragment_paths = sorted(list(fragment_paths), key=lambda fragment: fragment)
-        yield {"APNGDIS SPLIT PATHS": fragment_paths}
-        for fp in fragment_paths:
-            frames.append(Image.open(fp))
-    else:
-        apng = APNG.open(apng_path)
-        iframes = apng.frames
-        fcount = len(iframes)
-        pad_count = max(len(str(fcount)), 3)
-        shout_nums = shout_indices(fcount, 5)
-        first_png = iframes[0][0]
-        base_stack_image: Image.Image
-        with io.BytesIO() as firstbox:
-            first_png.save(firstbox)
-            with Image.open(firstbox) as first_im:
-                first_im = first_im.convert("RGBA")
-                base_stack_image: Image = first_im.copy()
-        # yield {"MODE FIRST": base_stack_image.mode}
-        # yield {"msg": iframes[0][1].__dict__}
-        separate_stack_image: Image.Image = Image.new("RGBA", base_stack_image.size)
-        depose_blend_ops = []
-        rerender = False
-        width = iframes[0][0].width
-        height = iframes[0][0].height
-        base_alpha = Image.new("RGBA", (width, height))
-        output_buffer = Image.new('RGBA', base_stack_image.size)
-        for index, (png, control) in enumerate(iframes):
-            if control:
-                yield {"CONTROL": control.__dict__}
-            if shout_nums.get(index):
-                yield {"msg": f'Splitting APNG... ({shout_nums.get(index)})'}
-            with io.BytesIO() as bytebox:
-                png.save(bytebox)
-                with Image.open(bytebox).convert("RGBA") as im:
-                    # if criteria.is_unoptimized:
-                    #     # if control.blend_op == 0:
-                    #     #     output_buffer = base_alpha.copy()
-                    #     if control.depose_op == 0:
-                    #         output_buffer.alpha_composite(im, (control.x_offset, control.y_offset))
-                    #         frames.append(output_buffer.copy())
-                    #     elif control.depose_op == 1:
-                    #         output_buffer.alpha_composite(im, (control.x_offset, control.y_offset))
-                    #         frames.append(output_buffer.copy())
-                    #         output_buffer = base_alpha.copy()
-                    #     elif control.depose_op == 2:
-                    #         separate_buffer = output_buffer.copy()
-                    #         separate_buffer.alpha_composite(im, (control.x_offset, control.y_offset))
-                    #         frames.append(separate_buffer.copy())
-                        # OLD ALGORITHM 2
-                        # if not control or (control and control.blend_op == 0 and control.depose_op != 1):
-                        #     yield {"MSG": "control blend 0, full overwrite"}
-                        #     if im.size != base_stack_image.size:
-                        #         alpha_pad = Image.new("RGBA", base_stack_image.size)
-                        #         alpha_pad.alpha_composite(im, (control.x_offset if control else 0, control.y_offset if control else 0))
-                        #         frames.append(alpha_pad.copy())
-                        #     else:
-                        #         frames.append(im)
-                        # if control and (control.blend_op == 1 or control.depose_op == 1):
-                        #     yield {"MSG": "control blend 1, managing..."}
-                        #     if control.depose_op in [0, 1]:
-                        #         base_stack_image.paste(im, (control.x_offset if control else 0, control.y_offset if control else 0), im)
-                        #         frames.append(base_stack_image.copy())
-                        #     elif control.depose_op == 2:
-                        #         temp_stack = base_stack_image.copy()
-                        #         temp_stack.paste(im, (control.x_offset if control else 0, control.y_offset if control else 0), im)
-                        #         frames.append(temp_stack.copy())
-
-                        # OLD Algorithm
-                        # # im = im.convert("RGBA")
-                        # # yield {"CONTROL": control.depose_op}
-                        # if rerender:
-                        #     newplain = Image.new("RGBA", base_stack_image.size)
-                        #     newplain.paste(im, (control.x_offset, control.y_offset), im)
-                        #     frames.append(newplain.copy())
-                        #     rerender = False
-                        # else:
-                        #     if control and (control.depose_op == 2 or control.depose_op == 1):
-                        #         separate_stack = base_stack_image.copy()
-                        #         separate_stack.paste(im, (control.x_offset, control.y_offset), im)
-                        #         frames.append(separate_stack.copy())
-                        #         if index == 0 and control.depose_op == 1:
-                        #             rerender = True
-                        #         # separate_stack.show()
-                        #     # elif control.depose_op == 1:
-                        #     #     frames.append(im.copy())
-                        #     elif not control or control.depose_op == 0:
-                        #         base_stack_image.paste(im, (control.x_offset if control else 0, control.y_offset if control else 0), im)
-                        #         frames.append(base_stack_image.copy())
-                        #     # base_stack_image.show()
-                    # else:
-                    frames.append(im)
-                    # if control:
-                    #     depose_blend_ops.append(f"blend: {control.blend_op}, depose: {control.depose_op}, x_off: {control.x_offset}, y_off: {control.y_offset}")
-                    # else:
-                    #     depose_blend_ops.append("NO CONTROL")
-        # for fr in frames:
-        #     fr.show()
-        yield {"DEPOSE_BLEND_OPS": depose_blend_ops}
-    if not all(ratio == 1 for index, ratio in indexed_ratios):
-        yield {"msg": "REORDER RATIOS"}
-        rationed_frames = []
-        for index, ratio in indexed_ratios:
-            for n in range(0, ratio):
-                rationed_frames.append(frames[index])
-        frames = deepcopy(rationed_frames)
-        del rationed_frames
-    return frames
-
-# def generate_delay_file()
-
-# def _fragment_apng_frames(apng: APNG, criteria: SplitCriteria) -> List[Image.Image]:
-#     """ Accepts an APNG, and then returns a list of PIL.Image.Images for each of the frames. """
-#     frames = []
-#     iframes = apng.frames
-#     fcount = len(iframes)
-#     pad_count = max(len(str(fcount)), 3)
-#     shout_nums = shout_indices(fcount, 5)
-#     first_png = iframes[0][0]
-#     base_stack_image: Image.Image
-#     with io.BytesIO() as firstbox:
-#         first_png.save(firstbox)
-#         with Image.open(firstbox) as im:
-#             im = im.convert("RGBA")
-#             base_stack_image: Image = im.copy()
-#     # yield {"MODE FIRST": base_stack_image.mode}
-#     depose_blend_ops = [{}]
-#     # rerender = False
-#     for index, (png, control) in enumerate(iframes):
-#         if shout_nums.get(index):
-#             yield {"msg": f'Splitting APNG... ({shout_nums.get(index)})'}
-#         with io.BytesIO() as bytebox:
-#             png.save(bytebox)
-#             with Image.open(bytebox).convert("RGBA") as im:
-#                 # yield {"MSG": control.__dict__}
-#                 if criteria.is_unoptimized:
-#                     # im = im.convert("RGBA")
-#                     # yield {"CONTROL": control.depose_op}
-#                     # if rerender:
-#                     # else:
-#                     if control.depose_op == 2:
-#                         separate_stack = base_stack_image.copy()
-#                         separate_stack.paste(im, (control.x_offset, control.y_offset), im)
-#                         frames.append(separate_stack.copy())
-#                         # if index == 0 and control.depose_op == 1:
-#                             # rerender = True
-#                         # separate_stack.show()
-#                     elif control.depose_op == 1 or control.blend_op == 0:
-#                         newplain = Image.new("RGBA", base_stack_image.size)
-#                         newplain.paste(im, (control.x_offset, control.y_offset), im)
-#                         frames.append(newplain.copy())
-#                         # rerender = False
-#                     elif control.depose_op == 0:
-#                         base_stack_image.paste(im, (control.x_offset, control.y_offset), im)
-#                         frames.append(base_stack_image.copy())
-#                     # base_stack_image.show()
-#                 else:
-#                     frames.append(im)
-#                 depose_blend_ops.append((control.depose_op, control.blend_op))
-#     # for fr in frames:
-#     #     fr.show()
-#     yield {"DEPOSE_BLEND_OPS": depose_blend_ops}
-#     return frames
-
+    return _apng_frame_iterator(apng_path, criteria.is_unoptimized)
 
 
+def _fragment_apng_frames(apng_path: str, criteria: SplitCriteria) -> Iterator[Image.Image]:
+    """ Accepts the path of an APNG, and then lazily yields PIL.Image.Images for each of the frames. Each frame is yielded as many times as its delay ratio """
+    indexed_ratios = _get_aimg_delay_ratios(apng_path, "PNG", duration_sensitive=criteria.is_duration_sensitive)
+    decoded_frames = _apng_frame_iterator(apng_path, criteria.is_unoptimized)
+    for (index, ratio), frame in zip(indexed_ratios, decoded_frames):
+        checkpoint()
+        for n in range(0, ratio):
+            yield frame
 
 def _split_apng(apng_path: str, out_dir: str, name: str, criteria: SplitCriteria):
     """ Extracts all of the frames of an animated PNG into a folder and return a list of each of the frames' absolute paths """
-    frame_paths = []
-    frames = yield from _fragment_apng_frames(apng_path, criteria)
-    pad_count = criteria.pad_count
-    shout_nums = shout_indices(len(frames), 5)
+    indexed_ratios = _get_aimg_delay_ratios(apng_path, "PNG", duration_sensitive=criteria.is_duration_sensitive)
+    frames = yield from _apng_frame_source(apng_path, criteria)
     save_name = criteria.new_name or name
-    for index, fr in enumerate(frames):
-        if shout_nums.get(index):
-            yield {"msg": f'Saving split frames... ({shout_nums.get(index)})'}
-        save_path = os.path.join(out_dir, f"{save_name}_{str.zfill(str(index), pad_count)}.png")
-        fr.save(save_path)
-        frame_paths.append(save_path)
+    frame_paths = yield from _save_rationed_frames(frames, indexed_ratios, out_dir, save_name, criteria.pad_count, criteria.will_report_runs)
     if criteria.will_generate_delay_info:
         yield {"msg": "Generating delay information file..."}
         generate_delay_file(apng_path, "PNG", out_dir)
@@ -383,6 +379,41 @@ def split_aimg(image_path: str, out_dir: str, criteria: SplitCriteria):
     yield {"CONTROL": "SPL_FINISH"}
     return frame_paths
 
+class FrameSequence:
+    """ The in-memory frames split out of an animated image. Iterating over it decodes the image again each time, so that only
+        the frames being worked on are held in memory, however long the animation is
+    """
+
+    def __init__(self, frame_count: int, fragment: Callable[[], Iterator[Image.Image]]):
+        self.frame_count = frame_count
+        self._fragment = fragment
+
+    def __len__(self) -> int:
+        return self.frame_count
+
+    def __iter__(self) -> Iterator[Image.Image]:
+        return self._fragment()
+
+
+def split_aimg_frames(image_path: str, criteria: SplitCriteria):
+    """ Splits an animated image into in-memory PIL.Image.Images instead of saving them to disk. Returns them as a FrameSequence, which decodes them lazily """
+    image_path = os.path.abspath(image_path)
+    if not os.path.isfile(image_path):
+        raise Exception("Oi skrubman the path here seems to be a bloody directory, should've been a file", image_path)
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    ext = str.lower(ext[1:])
+    if ext == 'gif':
+        indexed_ratios = _get_aimg_delay_ratios(image_path, "GIF", criteria.is_duration_sensitive)
+        fragment = lambda: _fragment_gif_frames(image_path, name, criteria)
+    elif ext == 'png':
+        indexed_ratios = _get_aimg_delay_ratios(image_path, "PNG", duration_sensitive=criteria.is_duration_sensitive)
+        fragment = lambda: _fragment_apng_frames(image_path, criteria)
+    else:
+        raise Exception('Only supported extensions are gif and apng. Sry lad')
+    yield {"msg": "Splitting frames..."}
+    return FrameSequence(sum(ratio for index, ratio in indexed_ratios), fragment)
+
+
 # if __name__ == "__main__":
 #     pprint(inspect_sequence(""))
 
@@ -1,19 +1,27 @@
 import os
 import io
+import json
+import hashlib
 import string
 import shutil
 import math
 from random import choices
 from pprint import pprint
 from urllib.parse import urlparse
-from typing import List
+from typing import List, Tuple, Iterator, Dict
 
 from PIL import Image
 from apng import APNG, PNG
 
-from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS
+from .core_funcs.config import IMG_EXTS, ANIMATED_IMG_EXTS, STATIC_IMG_EXTS, SPRITESHEET_BAND_BYTES
 from .core_funcs.criterion import SpritesheetBuildCriteria, SpritesheetSliceCriteria
-from .core_funcs.utility import shout_indices
+from .core_funcs.utility import shout_indices, imap_ordered
+from .core_funcs.cancellation import checkpoint
+from .core_funcs.instrumentation import stage
+from .core_funcs.gif_reader import read_gif_blocks
+from .core_funcs.png_reader import read_apng_chunks, supports_png_bands, iter_png_bands
+from .core_funcs.atlas_packer import pack_rects
+from .split_ops import _gif_frame_iterator, _apng_frame_iterator
 
 
 def _get_boxes(tile_width, tile_height, hbox_count, vbox_count, offset_x=0, offset_y=0, padding_x=0, padding_y=0):
@@ -31,27 +39,185 @@ def _get_boxes(tile_width, tile_height, hbox_count, vbox_count, offset_x=0, offs
             yield box
 
 
+def _sheet_bands(image_path: str, band_height: int, band_count: int) -> Iterator[Image.Image]:
+    """ Yields band_count horizontal bands of band_height rows of the sheet, rows past the bottom of the sheet are blank.\n
+        Non-interlaced 8-bit PNGs are decoded band by band, anything else is decoded whole first
+    """
+    if supports_png_bands(image_path):
+        band = None
+        for band in iter_png_bands(image_path, band_height):
+            if not band_count:
+                return
+            band_count -= 1
+            yield band
+        for _ in range(band_count):
+            # Cropping below the last band makes blank rows of the same mode and palette
+            yield band.crop((0, band.height, band.width, band.height + band_height))
+    else:
+        with Image.open(image_path) as sheet:
+            with stage("decode"):
+                sheet.load()
+            for index in range(band_count):
+                yield sheet.crop((0, index * band_height, sheet.width, (index + 1) * band_height))
+
+
+def _band_tiles(bands: Iterator[Image.Image], criteria: SpritesheetSliceCriteria, hbox_count: int, vbox_count: int, band_rows: int) -> Iterator[Tuple[int, Image.Image]]:
+    """ Crops the tiles out of each band in row-major order, along with their indices. A band is let go once all of its tiles are cut """
+    index = 0
+    for band_index, band in enumerate(bands):
+        for v in range(min(band_rows, vbox_count - band_index * band_rows)):
+            boxes = _get_boxes(criteria.tile_width, criteria.tile_height, hbox_count, 1, offset_y=v * criteria.tile_height)
+            for box in boxes:
+                with stage("transform", "crop"):
+                    tile = band.crop(box)
+                yield index, tile
+                index += 1
+
+
+def _save_tile(tile: Image.Image, save_path: str, criteria: SpritesheetSliceCriteria) -> bool:
+    """ Save a tile as an RGBA PNG. Returns False if it is fully transparent and skipped instead """
+    with stage("transform", "rgba"):
+        tile = tile.convert("RGBA")
+    if criteria.skip_transparent and not tile.getchannel("A").getbbox():
+        return False
+    with stage("write", "png"):
+        tile.save(save_path)
+    return True
+
+
 def _slice_spritesheet(image_path: str, out_dir:str, filename: str, criteria: SpritesheetSliceCriteria):
-    sheet = Image.open(os.path.abspath(image_path))
-    hbox_count = criteria.sheet_width / criteria.tile_width
-    vbox_count = criteria.sheet_height / criteria.tile_height
-    boxes = _get_boxes(criteria.tile_width, criteria.tile_height, hbox_count, vbox_count)
-    alpha_layer = Image.new("RGBA", (criteria.tile_width, criteria.tile_height))
-    for index, box in enumerate(boxes):
-        cut_frame = sheet.crop(box).convert("RGBA")
-        # cut_frame = cut_frame.convert("RGBA")
-        if criteria.is_edge_alpha and cut_frame.size != (criteria.tile_width, criteria.tile_height):
-            alpha_copy = alpha_layer.copy()
-            alpha_copy.alpha_composite(cut_frame)
-            cut_frame = alpha_copy
-        yield {"msg": cut_frame.size}
-        save_name = os.path.join(out_dir, f"{filename}_{str(index).zfill(3)}.png")
-        cut_frame.save(save_name)
-    # yield {"msg": boxes}
-    # yield {"msg": "e"}
+    """ Slice a spritesheet into tiles, processing it in horizontal bands of whole tile rows so that memory stays bounded on very large sheets.\n
+        The tiles of a band are converted and PNG-encoded on criteria.workers threads
+    """
+    image_path = os.path.abspath(image_path)
+    hbox_count = math.ceil(criteria.sheet_width / criteria.tile_width)
+    vbox_count = math.ceil(criteria.sheet_height / criteria.tile_height)
+    row_bytes = criteria.sheet_width * criteria.tile_height * 4
+    band_rows = min(max(SPRITESHEET_BAND_BYTES // max(row_bytes, 1), 1), vbox_count)
+    band_count = math.ceil(vbox_count / band_rows)
+    bands = _sheet_bands(image_path, band_rows * criteria.tile_height, band_count)
+    tiles = _band_tiles(bands, criteria, hbox_count, vbox_count, band_rows)
+    tile_count = hbox_count * vbox_count
+
+    def save(indexed_tile):
+        index, tile = indexed_tile
+        save_path = os.path.join(out_dir, f"{filename}_{str(index).zfill(3)}.png")
+        return _save_tile(tile, save_path, criteria)
+
+    shout_nums = shout_indices(tile_count, 5)
+    saved = 0
+    for index, was_saved in enumerate(imap_ordered(save, tiles, criteria.workers)):
+        checkpoint()
+        saved += was_saved
+        if shout_nums.get(index):
+            yield {"msg": f"Slicing tiles ({shout_nums.get(index)})"}
+    skipped = tile_count - saved
+    yield {"msg": f"Saved {saved} tiles" + (f", skipped {skipped} fully transparent tiles" if skipped else "")}
     yield {"CONTROL": "SSPR_FINISH"}
 
 
+def _iter_image_files(image_paths: List[str]) -> Iterator[Image.Image]:
+    """ Open and decode the images one at a time, each of them is closed once the next one is requested """
+    for path in image_paths:
+        with Image.open(path) as im:
+            with stage("decode"):
+                im.load()
+            yield im
+
+
+def _spritesheet_frame_source(img_paths: List[str], input_mode: str) -> Tuple[int, Iterator[Image.Image]]:
+    """ Returns the frame count of the input, and a lazy iterator that decodes its frames one at a time.\n
+        Animated inputs are read in-process with their frames fully composited, the frame count comes from their headers without decoding anything
+    """
+    if input_mode == 'sequence':
+        return len(img_paths), _iter_image_files(img_paths)
+    elif input_mode == 'aimg':
+        aimg = img_paths[0]
+        ext = os.path.splitext(aimg)[1][1:]
+        if ext.lower() == 'gif':
+            return len(read_gif_blocks(aimg).frames), _gif_frame_iterator(aimg, coalesce=True)
+        elif ext.lower() == 'png':
+            return len(read_apng_chunks(aimg).animation_controls), _apng_frame_iterator(aimg, coalesce=True)
+        else:
+            raise Exception('Unknown image format!')
+    else:
+        raise Exception('Unknown input image mode!')
+
+
+def _atlas_rect(x: int, y: int, width: int, height: int) -> Dict[str, int]:
+    return {"x": x, "y": y, "w": width, "h": height}
+
+
+def _build_atlas(frames: Iterator[Image.Image], fcount: int, out_dir: str, filename: str, criteria: SpritesheetBuildCriteria):
+    """ Pack the frames into an atlas along with a JSON description of it, instead of placing them in a grid.\n
+        Frames keep their own size and are trimmed down to their visible pixels, identical trimmed frames are stored only once.
+        The JSON follows the widely supported TexturePacker hash layout, where spriteSourceSize is the offset of the trimmed frame inside the original one
+    """
+    yield {"msg": "Trimming frames..."}
+    shout_nums = shout_indices(fcount, 5)
+    unique_tiles = []
+    tile_indices = {}
+    frame_entries = []
+    for index, fr in enumerate(frames):
+        checkpoint()
+        with stage("transform", "trim"):
+            rgba = fr.convert("RGBA")
+            bbox = rgba.getchannel("A").getbbox()
+            tile = rgba.crop(bbox) if bbox else None
+        fr.close()
+        tile_index = None
+        if tile:
+            key = hashlib.blake2b(tile.tobytes(), digest_size=16)
+            key.update(str(tile.size).encode())
+            tile_index = tile_indices.setdefault(key.digest(), len(unique_tiles))
+            if tile_index == len(unique_tiles):
+                unique_tiles.append(tile)
+        frame_entries.append((tile_index, bbox, rgba.size))
+        rgba.close()
+        if shout_nums.get(index):
+            yield {"msg": f'Trimming frames... ({shout_nums.get(index)})'}
+    yield {"msg": f"Packing {len(unique_tiles)} unique frames..."}
+    with stage("transform", "pack"):
+        atlas_width, atlas_height, positions = pack_rects([tile.size for tile in unique_tiles], criteria.padding_x, criteria.padding_y,
+                                                          criteria.offset_x, criteria.offset_y, criteria.power_of_two)
+    atlas = Image.new("RGBA", (max(atlas_width, 1), max(atlas_height, 1)))
+    with stage("transform", "place"):
+        for tile, position in zip(unique_tiles, positions):
+            atlas.paste(tile, position)
+            tile.close()
+    atlas_frames = {}
+    for index, (tile_index, bbox, (orig_width, orig_height)) in enumerate(frame_entries):
+        if tile_index is None:
+            # Fully transparent frames take no space in the atlas
+            frame, source = _atlas_rect(0, 0, 0, 0), _atlas_rect(0, 0, 0, 0)
+        else:
+            left, top, right, bottom = bbox
+            frame = _atlas_rect(*positions[tile_index], right - left, bottom - top)
+            source = _atlas_rect(left, top, right - left, bottom - top)
+        atlas_frames[f"{filename}_{str(index).zfill(3)}"] = {
+            "frame": frame,
+            "rotated": False,
+            "trimmed": (source["w"], source["h"]) != (orig_width, orig_height),
+            "spriteSourceSize": source,
+            "sourceSize": {"w": orig_width, "h": orig_height},
+        }
+    final_path = os.path.join(out_dir, f"{filename}.png")
+    atlas_path = os.path.join(out_dir, f"{filename}.json")
+    atlas_info = {
+        "frames": atlas_frames,
+        "meta": {"image": os.path.basename(final_path), "format": "RGBA8888", "size": {"w": atlas.width, "h": atlas.height}, "scale": "1"},
+    }
+    yield {"msg": f'Saving the file...'}
+    with stage("write", "png"):
+        atlas.save(final_path, "PNG")
+    atlas.close()
+    with open(atlas_path, "w") as atlas_file:
+        json.dump(atlas_info, atlas_file, indent=2)
+    yield {"preview_path": final_path}
+    yield {"atlas_path": atlas_path}
+    yield {"CONTROL": "BSPR_FINISH"}
+
+
 def _build_spritesheet(image_paths: List, out_dir: str, filename: str, criteria: SpritesheetBuildCriteria):
     abs_image_paths = [os.path.abspath(ip) for ip in image_paths if os.path.exists(ip)]
     img_paths = [f for f in abs_image_paths if str.lower(os.path.splitext(f)[1][1:]) in set(STATIC_IMG_EXTS + ANIMATED_IMG_EXTS)]
@@ -66,31 +232,14 @@ def _build_spritesheet(image_paths: List, out_dir: str, filename: str, criteria:
     if not os.path.exists(out_dir):
         raise Exception("The specified absolute out_dir does not exist!")
     input_mode = criteria.input_format
-    frames = []
-    if input_mode == 'sequence':
-        frames = [Image.open(i) for i in img_paths]
-    elif input_mode == 'aimg':
-        aimg = img_paths[0]
-        ext = os.path.splitext(aimg)[1][1:]
-        if ext.lower() == 'gif':
-            gif: Image = Image.open(aimg)
-            for cr in range(0, gif.n_frames):
-                gif.seek(cr)
-                bytebox = io.BytesIO()
-                gif.save(bytebox, "PNG", optimize=True)
-                frames.append(Image.open(bytebox))
-                yield {"msg": f'Splitting GIF... ({cr + 1}/{gif.n_frames})'}
-        elif ext.lower() == 'png':
-            raise Exception('APNG!')
-        else:
-            raise Exception('Unknown image format!')
-    else:
-        raise Exception('Unknown input image mode!')
+    fcount, frames = _spritesheet_frame_source(img_paths, input_mode)
+    if criteria.layout == 'atlas':
+        yield from _build_atlas(frames, fcount, out_dir, filename, criteria)
+        return
     # tile_width = frames[0].size[0]
     # tile_height = frames[0].size[1]
     tile_width = criteria.tile_width
     tile_height = criteria.tile_height
-    fcount = len(frames)
     max_frames_row = criteria.tiles_per_row
     if fcount > max_frames_row:
         spritesheet_width = tile_width * max_frames_row
@@ -122,11 +271,12 @@ def _build_spritesheet(image_paths: List, out_dir: str, filename: str, criteria:
     boxes = list(_get_boxes(tile_width, tile_height, hbox_count, vbox_count, criteria.offset_x, criteria.offset_y, criteria.padding_x, criteria.padding_y))
     yield {"msg": boxes}
     for index, fr in enumerate(frames):
-
+        checkpoint()
         orig_width, orig_height = fr.size
         must_resize = criteria.tile_width != orig_width or criteria.tile_height != orig_height
         if must_resize:
-            fr = fr.resize((round(criteria.tile_width) , round(criteria.tile_height)))
+            with stage("transform", "resize"):
+                fr = fr.resize((round(criteria.tile_width) , round(criteria.tile_height)))
             # yield {"msg": f"RESIZING {must_resize}"}
         # top = tile_height * math.floor(index / max_frames_row) + criteria.offset_y
         # left = tile_width * (index % max_frames_row) + criteria.offset_x
@@ -136,9 +286,11 @@ def _build_spritesheet(image_paths: List, out_dir: str, filename: str, criteria:
         # box = (left, top, right, bottom)
         # box = [int(b) for b in box]
 
-        cut_frame = fr.crop((0, 0, tile_width, tile_height))
-        spritesheet.paste(cut_frame, boxes[index])
+        with stage("transform", "place"):
+            cut_frame = fr.crop((0, 0, tile_width, tile_height))
+            spritesheet.paste(cut_frame, boxes[index])
         cut_frame.close()
+        fr.close()
         if shout_nums.get(index):
             yield {"msg": f'Placing frames to sheet... ({shout_nums.get(index)})'}
         # boxes.append(box)
@@ -146,11 +298,8 @@ def _build_spritesheet(image_paths: List, out_dir: str, filename: str, criteria:
     final_path = os.path.join(out_dir, outfilename)
     yield {"msg": f'Saving the file...'}
     spritesheet.MAX_IMAGE_PIXELS = None
-    spritesheet.save(final_path, "PNG")
-    yield {"msg": "closing up images..."}
-    if input_mode == 'sequence':
-        for f in frames:
-            f.close()
+    with stage("write", "png"):
+        spritesheet.save(final_path, "PNG")
     spritesheet.close()
     yield {"preview_path": final_path}
     yield {"CONTROL": "BSPR_FINISH"}